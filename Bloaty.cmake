@@ -20,6 +20,7 @@
 #
 #   swift_add_bloaty(<target>
 #     [OPTIONS]
+#     [CSV_REPORT]
 #     [LOG_TOTAL_MEMORY]
 #     [LOG_TOTAL_MEMORY_OPTIONS arg1 arg2 ...]
 #     [WORKING_DIRECTORY working_directory]
@@ -49,6 +50,14 @@
 #             how much space the binary is taking on disk.
 #      both - Default, sorts by max(vm, file).
 #
+# CSV_REPORT additionally runs Bloaty with `--csv -n 0` on sections, compile
+# units if COMPILEUNITS is given, and symbols if SYMBOLS is given or COMPILEUNITS
+# is not, and writes the result to `${report_directory}/${target_name}.csv`.
+# With LOG_TOTAL_MEMORY, the CSV file is parsed instead of the table, and a JSON
+# report of the sizes per section, compile unit and symbol is written to
+# `${report_directory}/${target_name}.json`. That report can be stored as a
+# baseline for later builds, see `--baseline` below.
+#
 # LOG_TOTAL_MEMORY enables the creation of a log file where the output from Bloaty
 # is parsed and the total number of allocated static memory (VM size) gets inserted.
 #
@@ -60,6 +69,16 @@
 #                  [Default: `${report_directory}/../memory_log.txt`]
 # * --message:     Add a custom message that gets concatenated with the reported
 #                  total memory. [Default: `"Static memory usage:"`]
+# * --baseline:    Set equal to the file path of a JSON report from an earlier
+#                  build to print the largest growth by VM size and by file
+#                  size per section, compile unit and symbol. Needs CSV_REPORT.
+# * --top:         Number of entries in each ranking of the comparison.
+#                  [Default: 20]
+# * --budget:      Set equal to SECTION=SIZE to fail the target when the VM size
+#                  of a section exceeds SIZE bytes, `Ki`, `Mi` and `Gi` suffixes
+#                  are accepted. Can be given multiple times. Needs CSV_REPORT.
+#
+# Example: `LOG_TOTAL_MEMORY_OPTIONS --budget=.text=512Ki --budget=.data=16Ki`.
 #
 # WORKING_DIRECTORY changes the execution directory for the tool from the default
 # folder `${CMAKE_CURRENT_BINARY_DIR}` to the given argument. For instance, if
@@ -123,7 +142,7 @@ endmacro()
 function(swift_add_bloaty target)
   eval_bloaty_target(${target})
 
-  set(argOption SEGMENTS SECTIONS SYMBOLS COMPILEUNITS LOG_TOTAL_MEMORY)
+  set(argOption SEGMENTS SECTIONS SYMBOLS COMPILEUNITS CSV_REPORT LOG_TOTAL_MEMORY)
   set(argSingle NUM SORT WORKING_DIRECTORY REPORT_DIRECTORY)
   set(argMulti LOG_TOTAL_MEMORY_OPTIONS)
 
@@ -135,6 +154,7 @@ function(swift_add_bloaty target)
 
   set(target_name bloaty-${target})
   set(output_file ${target_name}.txt)
+  set(csv_file ${target_name}.csv)
 
   set(working_directory ${CMAKE_CURRENT_BINARY_DIR})
   if (x_WORKING_DIRECTORY)
@@ -163,6 +183,15 @@ function(swift_add_bloaty target)
     list(APPEND resource_options compileunits)
   endif()
 
+  # sections are always included for the per section budgets
+  set(csv_sources sections)
+  if (x_COMPILEUNITS)
+    set(csv_sources ${csv_sources},compileunits)
+  endif()
+  if (x_SYMBOLS OR NOT x_COMPILEUNITS)
+    set(csv_sources ${csv_sources},symbols)
+  endif()
+
   if (DEFINED resource_options)
     string(REPLACE ";" "," resource_options "${resource_options}")
     set(resource_options -d ${resource_options})
@@ -176,6 +205,17 @@ function(swift_add_bloaty target)
     list(APPEND resource_options -s ${x_SORT})
   endif()
 
+  if (NOT Bloaty_FOUND)
+    set(bloaty_executable ${bloaty_BINARY_DIR}/bloaty)
+  else()
+    set(bloaty_executable ${Bloaty_EXECUTABLE})
+  endif()
+
+  unset(csv_command)
+  if (x_CSV_REPORT)
+    set(csv_command COMMAND ${bloaty_executable} --csv -n 0 -d ${csv_sources} $<TARGET_FILE:${target}> > ${report_directory}/${csv_file})
+  endif()
+
   if (NOT Bloaty_FOUND)
     add_custom_target(${target_name}
       COMMAND $(MAKE) --directory=${bloaty_BINARY_DIR}
@@ -183,6 +223,7 @@ function(swift_add_bloaty target)
       COMMAND ${CMAKE_COMMAND} -E make_directory ${report_directory}
       COMMAND ${CMAKE_COMMAND} -E echo \"bloaty with options: ${resource_options}\" > ${report_directory}/${output_file}
       COMMAND ${bloaty_BINARY_DIR}/bloaty ${resource_options} $<TARGET_FILE:${target}> >> ${report_directory}/${output_file}
+      ${csv_command}
       WORKING_DIRECTORY ${working_directory}
       DEPENDS ${target}
     )
@@ -192,6 +233,7 @@ function(swift_add_bloaty target)
       COMMAND ${CMAKE_COMMAND} -E make_directory ${report_directory}
       COMMAND ${CMAKE_COMMAND} -E echo \"bloaty with options: ${resource_options}\" > ${report_directory}/${output_file}
       COMMAND ${Bloaty_EXECUTABLE} ${resource_options} $<TARGET_FILE:${target}> >> ${report_directory}/${output_file}
+      ${csv_command}
       WORKING_DIRECTORY ${working_directory}
       DEPENDS ${target}
     )
@@ -207,6 +249,11 @@ function(swift_add_bloaty target)
   if (x_LOG_TOTAL_MEMORY)
     set(memory_input_file -i=${report_directory}/${output_file})
     set(memory_output_file -o=${report_directory}/../memory_log.txt)
+    unset(memory_json_file)
+    if (x_CSV_REPORT)
+      set(memory_input_file -i=${report_directory}/${csv_file})
+      set(memory_json_file --json=${report_directory}/${target_name}.json)
+    endif()
     foreach (memory_option ${x_LOG_TOTAL_MEMORY_OPTIONS})
       if (${memory_option} MATCHES "--input_file")
         set(memory_input_file ${memory_option})
@@ -218,7 +265,7 @@ function(swift_add_bloaty target)
     endforeach()
 
     set(script_options ${x_LOG_TOTAL_MEMORY_OPTIONS})
-    list(APPEND script_options ${memory_input_file} ${memory_output_file})
+    list(APPEND script_options ${memory_input_file} ${memory_output_file} ${memory_json_file})
     add_custom_command(TARGET ${target_name} POST_BUILD
       COMMAND python ${CMAKE_SOURCE_DIR}/cmake/common/scripts/parse_bloaty.py ${script_options}
     )
@@ -10,6 +10,24 @@
 # WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
 #
 
+#
+# Creates the check-attributes target, which reports uses of __attribute__ in
+# the C and C++ files of the repository instead of the macros from
+# swiftnav/macros.h.
+#
+# create_check_attributes_target(
+#   [EXCLUDE <pathspec>...]
+#   [BASELINE <file>]
+# )
+#
+# EXCLUDE drops files matching the git pathspecs from the check.
+#
+# BASELINE is a JSON file mapping file names to the number of uses of
+# __attribute__ tolerated in them, so that only new uses fail the check. It is
+# created, and lowered as files are cleaned up, with
+#
+#   cmake/common/scripts/check_attributes.py --baseline <file> --update-baseline
+#
 function(create_check_attributes_target)
   if(NOT ${PROJECT_NAME} STREQUAL ${CMAKE_PROJECT_NAME})
     # Only create for top level projects
@@ -17,18 +35,22 @@ function(create_check_attributes_target)
   endif()
 
   set(argOption "")
-  set(argSingle "")
+  set(argSingle "BASELINE")
   set(argMulti "EXCLUDE")
 
   cmake_parse_arguments(x "${argOption}" "${argSingle}" "${argMulti}" ${ARGN})
 
-  set(arguments "'*.[ch]'" "'*.[ch]pp'" "'*.cc'" "'*.[ch]xx'")
+  set(arguments "")
+  if(x_BASELINE)
+    list(APPEND arguments --baseline ${x_BASELINE})
+  endif()
+  list(APPEND arguments "'*.[ch]'" "'*.[ch]pp'" "'*.cc'" "'*.[ch]xx'")
   foreach(excl ${x_EXCLUDE})
     list(APPEND arguments ":!:${excl}")
   endforeach()
 
   add_custom_target(check-attributes ALL
-    ${CMAKE_CURRENT_LIST_DIR}/cmake/common/scripts/check_attributes.sh ${arguments}
+    ${CMAKE_CURRENT_LIST_DIR}/cmake/common/scripts/check_attributes.py ${arguments}
     WORKING_DIRECTORY ${CMAKE_CURRENT_LIST_DIR}
   )
 
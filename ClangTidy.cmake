@@ -29,7 +29,9 @@
 #
 # The first target 'clang-tidy-${target}' will invoke clang-tidy for all source
 # files which make up the given target. It will export fixes to a file called
-# 'fixes-${target}.yaml' in the top level project source directory.
+# 'fixes-${target}.yaml' in the top level project source directory, and every
+# reported diagnostic to 'clang-tidy-${target}-diagnostics.jsonl' in the top
+# level build directory.
 #
 # The second target 'clang-tidy-${target}-check' will run clang-tidy as the
 # target described above and then return an error code if any warning/errors
@@ -37,13 +39,17 @@
 #
 # If the variable SWIFT_CLANG_TIDY_RATCHET_FILE is defined, then a
 # third target will be created: 'clang-tidy-${target}-ratchet-check'.
-# This target pipes the output of clang-tidy through
-# scripts/clang_tidy_ratchet.py and compares the output to the check
-# counts supplied in the filename in SWIFT_CLANG_TIDY_RATCHET_FILE,
-# returning failure only if the ratchet check script fails.  This
-# feature can be used to (approximately) mask existing clang-tidy
-# warnings without fixing them, so that development going forward
-# can still benefit from clang-tidy checking
+# This target runs clang-tidy, exporting the diagnostics to
+# 'clang-tidy-${target}-ratchet-diagnostics.jsonl' in the top level build
+# directory, and feeds them through scripts/clang_tidy_ratchet.py. It
+# compares the output to the check counts supplied in the filename in
+# SWIFT_CLANG_TIDY_RATCHET_FILE, returning failure only if the ratchet
+# check script fails. The exit status of clang-tidy is ignored, like
+# translation units which fail to compile, but the ratchet check fails
+# if no diagnostics file was written at all. This feature can be used
+# to (approximately) mask existing clang-tidy warnings without fixing
+# them, so that development going forward can still benefit from
+# clang-tidy checking
 #
 # In addition there are two other targets created which lint multiple targets
 # at the same time
@@ -57,6 +63,9 @@
 # clang-tidy-all and clang-tidy-world each have a "check" variant which returns
 # an error code should any warning/errors be generated
 #
+# clang-tidy-diff works like clang-tidy-all but only reports warnings/errors on
+# lines which changed since the master branch
+#
 # swift_create_clang_tidy_targets will generate a .clang-tidy file in the
 # project source directory which contains the Swift master config for
 # clang-tidy. There is no need for repositories to maintain their own version
@@ -83,10 +92,11 @@ set(CMAKE_EXPORT_COMPILE_COMMANDS ON CACHE BOOL "Export compile commands" FORCE)
 
 # Helper function to actually create the targets, not to be used outside this file
 function(create_clang_tidy_targets key fixes)
+  set(diagnostics ${CMAKE_BINARY_DIR}/clang-tidy-${key}-diagnostics.jsonl)
   add_custom_target(
     clang-tidy-${key}
     COMMAND ${CMAKE_CURRENT_SOURCE_DIR}/cmake/common/scripts/run-clang-tidy.py -clang-tidy-binary ${CLANG_TIDY} -p ${CMAKE_BINARY_DIR} -export-fixes=${CMAKE_SOURCE_DIR}/${fixes}
-            ${ARGN}
+            -export-diagnostics=${diagnostics} -deduplicate ${ARGN}
     WORKING_DIRECTORY ${CMAKE_BINARY_DIR})
   add_custom_target(
     clang-tidy-${key}-check
@@ -94,10 +104,14 @@ function(create_clang_tidy_targets key fixes)
     DEPENDS clang-tidy-${key}
     WORKING_DIRECTORY ${CMAKE_BINARY_DIR})
   if(DEFINED SWIFT_CLANG_TIDY_RATCHET_FILE)
+    set(ratchet_diagnostics ${CMAKE_BINARY_DIR}/clang-tidy-${key}-ratchet-diagnostics.jsonl)
     add_custom_target(
       clang-tidy-${key}-ratchet-check
+      COMMAND ${CMAKE_COMMAND} -E remove -f ${ratchet_diagnostics}
       COMMAND ${CMAKE_CURRENT_SOURCE_DIR}/cmake/common/scripts/run-clang-tidy.py -clang-tidy-binary ${CLANG_TIDY} -p ${CMAKE_BINARY_DIR}
-              ${ARGN} 2>/dev/null | ${CMAKE_CURRENT_SOURCE_DIR}/cmake/common/scripts/clang_tidy_ratchet.py --reference ${SWIFT_CLANG_TIDY_RATCHET_FILE}
+              -export-diagnostics=${ratchet_diagnostics} -deduplicate ${ARGN} 2>/dev/null || true
+      COMMAND ${CMAKE_CURRENT_SOURCE_DIR}/cmake/common/scripts/clang_tidy_ratchet.py --reference ${SWIFT_CLANG_TIDY_RATCHET_FILE} --diagnostics ${ratchet_diagnostics}
+              --root ${CMAKE_SOURCE_DIR}
       WORKING_DIRECTORY ${CMAKE_BINARY_DIR})
   endif()
 endfunction()
@@ -351,7 +365,8 @@ CheckOptions:
     list(REMOVE_DUPLICATES all_abs_srcs)
     list(FILTER all_abs_srcs EXCLUDE REGEX "pb.cc")
     create_clang_tidy_targets(all fixes.yaml ${all_abs_srcs})
-    create_clang_tidy_targets(diff fixes.yaml `git diff --diff-filter=ACMRTUXB --name-only master -- ${all_abs_srcs}`)
+    # Lints only the lines changed since master, in the "core" sources which contain them or include a changed header
+    create_clang_tidy_targets(diff fixes.yaml -diff-base=master ${all_abs_srcs})
   endif()
 
   if(NOT world_abs_srcs)
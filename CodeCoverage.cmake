@@ -100,6 +100,12 @@ if (NOT LLVM_COV_PATH)
   endif()
   find_program(LLVM_COV_PATH ${LLVM_COV_NAME})
 endif()
+if (NOT LLVM_PROFDATA_PATH)
+  if (NOT LLVM_PROFDATA_NAME)
+    set(LLVM_PROFDATA_NAME llvm-profdata)
+  endif()
+  find_program(LLVM_PROFDATA_PATH ${LLVM_PROFDATA_NAME})
+endif()
 find_program(GCOV_PATH gcov)
 find_program(LCOV_PATH lcov)
 find_program(GENHTML_PATH genhtml)
@@ -140,6 +146,9 @@ if(CODE_COVERAGE AND NOT CODE_COVERAGE_ADDED)
         )
       endif()
     endif()
+    if(NOT LLVM_PROFDATA_PATH)
+      message(FATAL_ERROR "llvm-profdata not found! Aborting.")
+    endif()
 
     # Targets
     add_custom_target(ccov-clean
@@ -257,7 +266,7 @@ function(target_code_coverage TARGET_NAME)
           DEPENDS ccov-preprocessing ${TARGET_NAME})
 
         add_custom_target(ccov-processing-${TARGET_NAME}
-                          COMMAND llvm-profdata merge -sparse
+                          COMMAND ${LLVM_PROFDATA_PATH} merge -sparse
                                   ${TARGET_NAME}.profraw -o
                                   ${TARGET_NAME}.profdata
                           DEPENDS ccov-run-${TARGET_NAME})
@@ -392,6 +401,14 @@ endfunction()
 # `target_code_coverage` with the `ALL` parameter, but merges all the coverage
 # data from them into a single large report  instead of the numerous smaller
 # reports.
+#
+# With llvm-cov, the work is done by scripts/coverage_report.py:
+# ccov-all-processing merges the profiles in parallel as a tree, caching the
+# intermediate results in ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/profdata-cache so
+# that only the profiles of binaries which ran again are merged again, and runs
+# llvm-cov export once into ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/coverage.json.
+# ccov-all, ccov-all-report and ccov-all-export render their reports from that
+# export instead of running llvm-cov over all binaries again.
 # ~~~
 # Optional:
 # EXCLUDE <REGEX_PATTERNS> - Excludes files of the regex patterns provided from coverage.
@@ -418,45 +435,51 @@ function(add_code_coverage_all_targets)
   if(CODE_COVERAGE AND TOP_LEVEL_PROJECT)
     if("${CMAKE_C_COMPILER_ID}" MATCHES "(Apple)?[Cc]lang"
        OR "${CMAKE_CXX_COMPILER_ID}" MATCHES "(Apple)?[Cc]lang")
-      # Targets
-      add_custom_target(
-        ccov-all-processing
-        COMMAND llvm-profdata merge -o
-                ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/all-merged.profdata -sparse
-                `cat ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/profraw.list`)
-
       if(LLVM_COV_VERSION VERSION_GREATER_EQUAL "7.0.0")
         foreach(EXCLUDE_ITEM ${add_code_coverage_all_targets_EXCLUDE})
           set(EXCLUDE_REGEX ${EXCLUDE_REGEX}
-              -ignore-filename-regex=${EXCLUDE_ITEM})
+              --ignore-filename-regex=${EXCLUDE_ITEM})
         endforeach()
       endif()
 
+      set(COVERAGE_SCRIPT ${CMAKE_SOURCE_DIR}/cmake/common/scripts/coverage_report.py)
+      set(COVERAGE_EXPORT ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/coverage.json)
+
+      # Targets
+      add_custom_target(
+        ccov-all-processing
+        COMMAND
+          ${COVERAGE_SCRIPT} merge
+          --profraw-list ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/profraw.list
+          -o ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/all-merged.profdata
+          --cache-dir ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/profdata-cache
+          --llvm-profdata ${LLVM_PROFDATA_PATH}
+        COMMAND
+          ${COVERAGE_SCRIPT} export
+          --binaries-list ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/binaries.list
+          --profdata ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/all-merged.profdata
+          -o ${COVERAGE_EXPORT}
+          --llvm-cov ${LLVM_COV_PATH}
+          ${EXCLUDE_REGEX})
+
       add_custom_target(
         ccov-all-report
         COMMAND
-          ${LLVM_COV_PATH} report `cat ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/binaries.list`
-          -instr-profile=${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/all-merged.profdata
-          ${EXCLUDE_REGEX}
+          ${COVERAGE_SCRIPT} render --export ${COVERAGE_EXPORT} --summary
         DEPENDS ccov-all-processing)
 
       add_custom_target(
         ccov-all
         COMMAND
-          ${LLVM_COV_PATH} show `cat ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/binaries.list`
-          -instr-profile=${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/all-merged.profdata
-          -show-line-counts-or-regions
-          -output-dir=${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/all-merged
-          -format="html" ${EXCLUDE_REGEX}
+          ${COVERAGE_SCRIPT} render --export ${COVERAGE_EXPORT}
+          --html ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/all-merged
         DEPENDS ccov-all-processing)
 
       add_custom_target(
         ccov-all-export
         COMMAND
-          ${LLVM_COV_PATH} show `cat ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/binaries.list`
-          -instr-profile=${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/all-merged.profdata
-          -show-line-counts-or-regions
-          -format="text" ${EXCLUDE_REGEX} > ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/coverage.txt
+          ${COVERAGE_SCRIPT} render --export ${COVERAGE_EXPORT}
+          --text ${CMAKE_COVERAGE_OUTPUT_DIRECTORY}/coverage.txt
         DEPENDS ccov-all-processing)
 
     elseif("${CMAKE_C_COMPILER_ID}" MATCHES "GNU"
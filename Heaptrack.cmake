@@ -42,6 +42,17 @@
 #                  [Default: `${report_directory}/../memory_log.txt`]
 # * --message:     Add a custom message that gets concatenated with the reported
 #                  total memory. [Default: `"Heap memory usage:"`]
+# * --report:      Boolean flag that, if included, writes an extended report
+#                  next to the input file: `${target_name}.gz.json` with the
+#                  heap usage over time and the top allocation sites by peak
+#                  contribution and by number of allocations, and
+#                  `${target_name}.gz.csv` with the heap usage over time.
+# * --top:         Number of allocation sites in each ranking of the report.
+#                  [Default: 20]
+# * --points:      Maximum number of points of the heap usage over time.
+#                  [Default: 1000]
+#
+# Example: `LOG_TOTAL_MEMORY_OPTIONS --report --top=50`.
 #
 # NAME makes it possible to choose a custom name for the target, which
 # is useful in situations using Google Test.
@@ -18,24 +18,28 @@
 # When included will create 2 new targets:
 # - fix-include-guards - Check all header files in the repository for the
 #   above conditions
-# - fix-include-guards-check - Depends on fix-include-guards then exits with
-#   an error code if any changes were applied. Useful for enforcing checks
-#   during CI runs
+# - fix-include-guards-check - Reports the header files which need changes
+#   without modifying them and exits with an error code if there are any.
+#   Useful for enforcing checks during CI runs
 #
 # Include guards are formatted according to the header file's location in the
 # source tree. Copyright notices are boiler plate block comments
 #
-# Changes are applied in place
+# Changes are applied in place, only to header files which actually need
+# changes. Header files are checked in parallel, and the git blob hashes of
+# header files without problems are cached in the build directory so that
+# they are skipped on the next run.
 #
 
+set(_include_guards_cache ${CMAKE_CURRENT_BINARY_DIR}/fix-include-guards-${PROJECT_NAME}-cache.json)
 add_custom_target(fix-include-guards-${PROJECT_NAME}
   COMMAND
-    ${CMAKE_CURRENT_LIST_DIR}/scripts/fix_include_guards.py `git ls-files '*.h'`
+    ${CMAKE_CURRENT_LIST_DIR}/scripts/fix_include_guards.py --cache ${_include_guards_cache} `git ls-files '*.h'`
   WORKING_DIRECTORY ${PROJECT_SOURCE_DIR}
 )
 add_custom_target(fix-include-guards-check-${PROJECT_NAME}
-  COMMAND git diff --exit-code
-  DEPENDS fix-include-guards-${PROJECT_NAME}
+  COMMAND
+    ${CMAKE_CURRENT_LIST_DIR}/scripts/fix_include_guards.py --check --cache ${_include_guards_cache} `git ls-files '*.h'`
   WORKING_DIRECTORY ${PROJECT_SOURCE_DIR}
 )
 
@@ -43,6 +43,17 @@
 #                  [Default: `${report_directory}/../memory_log.txt`]
 # * --message:     Add a custom message that gets concatenated with the reported
 #                  total memory. [Default: `"Stack memory usage:"`]
+# * --report:      Set equal to a file path where a JSON report with the
+#                  maximal used stack, stack size and utilization per thread,
+#                  the totals per process and the threads closest to overflow
+#                  should be written.
+# * --baseline:    Set equal to the file path of a JSON report from an earlier
+#                  run. The target fails if the maximal used stack of a thread
+#                  grew by more than the threshold.
+# * --threshold:   Allowed growth in percent of the maximal used stack of a
+#                  thread compared to the baseline. [Default: 10]
+#
+# Example: `LOG_TOTAL_MEMORY_OPTIONS --report=${CMAKE_BINARY_DIR}/stack.json`.
 #
 # NAME makes it possible to choose a custom name for the target, which
 # is useful in situations using Google Test.
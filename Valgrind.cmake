@@ -131,6 +131,20 @@
 # UNDEF_VALUE_ERRORS controls whether Memcheck reports uses of undefined value
 # errors.
 #
+# SUPPRESSIONS_FILE=<path> passes a Valgrind suppressions file, relative to
+# `${CMAKE_SOURCE_DIR}`, to Memcheck. Errors matching one of its suppressions
+# are not reported.
+#
+# GENERATE_SUPPRESSIONS_FILE=<path> runs Memcheck with `--gen-suppressions=all`
+# and appends the suppressions of all reported errors to the given file,
+# relative to the report directory in the build tree. Suppressions are cut to
+# their top frames followed by a `...` wildcard and deduplicated against the
+# ones already in the file. The generated file only collects candidates: after
+# triaging an error, copy its suppression into SUPPRESSIONS_FILE by hand. The
+# two must not be the same file, otherwise every new error would be suppressed
+# from the next run on. The number of frames kept can be changed with the
+# `--suppression_frames` JUNIT_OPTIONS.
+#
 # GENERATE_JUNIT_REPORT converts the xml file output to a JUnit xml file
 # format that can be picked up by CI tools such as Jenkins to display test
 # results.
@@ -294,7 +308,7 @@ endmacro()
 
 function(swift_add_valgrind_memcheck target)
   set(argOption SHOW_REACHABLE TRACK_ORIGINS UNDEF_VALUE_ERRORS GENERATE_JUNIT_REPORT)
-  set(argSingle LEAK_CHECK SUPPRESSIONS_FILE)
+  set(argSingle LEAK_CHECK SUPPRESSIONS_FILE GENERATE_SUPPRESSIONS_FILE)
   set(argMulti JUNIT_OPTIONS)
 
   set(valgrind_tool memcheck)
@@ -322,13 +336,24 @@ function(swift_add_valgrind_memcheck target)
     list(APPEND valgrind_tool_options "--leak-check=${x_LEAK_CHECK}")
   endif()
 
+  if (x_GENERATE_SUPPRESSIONS_FILE)
+    get_filename_component(generated_suppressions ${x_GENERATE_SUPPRESSIONS_FILE} ABSOLUTE BASE_DIR ${report_directory})
+    if (x_SUPPRESSIONS_FILE AND generated_suppressions STREQUAL "${CMAKE_SOURCE_DIR}/${x_SUPPRESSIONS_FILE}")
+      message(FATAL_ERROR "GENERATE_SUPPRESSIONS_FILE must not be the SUPPRESSIONS_FILE, new errors would be suppressed without being triaged")
+    endif()
+  endif()
+
   if (x_SUPPRESSIONS_FILE)
     list(APPEND valgrind_tool_options "--suppressions=${CMAKE_SOURCE_DIR}/${x_SUPPRESSIONS_FILE}")
   endif()
 
+  if (x_GENERATE_SUPPRESSIONS_FILE)
+    list(APPEND valgrind_tool_options --gen-suppressions=all)
+  endif()
+
   setup_custom_target(${valgrind_tool} ${target_name})
 
-  if (x_GENERATE_JUNIT_REPORT)
+  if (x_GENERATE_JUNIT_REPORT OR x_GENERATE_SUPPRESSIONS_FILE)
     set(junit_input_dir -i=${report_directory}/${report_folder})
     set(junit_output_dir -o=${report_directory}/junit-xml)
     foreach (junit_option ${x_JUNIT_OPTIONS})
@@ -344,6 +369,9 @@ function(swift_add_valgrind_memcheck target)
     set(script_options ${x_JUNIT_OPTIONS})
     list(APPEND script_options ${junit_input_dir})
     list(APPEND script_options ${junit_output_dir})
+    if (x_GENERATE_SUPPRESSIONS_FILE)
+      list(APPEND script_options --generate_suppressions=${generated_suppressions})
+    endif()
 
     add_custom_command(TARGET ${target_name} POST_BUILD
       COMMAND python ${CMAKE_SOURCE_DIR}/cmake/common/scripts/memcheck_xml2junit_converter.py ${script_options}
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+#
+
+"""
+Benchmarks the bounded prefix scanner of fix_include_guards.py against reading
+and splitting every header completely, as fix_header_guard did before.
+
+A synthetic tree of headers is generated. Most headers are small and correct,
+some have a wrong guard or no copyright notice, some use #pragma once and a
+few are large generated headers, like the ones protobuf and nanopb produce.
+Both implementations check the tree in a single process without writing, and
+have to find the same headers with problems.
+
+USAGE
+
+  python3 benchmark_fix_include_guards.py [--headers 50000]
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import shutil
+import tempfile
+import time
+
+COPYRIGHT = """/**
+ * Copyright (C) 2023 Swift Navigation Inc.
+ * Contact: Swift Navigation <dev@swiftnav.com>
+ */
+"""
+
+
+def load_fix_include_guards():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fix_include_guards.py")
+    spec = importlib.util.spec_from_file_location("fix_include_guards", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_tree(root, headers, large_fraction, large_size, module):
+    rng = random.Random(0)
+    filenames = []
+    for index in range(headers):
+        directory = os.path.join(root, "lib{}".format(index % 100), "include", "lib{}".format(index % 100))
+        os.makedirs(directory, exist_ok=True)
+        filename = os.path.join(directory, "header_{}.h".format(index))
+        guard = module.get_expected_guard(filename)
+        kind = rng.random()
+        with open(filename, "w") as f:
+            if kind < 0.02:
+                f.write("#pragma once\n")
+            elif kind < 0.04:
+                f.write("#ifndef WRONG_GUARD_H\n#define WRONG_GUARD_H\n")
+            else:
+                if kind > 0.05:
+                    f.write(COPYRIGHT)
+                f.write("#ifndef {0}\n#define {0}\n".format(guard))
+            if rng.random() < large_fraction:
+                body = "typedef struct _Message{0} {{ pb_size_t field_{0}; }} Message{0};\n"
+                lines = large_size // len(body)
+                f.write("".join(body.format(line) for line in range(lines)))
+            else:
+                for declaration in range(rng.randint(10, 100)):
+                    f.write("int function_{}_{}(int argument);\n".format(index, declaration))
+            if kind >= 0.02:
+                f.write("#endif\n")
+        filenames.append(filename)
+    return filenames
+
+
+def legacy_check(module, filename):
+    with open(filename, "r", newline="") as target_file:
+        content = target_file.read()
+    return module.get_fixed_content(filename, content)[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the header scanner of fix_include_guards.py.")
+    parser.add_argument("--headers", type=int, default=50000, help="number of headers")
+    parser.add_argument("--large-fraction", type=float, default=0.005, help="fraction of large generated headers")
+    parser.add_argument("--large-size", type=int, default=1 << 20, help="size of large generated headers in bytes")
+    args = parser.parse_args()
+
+    module = load_fix_include_guards()
+    workdir = tempfile.mkdtemp()
+    try:
+        print("Generating {} headers ...".format(args.headers))
+        filenames = generate_tree(workdir, args.headers, args.large_fraction, args.large_size, module)
+
+        results = {}
+        for name, check in (
+            ("full read", lambda filename: legacy_check(module, filename)),
+            ("prefix", lambda filename: module.fix_header_guard(filename, check=True)),
+        ):
+            start = time.time()
+            failing = set(filename for filename in filenames if check(filename))
+            elapsed = time.time() - start
+            results[name] = failing
+            print("{:>10}: {:8.2f}s  {} headers with problems".format(name, elapsed, len(failing)))
+        if results["full read"] != results["prefix"]:
+            print("MISMATCH: the implementations found different headers with problems")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
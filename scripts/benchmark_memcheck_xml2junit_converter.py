@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+#
+
+"""
+Benchmarks memcheck_xml2junit_converter.py over a synthetic corpus of Valgrind
+Memcheck xml files, as produced by tracing children with one xml file per
+process, for an increasing number of jobs.
+
+Every run writes to its own output directory, which is compared against the
+output of the single job run to check that the result does not depend on the
+number of jobs.
+
+USAGE
+
+  python3 benchmark_memcheck_xml2junit_converter.py [--files 200] [--errors 500]
+"""
+
+import argparse
+import filecmp
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+KINDS = ["InvalidRead", "InvalidWrite", "UninitCondition", "Leak_DefinitelyLost"]
+
+
+def write_error(out, rng, unique):
+    kind = rng.choice(KINDS)
+    site = rng.randint(0, 50)
+    out.write("  <error>\n    <unique>0x{:x}</unique>\n    <tid>1</tid>\n    <kind>{}</kind>\n".format(unique, kind))
+    if kind.startswith("Leak"):
+        out.write(
+            "    <xwhat><text>{} bytes in 1 blocks are definitely lost</text>"
+            "<leakedbytes>{}</leakedbytes></xwhat>\n".format(8 * site, 8 * site)
+        )
+    else:
+        out.write("    <what>Invalid read of size {}</what>\n".format(rng.choice([1, 4, 8])))
+    out.write("    <stack>\n")
+    for depth in range(8):
+        out.write(
+            "      <frame><ip>0x{:X}</ip><obj>/usr/bin/test</obj><fn>site_{}_{}</fn>"
+            "<dir>/src</dir><file>site_{}.c</file><line>{}</line></frame>\n".format(
+                0x400000 + rng.randint(0, 1 << 20), site, depth, site, 10 + depth
+            )
+        )
+    out.write("    </stack>\n  </error>\n")
+
+
+def generate_corpus(directory, files, errors):
+    for index in range(files):
+        rng = random.Random(index)
+        with open(os.path.join(directory, "test.xml.{}".format(1000 + index)), "w") as out:
+            out.write('<?xml version="1.0"?>\n<valgrindoutput>\n  <pid>{}</pid>\n'.format(1000 + index))
+            for unique in range(rng.randint(errors // 2, errors)):
+                write_error(out, rng, unique)
+            out.write("</valgrindoutput>\n")
+
+
+def same_tree(left, right):
+    comparison = filecmp.dircmp(left, right)
+    if comparison.left_only or comparison.right_only:
+        return False
+    _, mismatch, errors = filecmp.cmpfiles(left, right, comparison.common_files, shallow=False)
+    return not mismatch and not errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark memcheck_xml2junit_converter.py for increasing job counts.")
+    parser.add_argument("--files", type=int, default=200, help="number of xml files")
+    parser.add_argument("--errors", type=int, default=500, help="maximum number of errors per xml file")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        nargs="+",
+        default=sorted(set([1, 2, 4, multiprocessing.cpu_count()])),
+        help="job counts to benchmark",
+    )
+    args = parser.parse_args()
+
+    converter = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memcheck_xml2junit_converter.py")
+    workdir = tempfile.mkdtemp()
+    try:
+        input_directory = os.path.join(workdir, "input")
+        os.mkdir(input_directory)
+        print("Generating {} xml files ...".format(args.files))
+        generate_corpus(input_directory, args.files, args.errors)
+
+        reference = None
+        baseline = None
+        for jobs in args.jobs:
+            output_directory = os.path.join(workdir, "junit-{}".format(jobs))
+            start = time.time()
+            subprocess.check_call(
+                [sys.executable, converter, "-i", input_directory, "-o", output_directory, "-j", str(jobs)]
+            )
+            elapsed = time.time() - start
+            if reference is None:
+                reference = output_directory
+                baseline = elapsed
+                identical = True
+            else:
+                identical = same_tree(reference, output_directory)
+            print(
+                "{:>4} jobs: {:8.2f}s  speedup {:5.2f}x  {}".format(
+                    jobs, elapsed, baseline / elapsed, "identical" if identical else "OUTPUT DIFFERS"
+                )
+            )
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+#
+
+"""
+Benchmarks merge_replacement_files from run-clang-tidy.py against the
+implementation it replaced, which loaded every replacement file into one list
+and dumped it with the pure Python YAML dumper.
+
+A synthetic set of per translation unit replacement files is generated, where
+every file has a few diagnostics of its own plus the diagnostics of a number
+of shared headers, as clang-tidy -export-fixes produces them. Each
+implementation runs in a fresh process so that its peak RSS can be reported.
+
+USAGE
+
+  python3 benchmark_merge_replacement_files.py [--files 10000]
+"""
+
+import argparse
+import glob
+import importlib.util
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import yaml
+
+
+def load_run_clang_tidy():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run-clang-tidy.py")
+    spec = importlib.util.spec_from_file_location("run_clang_tidy", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_merge_replacement_files(tmpdir, mergefile):
+    mergekey = "Diagnostics"
+    merged = []
+    for replacefile in glob.iglob(os.path.join(tmpdir, "*.yaml")):
+        content = yaml.safe_load(open(replacefile, "r"))
+        if not content:
+            continue
+        merged.extend(content.get(mergekey, []))
+
+    if merged:
+        output = {"MainSourceFile": "", mergekey: merged}
+        with open(mergefile, "w") as out:
+            yaml.safe_dump(output, out)
+
+
+def make_diagnostic(filename, offset):
+    return {
+        "DiagnosticName": "readability-braces-around-statements",
+        "DiagnosticMessage": {
+            "Message": "statement should be inside braces",
+            "FilePath": filename,
+            "FileOffset": offset,
+            "Replacements": [
+                {"FilePath": filename, "Offset": offset, "Length": 0, "ReplacementText": " {"},
+                {"FilePath": filename, "Offset": offset + 40, "Length": 0, "ReplacementText": "\n}"},
+            ],
+        },
+        "Level": "Warning",
+        "BuildDirectory": "/build",
+    }
+
+
+def generate_fixes(directory, files, own, headers, per_header):
+    header_diagnostics = [
+        make_diagnostic("/src/include/header_%d.h" % header, 100 * index)
+        for header in range(headers)
+        for index in range(per_header)
+    ]
+    for index in range(files):
+        source = "/src/source_%d.cc" % index
+        diagnostics = [make_diagnostic(source, 100 * i) for i in range(own)]
+        content = {"MainSourceFile": source, "Diagnostics": diagnostics + header_diagnostics}
+        with open(os.path.join(directory, "fixes_%d.yaml" % index), "w") as f:
+            yaml.dump(content, f, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
+
+
+def run(name, fixes_dir, output, queue):
+    if name == "legacy":
+        merge = legacy_merge_replacement_files
+    else:
+        merge = load_run_clang_tidy().merge_replacement_files
+    start = time.time()
+    merge(fixes_dir, output)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark merging of clang-tidy replacement files.")
+    parser.add_argument("--files", type=int, default=10000, help="number of replacement files")
+    parser.add_argument("--own", type=int, default=3, help="diagnostics per file in its own source")
+    parser.add_argument("--headers", type=int, default=5, help="number of headers included by every file")
+    parser.add_argument("--per-header", type=int, default=2, help="diagnostics per header")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        fixes_dir = os.path.join(workdir, "fixes")
+        os.mkdir(fixes_dir)
+        print("Generating {} replacement files ...".format(args.files))
+        generate_fixes(fixes_dir, args.files, args.own, args.headers, args.per_header)
+
+        context = multiprocessing.get_context("spawn")
+        for name in ("legacy", "streaming"):
+            output = os.path.join(workdir, name + ".yaml")
+            queue = context.Queue()
+            process = context.Process(target=run, args=(name, fixes_dir, output, queue))
+            process.start()
+            elapsed, peak = queue.get()
+            process.join()
+            print(
+                "{:>10}: {:8.2f}s  peak RSS {:8.1f} MiB  output {:8.1f} MiB".format(
+                    name, elapsed, peak, os.path.getsize(output) / 1024.0 / 1024.0
+                )
+            )
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
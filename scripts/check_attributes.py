@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+#
+
+"""
+Reports uses of __attribute__ in the files tracked by git, which should use
+one of the macros from swiftnav/macros.h instead.
+
+The arguments are git pathspecs selecting the files to check, exactly like the
+arguments of check_attributes.sh. Files are mapped into memory and searched
+with a compiled regex by a pool of worker processes, the diagnostics are
+printed in the order of git ls-files and in the same format as
+check_attributes.sh:
+
+  /path/to/file.c:12: error: Do not use __attribute__, prefer one of the macros from swiftnav/macros.h
+            int foo(void) __attribute__((unused));
+
+A baseline maps file names to the number of uses of __attribute__ which are
+tolerated in them, so that legacy code does not block new changes. Only the
+files with more uses than recorded in the baseline are reported. Updating the
+baseline never raises a count, it only lowers the counts of files which were
+cleaned up, so the number of uses can only go down over time.
+
+USAGE
+
+  check_attributes.py [-j JOBS] [--json FILE] [--baseline FILE [--update-baseline]] [PATHSPEC ...]
+"""
+
+import argparse
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+ATTRIBUTE_RE = re.compile(rb"__attribute__")
+MESSAGE = "Do not use __attribute__, prefer one of the macros from swiftnav/macros.h"
+# Whitespace stripped from the end of a line by the shell's `read`.
+TRAILING_WHITESPACE = b" \t\n"
+
+
+def find_attributes_in(data):
+    """Returns the (line number, line) of every line using __attribute__.
+
+    data is the content of a file, as bytes or mmap.
+    """
+    matches = []
+    position = 0
+    line_number = 1
+    match = ATTRIBUTE_RE.search(data)
+    while match is not None:
+        start = data.rfind(b"\n", 0, match.start()) + 1
+        end = data.find(b"\n", match.end())
+        if end == -1:
+            end = len(data)
+        line_number += data[position:start].count(b"\n")
+        matches.append((line_number, data[start:end].rstrip(TRAILING_WHITESPACE)))
+        position = start
+        match = ATTRIBUTE_RE.search(data, end)
+    return matches
+
+
+def find_attributes(filename):
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return find_attributes_in(data)
+
+
+def check_file(filename):
+    try:
+        return filename, find_attributes(filename)
+    except (IOError, ValueError) as e:
+        print("{}: {}".format(filename, e), file=sys.stderr)
+        return filename, []
+
+
+def list_files(pathspecs):
+    output = subprocess.check_output(["git", "ls-files", "-z", "--"] + pathspecs)
+    return [filename for filename in output.decode("utf-8").split("\0") if filename]
+
+
+def working_directory():
+    """Returns the working directory like the shell's pwd, keeping symlinks."""
+    pwd = os.environ.get("PWD")
+    if pwd and os.path.isabs(pwd):
+        try:
+            if os.path.samefile(pwd, "."):
+                return pwd
+        except OSError:
+            pass
+    return os.getcwd()
+
+
+def format_diagnostic(pwd, filename, line_number, code):
+    location = "{}/{}:{}: error: {}".format(pwd, filename, line_number, MESSAGE).encode("utf-8")
+    return location + b"\n          " + code + b"\n"
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def ratchet_baseline(baseline, counts, create):
+    """Returns the baseline with the counts of improved files lowered.
+
+    Files are only added if the baseline is being created.
+    """
+    if create:
+        return dict(counts)
+    result = {}
+    for filename, count in baseline.items():
+        count = min(count, counts.get(filename, 0))
+        if count > 0:
+            result[filename] = count
+    return result
+
+
+def write_json(data, path):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write("\n")
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check files tracked by git for uses of __attribute__.")
+    parser.add_argument("pathspecs", nargs="*", help="git pathspecs of the files to check")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of processes checking files"
+    )
+    parser.add_argument("--json", metavar="FILE", help="also write the diagnostics to a JSON file")
+    parser.add_argument(
+        "--baseline", metavar="FILE", help="JSON file with the number of uses tolerated in each file"
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="lower the counts of the baseline to the current ones, or create it if it doesn't exist",
+    )
+    args = parser.parse_args()
+
+    if args.update_baseline and not args.baseline:
+        parser.error("--update-baseline requires --baseline")
+
+    filenames = list_files(args.pathspecs)
+    if args.jobs > 1 and len(filenames) > 1:
+        with multiprocessing.Pool(min(args.jobs, len(filenames))) as pool:
+            results = pool.map(check_file, filenames, chunksize=max(1, len(filenames) // (args.jobs * 8)))
+    else:
+        results = [check_file(filename) for filename in filenames]
+
+    counts = {filename: len(matches) for filename, matches in results if matches}
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+    create_baseline = args.update_baseline and not os.path.exists(args.baseline)
+    if create_baseline:
+        baseline = dict(counts)
+
+    pwd = working_directory()
+    out = sys.stdout.buffer
+    failed = False
+    diagnostics = []
+    for filename, matches in results:
+        if not matches:
+            continue
+        tolerated = len(matches) <= baseline.get(filename, 0)
+        if not tolerated:
+            failed = True
+        for line_number, code in matches:
+            if not tolerated:
+                out.write(format_diagnostic(pwd, filename, line_number, code))
+            diagnostics.append(
+                {
+                    "file": filename,
+                    "line": line_number,
+                    "code": code.decode("utf-8", "replace"),
+                    "baseline": tolerated,
+                }
+            )
+    out.flush()
+
+    if args.baseline:
+        for filename in sorted(baseline):
+            if counts.get(filename, 0) < baseline[filename]:
+                print(
+                    "{}: {} --> {} uses of __attribute__".format(filename, baseline[filename], counts.get(filename, 0)),
+                    file=sys.stderr,
+                )
+        if args.update_baseline:
+            write_json(ratchet_baseline(baseline, counts, create_baseline), args.baseline)
+        elif any(counts.get(filename, 0) < count for filename, count in baseline.items()):
+            print("Please lower the counts in the baseline with --update-baseline.", file=sys.stderr)
+
+    if args.json:
+        write_json(diagnostics, args.json)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,27 +12,5 @@
 # WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
 #
 
-result=0
-
-files=$(git ls-files "$@")
-while read -r file;
-do
-  matches=$(grep -Hn __attribute__ "$file")
-  while read -r line;
-  do
-    if [ -n "$line" ];
-    then
-      location=$(echo "$line" | cut -d: -f-2)
-      code=$(echo "$line" | cut -d: -f3-)
-      echo "$(pwd)/$location: error: Do not use __attribute__, prefer one of the macros from swiftnav/macros.h"
-      echo "          $code"
-      result=1
-    fi
-  done <<EOF_MATCHES
-  $matches
-EOF_MATCHES
-done <<EOF_FILES
-$files
-EOF_FILES
-
-exit $result
+# Kept for callers of the shell script, the check is in check_attributes.py.
+exec python3 "$(dirname "$0")/check_attributes.py" "$@"
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 import re
+import json
 import yaml
 import argparse
+import itertools
+import multiprocessing
 
 
 LINE = "(?P<line_number>[0-9]+)"
@@ -13,35 +17,245 @@ CHECK = "(?P<check_name>[a-z-]+)"
 extract_check = re.compile(
     f"^{FILENAME}:{LINE}:{COLUMN}:[ ]+(warning|error):[^[]+\[{CHECK}\]$"
 )
+valid_check = re.compile(f"^{CHECK}$")
+
+
+class WarningIndex:
+    """Unique warning locations indexed by (check, file).
+
+    Locations are kept as sets so that a warning in a header which is
+    reported once per including translation unit is only counted once.
+    This is intended to prevent situations like the count of issues
+    going up when someone `#include`s a known problematic header in a
+    new source file.
+
+    """
+
+    def __init__(self):
+        self.locations = {}
+
+    def add(self, check_name, filename, line_number, column_number):
+        self.locations.setdefault((check_name, filename), set()).add(
+            (line_number, column_number)
+        )
+
+    def update(self, other):
+        for key, locations in other.locations.items():
+            self.locations.setdefault(key, set()).update(locations)
+
+    def files(self):
+        return {filename for _, filename in self.locations}
+
+    def check_counts(self):
+        """Return a map from check name to the number of occurrences."""
+        results = {}
+        for (check_name, _), locations in self.locations.items():
+            results[check_name] = results.get(check_name, 0) + len(locations)
+        return results
+
+    def file_counts(self, root=None):
+        """Return a map from check name to a map from file name,
+        relative to root where possible, to the number of occurrences.
+
+        """
+        results = {}
+        for (check_name, filename), locations in self.locations.items():
+            results.setdefault(check_name, {})[relative_path(filename, root)] = len(
+                locations
+            )
+        return results
+
+
+def relative_path(filename, root):
+    if root and filename.startswith(root + os.sep):
+        return filename[len(root) + 1 :]
+    return filename
 
 
 def load_count_reference(reference_file):
-    return yaml.safe_load(reference_file) or {}
+    """Load a reference file.
+
+    Each check maps either to a total count, the original format, or
+    to a map from file name to count.
+
+    """
+    return yaml.load(reference_file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
+
+
+def reference_totals(reference):
+    """Collapse a reference into a map from check name to total count."""
+    return {
+        check: sum(counts.values()) if isinstance(counts, dict) else counts
+        for check, counts in reference.items()
+    }
+
+
+def is_per_file(reference):
+    return any(isinstance(counts, dict) for counts in reference.values())
 
 
 def emit_checks_as_yaml(results):
     return yaml.dump(results)
 
 
+def emit_checks(results, filename):
+    if filename.endswith(".json"):
+        return json.dumps(results, indent=2, sort_keys=True) + "\n"
+    return emit_checks_as_yaml(results)
+
+
+def index_lines(lines):
+    index = WarningIndex()
+    for line in lines:
+        found = extract_check.search(line)
+        if found:
+            index.add(
+                found["check_name"],
+                found["filename"],
+                found["line_number"],
+                found["column_number"],
+            )
+    return index
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def index_clang_tidy_output(clang_tidy_output, jobs=1):
+    """Index the warnings in clang-tidy's textual output.
+
+    With more than one job the output is parsed in chunks by a process
+    pool.
+
+    """
+    if jobs <= 1:
+        return index_lines(clang_tidy_output)
+    index = WarningIndex()
+    with multiprocessing.Pool(jobs) as pool:
+        for chunk_index in pool.imap_unordered(
+            index_lines, chunks(clang_tidy_output, 20000)
+        ):
+            index.update(chunk_index)
+    return index
+
+
+def index_diagnostics(diagnostics_file):
+    """Index the warnings in a JSON lines diagnostics file written by
+    run-clang-tidy.py -export-diagnostics.
+
+    Only diagnostics that `extract_check` would match in the textual
+    output are counted, so that both inputs yield identical counts.
+
+    """
+    index = WarningIndex()
+    for line in diagnostics_file:
+        if not line.strip():
+            continue
+        diagnostic = json.loads(line)
+        check_name = diagnostic.get("check")
+        if not check_name or not valid_check.match(check_name):
+            continue
+        # extract_check only matches messages without a "[", as the
+        # check name is the first bracketed part of the line.
+        message = diagnostic.get("message") or ""
+        if not message or "[" in message:
+            continue
+        index.add(
+            check_name,
+            diagnostic["file"],
+            str(diagnostic["line"]),
+            str(diagnostic["column"]),
+        )
+    return index
+
+
 def get_check_counts(clang_tidy_output):
     """Return a map from check name to the number of occurrences in
     the given output.
 
     """
+    return index_clang_tidy_output(clang_tidy_output).check_counts()
+
+
+def get_check_counts_from_diagnostics(diagnostics_file):
+    """Return a map from check name to the number of occurrences in
+    a JSON lines diagnostics file written by run-clang-tidy.py
+    -export-diagnostics.
+
+    """
+    return index_diagnostics(diagnostics_file).check_counts()
+
+
+def merge_incremental(reference, results, linted_files):
+    """Combine a per-file reference with results for a subset of files.
+
+    Counts for files which were linted again are taken from the
+    results, all other files keep their reference counts.
+
+    """
+    linted = set(linted_files)
+    for counts in results.values():
+        linted.update(counts)
+    merged = {}
+    for check, counts in reference.items():
+        kept = {f: c for f, c in counts.items() if f not in linted}
+        if kept:
+            merged[check] = kept
+    for check, counts in results.items():
+        merged.setdefault(check, {}).update(counts)
+    return merged
+
+
+def recommend(reference, results, improvements, per_file):
+    """Return the recommended reference contents.
+
+    Improved checks take the result counts, either as a total or as a
+    per-file breakdown, and all other checks keep their reference
+    entry.
+
+    """
+    recommended = {}
+    for check, counts in reference.items():
+        if check not in improvements:
+            if per_file and not isinstance(counts, dict) and check in results:
+                # Unchanged total, so the breakdown can replace it as is
+                recommended[check] = results[check]
+            else:
+                recommended[check] = counts
+        elif check in results:
+            new_counts = results[check]
+            recommended[check] = new_counts if per_file else sum(new_counts.values())
+    return recommended
+
+
+def directory_totals(counts):
+    """Sum per-file counts of all checks by directory."""
     results = {}
-    for line in clang_tidy_output:
-        found = extract_check.search(line)
-        if found:
-            check_name = found["check_name"]
-            # Save a set of tuples identifying where the problem
-            # occurred.  This is intended to prevent situations like
-            # the count of issues going up when someone `#include`s a
-            # known problematic header in a new source file.
-            results[check_name] = results.setdefault(check_name, set()) | set(
-                [(found["filename"], found["line_number"], found["column_number"])]
+    for files in counts.values():
+        if not isinstance(files, dict):
+            continue
+        for filename, count in files.items():
+            directory = os.path.dirname(filename) or "."
+            results[directory] = results.get(directory, 0) + count
+    return results
+
+
+def render_directory_deltas(results, reference):
+    before = directory_totals(reference)
+    after = directory_totals(results)
+    lines = []
+    for directory in sorted(set(before) | set(after)):
+        if before.get(directory, 0) != after.get(directory, 0):
+            lines.append(
+                f"  {directory}:\t{before.get(directory, 0)}  -->  {after.get(directory, 0)}"
             )
-
-    return {check: len(locations) for check, locations in results.items()}
+    return "\n".join(lines)
 
 
 def compare(results, reference):
@@ -85,14 +299,16 @@ def render_delta(delta):
 HEADER = "\n  == cmake/scripts/clang_tidy_ratchet.py ==\n"
 
 
-def display_comparison(comparison_results, reference_filename):
+def display_comparison(comparison_results, reference_filename, recommended=None):
     """Displays the comparison results for human consumption.
 
     Returns a positive number if changes are required (ratchet check
     failure) or 0 if all is well.
 
     """
-    violations, improvements, recommended = comparison_results
+    violations, improvements, recommended_totals = comparison_results
+    if recommended is None:
+        recommended = recommended_totals
 
     if violations:
         print(HEADER)
@@ -124,6 +340,11 @@ reported as errors.  If no errors have occurred, counts that have
 decreased are reported as improvements to be applied to the reference
 file and code-reviewed.
 
+The reference may list a per-file breakdown for each check instead of
+a total count.  Totals are still what is compared, but such a reference
+can be updated for just the files which were linted again
+(--linted_files) and changes can be reported by directory.
+
 """
 
 
@@ -139,17 +360,100 @@ def main():
         type=argparse.FileType("r"),
         help="Path to yaml reference warning counts",
     )
-    parser.add_argument(
+    inputs = parser.add_mutually_exclusive_group()
+    inputs.add_argument(
         "--clang_tidy_output",
         default="-",
         type=argparse.FileType("r"),
         help="Path to clang-tidy warning output",
     )
+    inputs.add_argument(
+        "--diagnostics",
+        type=argparse.FileType("r"),
+        help="Path to a JSON lines diagnostics file written by "
+        "run-clang-tidy.py -export-diagnostics, used instead of the "
+        "clang-tidy warning output",
+    )
+    parser.add_argument(
+        "--root",
+        default=os.getcwd(),
+        help="Files below this directory are recorded relative to it in "
+        "per-file references (default: the current directory)",
+    )
+    parser.add_argument(
+        "--per_file",
+        action="store_true",
+        help="Recommend a reference with a per-file breakdown of each "
+        "check, even if the current reference only has totals",
+    )
+    parser.add_argument(
+        "--linted_files",
+        type=argparse.FileType("r"),
+        help="Path to a list of the files which were linted, one per "
+        "line. Only the counts of these files are compared and updated, "
+        "all other files keep their counts from the per-file reference",
+    )
+    parser.add_argument(
+        "--update_reference",
+        metavar="PATH",
+        help="Write the recommended reference to this path, as JSON if "
+        "it ends in .json and YAML otherwise, instead of asking for it to "
+        "be updated by hand",
+    )
+    parser.add_argument(
+        "--per_directory",
+        action="store_true",
+        help="Report how the counts in the per-file reference changed by "
+        "directory",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes parsing the clang-tidy warning output",
+    )
     args = parser.parse_args()
+    root = os.path.abspath(args.root)
     reference = load_count_reference(args.reference)
-    results = get_check_counts(args.clang_tidy_output)
-    comparison = compare(results, reference)
-    sys.exit(display_comparison(comparison, args.reference.name))
+    if args.diagnostics:
+        index = index_diagnostics(args.diagnostics)
+    else:
+        index = index_clang_tidy_output(args.clang_tidy_output, args.jobs)
+    results = index.file_counts(root)
+
+    if args.linted_files:
+        if any(not isinstance(counts, dict) for counts in reference.values()):
+            parser.error("--linted_files requires a per-file reference for every check")
+        linted_files = [
+            relative_path(os.path.abspath(line.strip()), root)
+            for line in args.linted_files
+            if line.strip()
+        ]
+        results = merge_incremental(reference, results, linted_files)
+
+    comparison = compare(reference_totals(results), reference_totals(reference))
+    recommended = recommend(
+        reference, results, comparison[1], args.per_file or is_per_file(reference)
+    )
+
+    if args.per_directory:
+        deltas = render_directory_deltas(results, reference)
+        if deltas:
+            print("\nclang-tidy warnings by directory:\n")
+            print(deltas)
+
+    if args.update_reference and not comparison[0] and recommended != reference:
+        with open(args.update_reference, "w") as f:
+            f.write(emit_checks(recommended, args.update_reference))
+        print(HEADER)
+        if comparison[1]:
+            print("CONGRATULATIONS: you have reduced the number of clang-tidy warnings:\n")
+            print(render_delta(comparison[1]))
+        print(f"\nThe reference file '{args.update_reference}' has been updated.")
+        sys.exit(0)
+
+    sys.exit(display_comparison(comparison, args.reference.name, recommended))
 
 
 if __name__ == "__main__":
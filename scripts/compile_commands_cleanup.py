@@ -3,25 +3,256 @@
 #
 # Application will allow users to strip away source files from the compile_commands.json file.
 #
+# The database is parsed one entry at a time instead of being loaded as a
+# whole. Entries can be filtered with include/exclude globs and regular
+# expressions matched against the absolute path of the source file, duplicate
+# entries for the same (file, directory, output) are dropped and "command"
+# strings are split into "arguments" lists. Duplicates are found with a set of
+# 20 byte digests, one per entry kept, so memory use still grows with the
+# number of entries, but much slower than with the whole database in memory.
+# --remove-third-party drops the entries whose "file" contains third_party,
+# like it always did.
+#
+# The result is written compactly, one entry per line, to a temporary file
+# which only replaces the database if its content changed. Tools watching the
+# database (clangd, run-clang-tidy.py) therefore don't see a new mtime when
+# re-running the cleanup is a no-op.
+#
 
 import argparse
+import fnmatch
+import hashlib
 import json
+import os
+import re
+import shlex
 import sys
+import tempfile
+
+CHUNK_SIZE = 1 << 20
+
+
+def iter_entries(file, chunk_size=CHUNK_SIZE):
+    """Yields the entries of a JSON array read incrementally from a file."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = file.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def skip_whitespace():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            fill()
+
+    skip_whitespace()
+    if position >= len(buffer) or buffer[position] != "[":
+        raise ValueError("compilation database is not a JSON array")
+    position += 1
+    expect_separator = False
+    while True:
+        skip_whitespace()
+        if position >= len(buffer):
+            raise ValueError("unexpected end of compilation database")
+        if buffer[position] == "]":
+            return
+        if expect_separator:
+            if buffer[position] != ",":
+                raise ValueError(f"expected ',' at offset {position} of the current chunk")
+            position += 1
+            skip_whitespace()
+        while True:
+            try:
+                entry, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            # A number at the end of the buffer may be cut short, only trust
+            # it once more data or the end of the file follows.
+            if end == len(buffer) and not eof:
+                fill()
+                continue
+            break
+        position = end
+        expect_separator = True
+        yield entry
+
+
+def get_arguments(entry):
+    if "arguments" in entry:
+        return entry["arguments"]
+    return shlex.split(entry["command"])
+
+
+def get_output(entry, arguments):
+    if "output" in entry:
+        return entry["output"]
+    for index, argument in enumerate(arguments):
+        if argument == "-o" and index + 1 < len(arguments):
+            return arguments[index + 1]
+        if argument.startswith("-o") and len(argument) > 2:
+            return argument[2:]
+    return None
+
+
+def normalize(entry):
+    """Returns the entry with its command split into an arguments list."""
+    if "command" not in entry:
+        return entry
+    result = {}
+    for key, value in entry.items():
+        if key == "command":
+            result["arguments"] = shlex.split(value)
+        else:
+            result[key] = value
+    return result
+
+
+class EntryFilter:
+    def __init__(self, include_globs, exclude_globs, include_regexes, exclude_regexes, remove_third_party=False):
+        self.remove_third_party = remove_third_party
+        self.include_globs = include_globs
+        self.exclude_globs = exclude_globs
+        self.include_regexes = [re.compile(regex) for regex in include_regexes]
+        self.exclude_regexes = [re.compile(regex) for regex in exclude_regexes]
+
+    def matches(self, entry, path):
+        # Only the "file" field is checked, a build directory in a path
+        # containing third_party does not make every entry third party.
+        if self.remove_third_party and "third_party" in entry["file"]:
+            return False
+        if self.include_globs or self.include_regexes:
+            if not any(fnmatch.fnmatchcase(path, glob) for glob in self.include_globs) and not any(
+                regex.search(path) for regex in self.include_regexes
+            ):
+                return False
+        if any(fnmatch.fnmatchcase(path, glob) for glob in self.exclude_globs):
+            return False
+        if any(regex.search(path) for regex in self.exclude_regexes):
+            return False
+        return True
+
+
+def transform(entries, entry_filter, deduplicate=True, normalize_commands=True):
+    """Yields the entries passing the filter, deduplicated and normalized."""
+    seen = set()
+    for entry in entries:
+        path = os.path.normpath(os.path.join(entry["directory"], entry["file"]))
+        if not entry_filter.matches(entry, path):
+            continue
+        if deduplicate:
+            output = get_output(entry, get_arguments(entry))
+            key = hashlib.sha1(json.dumps([path, entry["directory"], output]).encode("utf-8")).digest()
+            if key in seen:
+                continue
+            seen.add(key)
+        yield normalize(entry) if normalize_commands else entry
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    try:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.digest()
+
+
+def write_database(entries, path):
+    """Writes the entries to path, returns whether the file was changed.
+
+    The database is written to a temporary file next to the target which only
+    replaces it if the content differs, so an unchanged database keeps its
+    mtime.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, prefix=".compile_commands.", suffix=".tmp")
+    digest = hashlib.sha1()
+    try:
+        with os.fdopen(descriptor, "w") as file:
+
+            def write(text):
+                file.write(text)
+                digest.update(text.encode("utf-8"))
+
+            write("[")
+            separator = "\n"
+            for entry in entries:
+                write(separator)
+                write(json.dumps(entry, separators=(",", ":")))
+                separator = ",\n"
+            write("\n]\n")
+        if digest.digest() == file_digest(path):
+            os.remove(tmp_path)
+            return False
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+        return True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 
-parser = argparse.ArgumentParser(description="Modifies a compile_commands.json file", allow_abbrev=False)
-parser.add_argument("file", type=str, help="path to the compile_commands.json file")
-parser.add_argument("--remove-third-party", action="store_true", help="removes all third party files")
-arguments = parser.parse_args()
+def main():
+    parser = argparse.ArgumentParser(description="Modifies a compile_commands.json file", allow_abbrev=False)
+    parser.add_argument("file", type=str, help="path to the compile_commands.json file")
+    parser.add_argument("--output", type=str, help="write the result here instead of modifying the file in place")
+    parser.add_argument("--remove-third-party", action="store_true", help="removes all third party files")
+    parser.add_argument(
+        "--include", action="append", default=[], metavar="GLOB", help="only keep files matching the glob"
+    )
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB", help="remove files matching the glob")
+    parser.add_argument(
+        "--include-regex", action="append", default=[], metavar="REGEX", help="only keep files matching the regex"
+    )
+    parser.add_argument(
+        "--exclude-regex", action="append", default=[], metavar="REGEX", help="remove files matching the regex"
+    )
+    parser.add_argument(
+        "--keep-duplicates", action="store_true", help="keep entries with the same file, directory and output"
+    )
+    parser.add_argument("--keep-command", action="store_true", help="don't split commands into argument lists")
+    arguments = parser.parse_args()
 
-try:
-    with open(arguments.file, "r") as file:
-        data = json.load(file)
+    try:
+        entry_filter = EntryFilter(
+            arguments.include,
+            arguments.exclude,
+            arguments.include_regex,
+            arguments.exclude_regex,
+            remove_third_party=arguments.remove_third_party,
+        )
+        with open(arguments.file, "r") as file:
+            entries = transform(
+                iter_entries(file),
+                entry_filter,
+                deduplicate=not arguments.keep_duplicates,
+                normalize_commands=not arguments.keep_command,
+            )
+            write_database(entries, arguments.output or arguments.file)
+    except BaseException as e:
+        print(e, file=sys.stderr)
+        exit(1)
 
-    if arguments.remove_third_party:
-        data = [x for x in data if "third_party" not in x["file"]]
 
-    with open(arguments.file, "w") as file:
-        json.dump(data, file, indent=4)
-except BaseException as e:
-    print(e, file=sys.stderr)
-    exit(1)
+if __name__ == "__main__":
+    main()
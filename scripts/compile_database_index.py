@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+#
+# Indexes a compile_commands.json file so that tools can look up single files
+# without parsing the whole database.
+#
+# The index is an SQLite database next to compile_commands.json, keyed by the
+# absolute path of every source file, with a second table mapping each header
+# to the translation units which (transitively) include it. Lookups by file,
+# by header and by path prefix are B-tree lookups. The index records the
+# mtime, size and SHA-1 of the database it was built from and is rebuilt
+# transparently when the database changes.
+#
+# This is a standalone tool for scripts and editors which need single lookups;
+# run-clang-tidy.py processes whole databases and keeps loading them itself.
+#
+# USAGE
+#
+#   compile_database_index.py build [-p build]
+#   compile_database_index.py flags src/foo.cc
+#   compile_database_index.py includes include/foo.h
+#   compile_database_index.py match '^/src/libfoo/.*\.cc$'
+#
+#   from compile_database_index import CompileDatabaseIndex
+#   with CompileDatabaseIndex("build/compile_commands.json") as index:
+#       for entry in index.flags("src/foo.cc"):
+#           print(entry["arguments"])
+#
+# The regex prefix handling is covered by doctests:
+#
+#   python3 -m doctest compile_database_index.py
+#
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import shlex
+import sqlite3
+import sys
+import tempfile
+
+from compile_commands_cleanup import CHUNK_SIZE, get_arguments, get_output, iter_entries
+
+INDEX_VERSION = "1"
+INDEX_SUFFIX = ".index.sqlite"
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE entries (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    arguments TEXT NOT NULL,
+    output TEXT
+);
+CREATE INDEX entries_path ON entries (path);
+CREATE TABLE includes (
+    header TEXT NOT NULL,
+    entry INTEGER NOT NULL,
+    PRIMARY KEY (header, entry)
+) WITHOUT ROWID;
+"""
+
+
+def load_run_clang_tidy():
+    """Imports run-clang-tidy.py, whose file name is not a module name."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run-clang-tidy.py")
+    spec = importlib.util.spec_from_file_location("run_clang_tidy", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def has_alternation(regex):
+    """Checks for an unescaped | outside of character classes."""
+    index = 0
+    in_class = False
+    while index < len(regex):
+        char = regex[index]
+        if char == "\\":
+            index += 2
+            continue
+        if in_class:
+            # A ] right after [ or [^ is part of the class.
+            if char == "]" and regex[index - 1] != "[" and regex[index - 2 : index] != "[^":
+                in_class = False
+        elif char == "[":
+            in_class = True
+        elif char == "|":
+            return True
+        index += 1
+    return False
+
+
+def literal_prefix(regex):
+    """Returns the literal text an anchored regex has to start with.
+
+    Any alternation may let a match start differently, so there is no prefix
+    then.
+
+    >>> literal_prefix(r"^/src/lib\.a/.*\.cc$")
+    '/src/lib.a/'
+    >>> literal_prefix("^/src/fo?")
+    '/src/f'
+    >>> literal_prefix("^a|b")
+    ''
+    >>> literal_prefix("^/src/(a|b)")
+    ''
+    >>> literal_prefix(r"^/src/[|]\|")
+    '/src/'
+    >>> literal_prefix("/src/a")
+    ''
+    """
+    if not regex.startswith("^") or has_alternation(regex):
+        return ""
+    prefix = ""
+    index = 1
+    while index < len(regex):
+        char = regex[index]
+        if char == "\\" and index + 1 < len(regex) and not regex[index + 1].isalnum():
+            prefix += regex[index + 1]
+            index += 2
+            continue
+        if char in ".^$*+?{}[]()|\\":
+            # A quantifier makes the preceding character optional.
+            if char in "*?{" and prefix:
+                prefix = prefix[:-1]
+            break
+        prefix += char
+        index += 1
+    return prefix
+
+
+class CompileDatabaseIndex:
+    """Read access to a compilation database through its SQLite index."""
+
+    def __init__(self, database, index=None, scan_includes=True):
+        self.database = os.path.abspath(database)
+        self.index = index or self.database + INDEX_SUFFIX
+        self.scan_includes = scan_includes
+        self.connection = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        """Opens the index, building it first if it is missing or stale."""
+        if self.connection is None:
+            if not self.is_fresh():
+                self.build()
+            self.connection = sqlite3.connect(self.index)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def read_meta(self):
+        if not os.path.isfile(self.index):
+            return None
+        try:
+            connection = sqlite3.connect(self.index)
+            try:
+                return dict(connection.execute("SELECT key, value FROM meta"))
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            return None
+
+    def is_fresh(self):
+        """Checks whether the index matches the current database.
+
+        The mtime and size are checked first. If they changed, the content
+        hash decides, so that a database rewritten with the same content
+        only updates the recorded mtime instead of triggering a rebuild.
+        """
+        meta = self.read_meta()
+        if meta is None or meta.get("version") != INDEX_VERSION or meta.get("database") != self.database:
+            return False
+        if meta.get("includes") != str(int(self.scan_includes)) and self.scan_includes:
+            return False
+        stat = os.stat(self.database)
+        if meta.get("mtime_ns") == str(stat.st_mtime_ns) and meta.get("size") == str(stat.st_size):
+            return True
+        if meta.get("sha1") != file_digest(self.database):
+            return False
+        connection = sqlite3.connect(self.index)
+        try:
+            with connection:
+                connection.executemany(
+                    "UPDATE meta SET value = ? WHERE key = ?",
+                    [(str(stat.st_mtime_ns), "mtime_ns"), (str(stat.st_size), "size")],
+                )
+        finally:
+            connection.close()
+        return True
+
+    def build(self):
+        """Builds the index into a temporary file and moves it into place."""
+        stat = os.stat(self.database)
+        sha1 = file_digest(self.database)
+        scanner = load_run_clang_tidy().IncludeScanner() if self.scan_includes else None
+        descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.index), suffix=".tmp")
+        os.close(descriptor)
+        try:
+            connection = sqlite3.connect(tmp_path)
+            try:
+                connection.executescript(SCHEMA)
+                with open(self.database, "r") as file:
+                    for entry in iter_entries(file):
+                        directory = entry["directory"]
+                        path = os.path.normpath(os.path.join(directory, entry["file"]))
+                        arguments = get_arguments(entry)
+                        cursor = connection.execute(
+                            "INSERT INTO entries (path, directory, arguments, output) VALUES (?, ?, ?, ?)",
+                            (path, directory, json.dumps(arguments), get_output(entry, arguments)),
+                        )
+                        if scanner is not None:
+                            connection.executemany(
+                                "INSERT OR IGNORE INTO includes (header, entry) VALUES (?, ?)",
+                                ((header, cursor.lastrowid) for header in scanner.get_includes(entry, path)),
+                            )
+                connection.executemany(
+                    "INSERT INTO meta (key, value) VALUES (?, ?)",
+                    [
+                        ("version", INDEX_VERSION),
+                        ("database", self.database),
+                        ("mtime_ns", str(stat.st_mtime_ns)),
+                        ("size", str(stat.st_size)),
+                        ("sha1", sha1),
+                        ("includes", str(int(self.scan_includes))),
+                    ],
+                )
+                connection.commit()
+            finally:
+                connection.close()
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.index)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def flags(self, path):
+        """Returns the entries compiling a source file."""
+        rows = self.open().execute(
+            "SELECT path, directory, arguments, output FROM entries WHERE path = ? ORDER BY id",
+            (os.path.abspath(path),),
+        )
+        return [
+            {"file": file, "directory": directory, "arguments": json.loads(arguments), "output": output}
+            for file, directory, arguments, output in rows
+        ]
+
+    def including(self, header):
+        """Returns the translation units which include a header."""
+        rows = self.open().execute(
+            "SELECT DISTINCT entries.path FROM includes JOIN entries ON entries.id = includes.entry "
+            "WHERE includes.header = ? ORDER BY entries.path",
+            (os.path.abspath(header),),
+        )
+        return [path for (path,) in rows]
+
+    def matching(self, regex):
+        """Returns the source files whose absolute path matches a regex.
+
+        The literal prefix of an anchored regex narrows the search to a
+        range of the path index, other regexes are matched against all
+        paths without decoding any compile commands.
+        """
+        compiled = re.compile(regex)
+        prefix = literal_prefix(regex)
+        if prefix:
+            rows = self.open().execute(
+                "SELECT DISTINCT path FROM entries WHERE path >= ? AND path < ? ORDER BY path",
+                (prefix, prefix + "\U0010ffff"),
+            )
+        else:
+            rows = self.open().execute("SELECT DISTINCT path FROM entries ORDER BY path")
+        return [path for (path,) in rows if compiled.search(path)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexed lookups in a compile_commands.json file", allow_abbrev=False)
+    parser.add_argument(
+        "-p",
+        dest="build_path",
+        default=None,
+        help="path to a build directory containing compile_commands.json, found in the parents of the working directory by default",
+    )
+    parser.add_argument("--index", default=None, help="path of the index, next to compile_commands.json by default")
+    parser.add_argument("--no-includes", action="store_true", help="don't scan includes when building the index")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="build the index if it is missing or stale")
+    flags_parser = subparsers.add_parser("flags", help="print the compile commands of a file")
+    flags_parser.add_argument("file")
+    includes_parser = subparsers.add_parser("includes", help="print the translation units including a header")
+    includes_parser.add_argument("header")
+    match_parser = subparsers.add_parser("match", help="print the files whose absolute path matches a regex")
+    match_parser.add_argument("regex")
+    arguments = parser.parse_args()
+
+    if arguments.build_path is not None:
+        database = os.path.join(arguments.build_path, "compile_commands.json")
+    else:
+        build_path = load_run_clang_tidy().find_compilation_database("compile_commands.json")
+        database = os.path.join(build_path, "compile_commands.json")
+    if not os.path.isfile(database):
+        print("Error: could not find compilation database.", file=sys.stderr)
+        sys.exit(1)
+
+    with CompileDatabaseIndex(database, arguments.index, scan_includes=not arguments.no_includes) as index:
+        if arguments.command == "build":
+            result = None
+        elif arguments.command == "flags":
+            result = index.flags(arguments.file)
+            if not result:
+                print(f"Error: {arguments.file} is not in the compilation database.", file=sys.stderr)
+                sys.exit(1)
+        elif arguments.command == "includes":
+            result = index.including(arguments.header)
+        else:
+            result = index.matching(arguments.regex)
+
+    if result is None:
+        return
+    if arguments.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    elif arguments.command == "flags":
+        for entry in result:
+            print(" ".join(shlex.quote(argument) for argument in entry["arguments"]))
+    else:
+        for path in result:
+            print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+#
+
+"""
+Merges the llvm coverage data of the ccov-all targets and renders its reports.
+
+The work is split into three steps, used by CodeCoverage.cmake:
+
+merge
+  Merges the .profraw files listed in profraw.list into a single .profdata
+  file. Every .profraw file is first converted on its own, then the results
+  are merged in groups of --fan-in files, level by level, with the merges of
+  a level running in parallel. Every intermediate .profdata file is kept in
+  the cache directory under a hash of its inputs, so when only some test
+  binaries produced new data, only their files and the merges above them in
+  the tree are redone.
+
+export
+  Runs llvm-cov export once over all binaries listed in binaries.list and
+  writes the JSON export. The export is skipped if the merged profile, the
+  binaries (by size and mtime) and the options did not change since the
+  last one.
+
+render
+  Renders the HTML, text and summary reports from the JSON export, without
+  running llvm-cov again. The summary has the columns of llvm-cov report,
+  line counts are derived from the region segments the way llvm-cov show
+  derives them. Source files are rendered in parallel.
+
+USAGE
+
+  coverage_report.py merge --profraw-list ccov/profraw.list -o ccov/all-merged.profdata --cache-dir ccov/cache
+  coverage_report.py export --binaries-list ccov/binaries.list --profdata ccov/all-merged.profdata -o ccov/coverage.json
+  coverage_report.py render --export ccov/coverage.json --html ccov/all-merged --text ccov/coverage.txt --summary
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import html
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+CHUNK_SIZE = 1 << 20
+CACHE_VERSION = "1"
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def key_digest(*parts):
+    return hashlib.sha1("\0".join([CACHE_VERSION] + list(parts)).encode("utf-8")).hexdigest()
+
+
+def read_list(path):
+    """Returns the unique entries of a list file, one per line, in order."""
+    entries = []
+    seen = set()
+    with open(path, "r") as f:
+        for line in f:
+            entry = line.strip()
+            if entry and entry not in seen:
+                seen.add(entry)
+                entries.append(entry)
+    return entries
+
+
+def replace_with_copy(source, destination):
+    directory = os.path.dirname(os.path.abspath(destination))
+    os.makedirs(directory, exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(descriptor)
+    try:
+        shutil.copyfile(source, tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, destination)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ProfileMerger:
+    """Merges profiles as a tree reduction cached by the hash of its inputs."""
+
+    def __init__(self, llvm_profdata, cache_dir, fan_in, jobs):
+        self.llvm_profdata = llvm_profdata
+        self.cache_dir = cache_dir
+        self.fan_in = max(2, fan_in)
+        self.jobs = max(1, jobs)
+        self.used = set()
+        self.merged = 0
+        self.cached = 0
+
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, key + ".profdata")
+
+    def run_merge(self, key, inputs):
+        """Merges the inputs into the cache entry of key, unless it exists.
+
+        Returns whether the entry was taken from the cache.
+        """
+        path = self.cache_path(key)
+        if os.path.exists(path):
+            return True
+        # A unique temporary file, so that concurrent runs sharing the cache
+        # don't write to the same file, and no partial file is left behind.
+        descriptor, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(descriptor)
+        try:
+            # The merges already run in parallel, each one uses a single thread
+            # instead of one per core.
+            subprocess.check_call([self.llvm_profdata, "merge", "-sparse", "-num-threads=1", "-o", tmp_path] + inputs)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return False
+
+    def run_level(self, executor, keys, inputs):
+        """Runs the merges of one level of the tree, returns their outputs."""
+        # Identical inputs give identical keys, which are only merged once.
+        jobs = dict(zip(keys, inputs))
+        for cached in executor.map(self.run_merge, jobs.keys(), jobs.values()):
+            if cached:
+                self.cached += 1
+            else:
+                self.merged += 1
+        paths = [self.cache_path(key) for key in keys]
+        self.used.update(paths)
+        return paths
+
+    def merge(self, profraw_files, output):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            # Sorted leaves keep the shape of the tree stable between runs.
+            leaves = sorted(profraw_files)
+            keys = [key_digest("leaf", self.llvm_profdata, file_digest(path)) for path in leaves]
+            paths = self.run_level(executor, keys, [[path] for path in leaves])
+            while len(keys) > 1:
+                groups = range(0, len(keys), self.fan_in)
+                next_keys = [key_digest("node", *keys[i : i + self.fan_in]) for i in groups]
+                paths = self.run_level(executor, next_keys, [paths[i : i + self.fan_in] for i in groups])
+                keys = next_keys
+        replace_with_copy(paths[0], output)
+
+    def prune(self):
+        """Removes the cache entries which were not part of this merge."""
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".profdata") and path not in self.used:
+                os.remove(path)
+
+
+def merge_command(args):
+    profraw_files = []
+    for path in read_list(args.profraw_list):
+        if os.path.isfile(path):
+            profraw_files.append(path)
+        else:
+            print("Warning: {} does not exist, skipping it".format(path), file=sys.stderr)
+    if not profraw_files:
+        print("Error: no profraw files to merge", file=sys.stderr)
+        sys.exit(1)
+    cache_dir = args.cache_dir or os.path.join(os.path.dirname(os.path.abspath(args.output)), "profdata-cache")
+    merger = ProfileMerger(args.llvm_profdata, cache_dir, args.fan_in, args.jobs)
+    merger.merge(profraw_files, args.output)
+    merger.prune()
+    print(
+        "Merged {} profiles into {} ({} merges, {} cached)".format(
+            len(profraw_files), args.output, merger.merged, merger.cached
+        )
+    )
+
+
+def export_key(args, objects):
+    parts = ["export", args.llvm_cov, file_digest(args.profdata)] + args.ignore_filename_regex
+    for obj in objects:
+        path = obj[len("-object=") :] if obj.startswith("-object=") else obj
+        stat = os.stat(path)
+        parts.extend([obj, str(stat.st_size), str(stat.st_mtime_ns)])
+    return key_digest(*parts)
+
+
+def export_command(args):
+    objects = read_list(args.binaries_list)
+    if not objects:
+        print("Error: no binaries to export coverage for", file=sys.stderr)
+        sys.exit(1)
+    key = export_key(args, objects)
+    key_path = args.output + ".key"
+    if os.path.exists(args.output) and os.path.exists(key_path):
+        with open(key_path, "r") as f:
+            if f.read().strip() == key:
+                print("{} is up to date".format(args.output))
+                return
+
+    command = [args.llvm_cov, "export", "-format=text", "-instr-profile=" + args.profdata]
+    command += ["-ignore-filename-regex=" + regex for regex in args.ignore_filename_regex]
+    command += objects
+    directory = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(directory, exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w") as f:
+            subprocess.check_call(command, stdout=f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, args.output)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    with open(key_path, "w") as f:
+        f.write(key + "\n")
+
+
+def is_region_start(segment):
+    # [line, column, count, has count, is region entry, is gap region], the
+    # gap flag is missing in exports of older llvm-cov versions.
+    return segment[3] and segment[4] and not (len(segment) > 5 and segment[5])
+
+
+def line_counts(segments, num_lines):
+    """Returns the execution count of every line, None for unmapped lines.
+
+    This follows LineCoverageStats of llvm-cov: a line takes the count of the
+    segment wrapping into it, or the highest count of the regions starting
+    on it.
+    """
+    counts = []
+    wrapped = None
+    index = 0
+    for line in range(1, num_lines + 1):
+        start = index
+        while index < len(segments) and segments[index][0] <= line:
+            index += 1
+        line_segments = [segment for segment in segments[start:index] if segment[0] == line]
+        region_starts = [segment[2] for segment in line_segments if is_region_start(segment)]
+        skipped = bool(line_segments) and not line_segments[0][3] and line_segments[0][4]
+        if skipped or not ((wrapped is not None and wrapped[3]) or region_starts):
+            counts.append(None)
+        else:
+            count = wrapped[2] if wrapped is not None else 0
+            counts.append(max([count] + region_starts))
+        if index > start:
+            wrapped = segments[index - 1]
+    return counts
+
+
+def read_source(filename, segments):
+    try:
+        with open(filename, "r", errors="replace") as f:
+            lines = f.read().split("\n")
+        if lines and lines[-1] == "":
+            lines.pop()
+    except IOError:
+        lines = [""] * max([segment[0] for segment in segments] or [0])
+    return lines
+
+
+def format_count(count):
+    """Formats an execution count like llvm-cov does."""
+    if count < 1000:
+        return str(count)
+    for suffix, scale in (("k", 1e3), ("M", 1e6), ("G", 1e9), ("T", 1e12), ("P", 1e15)):
+        if count < scale * 1000:
+            return "{:.2f}{}".format(count / scale, suffix)
+    return "{:.2f}E".format(count / 1e18)
+
+
+def format_percent(summary):
+    if not summary["count"]:
+        return "-"
+    return "{:.2f}%".format(100.0 * summary["covered"] / summary["count"])
+
+
+def render_text_file(file):
+    filename = file["filename"]
+    lines = read_source(filename, file["segments"])
+    counts = line_counts(file["segments"], len(lines))
+    width = len(str(len(lines)))
+    result = [filename + ":"]
+    for number, (line, count) in enumerate(zip(lines, counts), 1):
+        result.append("{:>{}}|{:>7}|{}".format(number, width, "" if count is None else format_count(count), line))
+    return "\n".join(result) + "\n"
+
+
+STYLE = """
+body { font-family: sans-serif; }
+table { border-collapse: collapse; }
+td, th { border: 1px solid #ccc; padding: 2px 6px; }
+td.number { text-align: right; }
+pre { margin: 0; }
+tr.covered td.count { background: #cfc; }
+tr.uncovered td.count, tr.uncovered td.code { background: #fcc; }
+.low { background: #fcc; }
+.medium { background: #ffc; }
+.high { background: #cfc; }
+"""
+
+
+def html_page(title, body):
+    return (
+        "<!doctype html>\n<html><head><meta charset='utf-8'><title>{0}</title>"
+        "<style>{1}</style></head>\n<body><h2>{0}</h2>\n{2}\n</body></html>\n".format(html.escape(title), STYLE, body)
+    )
+
+
+def html_file_path(output_dir, filename):
+    return os.path.join(output_dir, "coverage", filename.lstrip(os.sep) + ".html")
+
+
+def render_html_file(job):
+    file, output_dir = job
+    filename = file["filename"]
+    lines = read_source(filename, file["segments"])
+    counts = line_counts(file["segments"], len(lines))
+    rows = []
+    for number, (line, count) in enumerate(zip(lines, counts), 1):
+        if count is None:
+            css, text = "", ""
+        else:
+            css, text = "covered" if count else "uncovered", format_count(count)
+        rows.append(
+            "<tr class='{}'><td class='number'>{}</td><td class='number count'>{}</td>"
+            "<td class='code'><pre>{}</pre></td></tr>".format(css, number, text, html.escape(line))
+        )
+    path = html_file_path(output_dir, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(html_page(filename, "<table>\n" + "\n".join(rows) + "\n</table>"))
+
+
+SUMMARY_COLUMNS = [
+    ("regions", "Regions"),
+    ("functions", "Functions"),
+    ("lines", "Lines"),
+    ("branches", "Branches"),
+]
+
+
+def summary_cells(summary):
+    cells = []
+    for key, _ in SUMMARY_COLUMNS:
+        entry = summary.get(key, {"count": 0, "covered": 0})
+        cells.extend([entry["count"], entry["count"] - entry["covered"], format_percent(entry)])
+    return cells
+
+
+def summary_header():
+    header = ["Filename"]
+    for key, title in SUMMARY_COLUMNS:
+        if key == "functions":
+            header.extend(["Functions", "Missed Functions", "Executed"])
+        else:
+            header.extend([title, "Missed " + title, "Cover"])
+    return header
+
+
+def common_prefix(filenames):
+    if len(filenames) < 2:
+        return os.path.dirname(filenames[0]) + os.sep if filenames else ""
+    prefix = os.path.commonpath(filenames)
+    return prefix + os.sep if prefix not in ("", os.sep) else prefix
+
+
+def render_summary(export, out):
+    """Prints a table with the columns of llvm-cov report."""
+    files = sorted(export["files"], key=lambda file: file["filename"])
+    prefix = common_prefix([file["filename"] for file in files])
+    rows = [summary_header()]
+    for file in files:
+        rows.append([file["filename"][len(prefix) :]] + summary_cells(file["summary"]))
+    total = ["TOTAL"] + summary_cells(export["totals"])
+    widths = [max(len(str(row[column])) for row in rows + [total]) for column in range(len(total))]
+
+    def format_row(row):
+        cells = [str(row[0]).ljust(widths[0])]
+        cells += [str(cell).rjust(width) for cell, width in zip(row[1:], widths[1:])]
+        return "   ".join(cells).rstrip()
+
+    separator = "-" * len(format_row(rows[0]))
+    print(format_row(rows[0]), file=out)
+    print(separator, file=out)
+    for row in rows[1:]:
+        print(format_row(row), file=out)
+    print(separator, file=out)
+    print(format_row(total), file=out)
+
+
+def render_html_index(export, output_dir):
+    files = sorted(export["files"], key=lambda file: file["filename"])
+    prefix = common_prefix([file["filename"] for file in files])
+
+    def cells(summary):
+        result = []
+        for key, _ in SUMMARY_COLUMNS:
+            entry = summary.get(key, {"count": 0, "covered": 0})
+            percent = 100.0 * entry["covered"] / entry["count"] if entry["count"] else 100.0
+            css = "low" if percent < 50 else "medium" if percent < 80 else "high"
+            result.append(
+                "<td class='number {}'>{} ({}/{})</td>".format(
+                    css, format_percent(entry), entry["covered"], entry["count"]
+                )
+            )
+        return "".join(result)
+
+    rows = ["<tr><th>Filename</th>" + "".join("<th>{}</th>".format(title) for _, title in SUMMARY_COLUMNS) + "</tr>"]
+    for file in files:
+        link = os.path.relpath(html_file_path(output_dir, file["filename"]), output_dir)
+        rows.append(
+            "<tr><td><a href='{}'>{}</a></td>{}</tr>".format(
+                html.escape(link), html.escape(file["filename"][len(prefix) :]), cells(file["summary"])
+            )
+        )
+    rows.append("<tr><td>Totals</td>{}</tr>".format(cells(export["totals"])))
+    with open(os.path.join(output_dir, "index.html"), "w") as f:
+        f.write(html_page("Coverage Report", "<table>\n" + "\n".join(rows) + "\n</table>"))
+
+
+def merge_exports(data):
+    """Combines the entries of an export into one, summing the totals."""
+    if len(data) == 1:
+        return data[0]
+    export = {"files": [], "totals": {}}
+    for entry in data:
+        export["files"].extend(entry["files"])
+        for key, summary in entry["totals"].items():
+            total = export["totals"].setdefault(key, {"count": 0, "covered": 0})
+            total["count"] += summary["count"]
+            total["covered"] += summary["covered"]
+    return export
+
+
+def render_command(args):
+    with open(args.export, "r") as f:
+        export = merge_exports(json.load(f)["data"])
+
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 and len(export["files"]) > 1 else None
+    try:
+        map_function = pool.imap if pool is not None else map
+        if args.html:
+            os.makedirs(args.html, exist_ok=True)
+            for _ in map_function(render_html_file, [(file, args.html) for file in export["files"]]):
+                pass
+            render_html_index(export, args.html)
+        if args.text:
+            with open(args.text, "w") as f:
+                files = sorted(export["files"], key=lambda file: file["filename"])
+                for index, text in enumerate(map_function(render_text_file, files)):
+                    if index:
+                        f.write("\n")
+                    f.write(text)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if args.summary == "-":
+        render_summary(export, sys.stdout)
+    elif args.summary:
+        with open(args.summary, "w") as f:
+            render_summary(export, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge llvm coverage data and render reports from a single export.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    jobs = os.cpu_count() or 1
+
+    merge_parser = subparsers.add_parser("merge", help="merge profraw files into a profdata file")
+    merge_parser.add_argument("--profraw-list", required=True, help="file listing the profraw files, one per line")
+    merge_parser.add_argument("-o", "--output", required=True, help="merged profdata file")
+    merge_parser.add_argument("--cache-dir", help="directory of cached profdata files, next to the output by default")
+    merge_parser.add_argument("--fan-in", type=int, default=8, help="number of profiles merged by each merge")
+    merge_parser.add_argument("-j", "--jobs", type=int, default=jobs, help="number of parallel merges")
+    merge_parser.add_argument("--llvm-profdata", default="llvm-profdata", help="path to llvm-profdata")
+    merge_parser.set_defaults(function=merge_command)
+
+    export_parser = subparsers.add_parser("export", help="export the coverage of all binaries to JSON")
+    export_parser.add_argument("--binaries-list", required=True, help="file listing -object=<binary> arguments")
+    export_parser.add_argument("--profdata", required=True, help="merged profdata file")
+    export_parser.add_argument("-o", "--output", required=True, help="JSON export")
+    export_parser.add_argument(
+        "--ignore-filename-regex", action="append", default=[], help="skip source files matching the regex"
+    )
+    export_parser.add_argument("--llvm-cov", default="llvm-cov", help="path to llvm-cov")
+    export_parser.set_defaults(function=export_command)
+
+    render_parser = subparsers.add_parser("render", help="render reports from a JSON export")
+    render_parser.add_argument("--export", required=True, help="JSON export")
+    render_parser.add_argument("--html", metavar="DIR", help="write the HTML report to this directory")
+    render_parser.add_argument("--text", metavar="FILE", help="write the line counts of all files to this file")
+    render_parser.add_argument(
+        "--summary", nargs="?", const="-", metavar="FILE", help="print the per-file summary, to a file if given"
+    )
+    render_parser.add_argument("-j", "--jobs", type=int, default=jobs, help="number of processes rendering files")
+    render_parser.set_defaults(function=render_command)
+
+    args = parser.parse_args()
+    try:
+        args.function(args)
+    except subprocess.CalledProcessError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,8 +12,16 @@
 # WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
 #
 
+import argparse
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
 import sys
 import re
+import subprocess
+import tempfile
 from pathlib import Path
 from datetime import datetime
 
@@ -74,21 +82,21 @@ def find_ifndef_define(lines):
     return ifndef, ifndef_linenum, define, define_linenum
 
 
-def fix_header_guard(filename):
-    try:
-        with open(filename, "r") as target_file:
-            lines = target_file.read().split("\n")
+def get_fixed_content(filename, content):
+    """Returns the content with its include guard and copyright fixed.
 
-        for linenum in range(len(lines) - 1):
-            if lines[linenum].endswith("\r"):
-                lines[linenum] = lines[linenum].rstrip("\r")
-    except IOError:
-        sys.stderr.write("Error opening {}\n".format(filename))
-        return
+    Also returns the list of problems found, the content is returned
+    unchanged if there are none.
+    """
+    lines = content.split("\n")
+    for linenum in range(len(lines) - 1):
+        if lines[linenum].endswith("\r"):
+            lines[linenum] = lines[linenum].rstrip("\r")
 
     if can_ignore_file(lines):
-        return
+        return content, []
 
+    problems = []
     expected_guard = get_expected_guard(filename)
     ifndef, ifndef_linenum, define, define_linenum = find_ifndef_define(lines)
 
@@ -100,12 +108,14 @@ def fix_header_guard(filename):
     ):
         if ifndef_linenum == -1:
             # file doesn't have an include guard so generate one
+            problems.append("missing include guard {}".format(expected_guard))
             lines.insert(
                 0, "#ifndef %s\n#define %s\n" % (expected_guard, expected_guard)
             )
             lines.append("\n#endif")
         else:
             # need to fix
+            problems.append("include guard should be {}".format(expected_guard))
             lines[ifndef_linenum] = "#ifndef " + expected_guard
             lines[define_linenum] = "#define " + expected_guard
 
@@ -128,15 +138,264 @@ def fix_header_guard(filename):
         if re.search(r"Copyright", lines[line], re.I):
             break
     else:  # means no copyright line was found
+        problems.append("missing copyright notice")
         lines.insert(0, default_copyright)
 
-    with open(filename, "w") as output_file:
-        output_file.write("\n".join(lines))
+    fixed = "\n".join(lines)
+    if fixed != content and not problems:
+        problems.append("line endings should be LF")
+    return fixed, problems
+
+
+def write_atomically(filename, content):
+    """Replaces a file by a temporary file written next to it."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix=".fix_include_guards.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", newline="") as output_file:
+            output_file.write(content)
+        os.chmod(tmp_filename, os.stat(filename).st_mode & 0o7777)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+# Number of bytes read to decide whether a header is fine. Include guards and
+# copyright notices are at the top, larger headers are only scanned for the
+# markers which make them ignored.
+PREFIX_SIZE = 8192
+IGNORE_MARKERS = (b"NOLINT(build/header_guard)", b"#pragma once")
+COPYRIGHT_RE = re.compile(rb"copyright", re.I)
+
+
+def contains_marker(data):
+    return any(marker in data for marker in IGNORE_MARKERS)
+
+
+def is_content_fine(filename, data):
+    """Decides from a bounded prefix whether a header needs no changes.
+
+    data is the content of the header, as bytes or mmap. Returns False if it
+    may need changes, in which case the whole header has to be checked with
+    get_fixed_content. This is a single pass over the first PREFIX_SIZE
+    bytes, the rest of the content is only searched for the ignore markers.
+    """
+    prefix = data[:PREFIX_SIZE]
+    if contains_marker(prefix):
+        return True
+    complete = len(prefix) < PREFIX_SIZE
+    if not complete:
+        # a marker may straddle the end of the prefix
+        start = PREFIX_SIZE - max(len(marker) for marker in IGNORE_MARKERS)
+        if any(data.find(marker, start) != -1 for marker in IGNORE_MARKERS):
+            return True
+        if data.find(b"\r\n", start) != -1:
+            return False
+        # only complete lines of the prefix are looked at
+        prefix = prefix[: prefix.rfind(b"\n") + 1]
+
+    if b"\r\n" in prefix:
+        return False
+    expected_guard = get_expected_guard(filename).encode()
+    ifndef = define = None
+    for linenum, line in enumerate(prefix.split(b"\n")):
+        if ifndef is None and line.startswith(b"#ifndef "):
+            ifndef = line.split(maxsplit=1)[1:]
+        elif define is None and line.startswith(b"#define "):
+            define = line.split(maxsplit=1)[1:]
+        if 1 <= linenum <= 10 and COPYRIGHT_RE.search(line):
+            copyright_found = True
+        elif linenum == 0:
+            copyright_found = False
+        if linenum >= 10 and ifndef is not None and define is not None:
+            break
+    else:
+        if not complete:
+            return False
+    return ifndef == [expected_guard] and define == [expected_guard] and copyright_found
+
+
+def is_header_fine(filename):
+    """Like is_content_fine for a header file.
+
+    Small headers are read at once, larger ones are mapped into memory so
+    that only their prefix is copied.
+    """
+    with open(filename, "rb") as f:
+        prefix = f.read(PREFIX_SIZE)
+        if len(prefix) < PREFIX_SIZE:
+            return is_content_fine(filename, prefix)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return is_content_fine(filename, data)
+
+
+def fix_header_guard(filename, check=False):
+    """Checks one header, fixing it in place unless check is set.
+
+    Returns the list of problems found, None if the file can't be read. A
+    file is only written if its content changes.
+    """
+    try:
+        if is_header_fine(filename):
+            return []
+    except (IOError, ValueError):
+        pass
+
+    try:
+        with open(filename, "r", newline="") as target_file:
+            content = target_file.read()
+    except IOError:
+        sys.stderr.write("Error opening {}\n".format(filename))
+        return None
+
+    fixed, problems = get_fixed_content(filename, content)
+    if fixed != content and not check:
+        write_atomically(filename, fixed)
+    return problems
+
+
+def check_header(job):
+    filename, check = job
+    return filename, fix_header_guard(filename, check)
+
+
+def git_blob_hash(content):
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def get_blob_hashes(filenames):
+    """Returns the git blob hash of every file, without reading unchanged ones.
+
+    Files which are unmodified in git take their hash from the index, other
+    files are hashed the way git hash-object does.
+    """
+    hashes = {}
+    try:
+        staged = subprocess.run(
+            ["git", "ls-files", "-s", "-z"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+        ).stdout
+        modified = subprocess.run(
+            ["git", "diff", "--name-only", "--relative", "-z"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        staged, modified = b"", b""
+    index = {}
+    for entry in staged.split(b"\0"):
+        if entry:
+            info, path = entry.split(b"\t", 1)
+            index[os.path.normpath(os.fsdecode(path))] = info.split()[1].decode()
+    modified = set(os.path.normpath(os.fsdecode(path)) for path in modified.split(b"\0") if path)
+
+    for filename in filenames:
+        path = os.path.normpath(filename)
+        if path in index and path not in modified:
+            hashes[filename] = index[path]
+            continue
+        try:
+            with open(filename, "rb") as f:
+                hashes[filename] = git_blob_hash(f.read())
+        except IOError:
+            pass
+    return hashes
+
+
+class ResultCache:
+    """Remembers which headers needed no changes, keyed by git blob hash.
+
+    The key also covers the path, since the expected include guard depends
+    on it, and a version which has to be bumped when the checks change.
+    """
+
+    VERSION = "1"
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = set()
+        self.changed = False
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self.keys = set(data["keys"])
+        except (IOError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def get_key(filename, blob_hash):
+        return hashlib.sha1(f"{os.path.normpath(filename)}\0{blob_hash}".encode()).hexdigest()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def add(self, key):
+        if key not in self.keys:
+            self.keys.add(key)
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": self.VERSION, "keys": sorted(self.keys)}, f)
+        os.replace(tmp_path, self.path)
 
 
 def main():
-    for filename in sys.argv[1:]:
-        fix_header_guard(filename)
+    parser = argparse.ArgumentParser(description="Fix include guards and copyright notices of header files.")
+    parser.add_argument("files", nargs="*", help="header files to check")
+    parser.add_argument(
+        "--check", action="store_true", help="only report headers which need changes, exit with 1 if there are any"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of processes checking headers"
+    )
+    parser.add_argument(
+        "--cache", help="file remembering headers without problems by git blob hash, to skip them on the next run"
+    )
+    args = parser.parse_args()
+
+    filenames = args.files
+    cache = None
+    hashes = {}
+    if args.cache:
+        cache = ResultCache(args.cache)
+        hashes = get_blob_hashes(filenames)
+        filenames = [
+            filename
+            for filename in filenames
+            if filename not in hashes or ResultCache.get_key(filename, hashes[filename]) not in cache
+        ]
+
+    jobs = [(filename, args.check) for filename in filenames]
+    if args.jobs > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(min(args.jobs, len(jobs))) as pool:
+            results = pool.map(check_header, jobs, chunksize=max(1, len(jobs) // (args.jobs * 8)))
+    else:
+        results = [check_header(job) for job in jobs]
+
+    failed = False
+    for filename, problems in results:
+        if problems is None:
+            continue
+        if problems:
+            failed = True
+            if args.check:
+                for problem in problems:
+                    print(f"{filename}: {problem}")
+        elif cache is not None and filename in hashes:
+            cache.add(ResultCache.get_key(filename, hashes[filename]))
+
+    if cache is not None:
+        cache.save()
+    if args.check and failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
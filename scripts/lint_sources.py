@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 Swift Navigation Inc.
+# Contact: Swift Navigation <dev@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+#
+
+"""
+Runs several source checks over the files tracked by git in a single walk.
+
+The files are listed with one git ls-files call and every file is read once,
+its content is then passed to all rules which apply to it. Files are checked
+by a pool of worker processes. The diagnostics of all rules are printed in the
+order of git ls-files, followed by a report of the files checked, the
+diagnostics found and the time spent by each rule.
+
+The built-in rules are ported from the standalone scripts, which are kept:
+
+  include-guard  include guards and copyright notices of headers, see
+                 fix_include_guards.py
+  attribute      uses of __attribute__ instead of the macros from
+                 swiftnav/macros.h, see check_attributes.py
+
+The uses of __attribute__ tolerated by a baseline of check_attributes.py are
+accepted with --attribute-baseline: the attribute diagnostics of a file are
+only reported if it has more of them than recorded in the baseline. The
+baseline is updated with check_attributes.py --update-baseline.
+
+More rules are loaded from Python files with --rules-from. Such a file defines
+a list RULES of instances of subclasses of lint_sources.Rule:
+
+  from lint_sources import Diagnostic, Rule
+
+  class TodoRule(Rule):
+      name = "todo"
+      patterns = ("*.c", "*.h")
+
+      def check(self, filename, data):
+          return [
+              Diagnostic(self.name, filename, line_number, "TODO left in the code", line)
+              for line_number, line in enumerate(bytes(data).split(b"\\n"), 1)
+              if b"TODO" in line
+          ]
+
+  RULES = [TodoRule()]
+
+USAGE
+
+  lint_sources.py [-j JOBS] [--rules include-guard,attribute] [--rules-from FILE] [--fix] [--json FILE]
+                  [--attribute-baseline FILE] [PATHSPEC ...]
+"""
+
+import argparse
+import collections
+import fnmatch
+import importlib.util
+import json
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import check_attributes
+import fix_include_guards
+
+# Files at least this large are mapped into memory instead of being read.
+MMAP_SIZE = 1 << 16
+CHUNK_FILES = 64
+
+# line and code are None for diagnostics about a whole file, code is the
+# offending line as bytes otherwise.
+Diagnostic = collections.namedtuple("Diagnostic", ["rule", "filename", "line", "message", "code"])
+
+
+class Rule:
+    """Base class of the rules run by lint_sources.py.
+
+    name identifies the rule on the command line and in the report, the rule
+    is applied to the files matching one of the fnmatch patterns. check() is
+    passed the content of a file as bytes or mmap and returns a list of
+    Diagnostic. Rules which can fix their problems also implement fix(),
+    returning the diagnostics which were fixed and the fixed content, or None
+    if it is unchanged.
+    """
+
+    name = None
+    patterns = ()
+
+    def applies_to(self, filename):
+        return any(fnmatch.fnmatchcase(filename, pattern) for pattern in self.patterns)
+
+    def check(self, filename, data):
+        raise NotImplementedError
+
+    def fix(self, filename, data):
+        return self.check(filename, data), None
+
+
+class IncludeGuardRule(Rule):
+    name = "include-guard"
+    patterns = ("*.h",)
+
+    def fix(self, filename, data):
+        if fix_include_guards.is_content_fine(filename, data):
+            return [], None
+        content = bytes(data).decode("utf-8", "surrogateescape")
+        fixed, problems = fix_include_guards.get_fixed_content(filename, content)
+        diagnostics = [Diagnostic(self.name, filename, None, problem, None) for problem in problems]
+        if fixed == content:
+            return diagnostics, None
+        return diagnostics, fixed.encode("utf-8", "surrogateescape")
+
+    def check(self, filename, data):
+        return self.fix(filename, data)[0]
+
+
+class AttributeRule(Rule):
+    name = "attribute"
+    patterns = ("*.[ch]", "*.[ch]pp", "*.cc", "*.[ch]xx")
+
+    def check(self, filename, data):
+        return [
+            Diagnostic(self.name, filename, line_number, check_attributes.MESSAGE, code)
+            for line_number, code in check_attributes.find_attributes_in(data)
+        ]
+
+
+BUILTIN_RULES = [IncludeGuardRule(), AttributeRule()]
+
+
+def load_rules(names, modules):
+    """Returns the built-in rules and those of the rule modules, selected by name."""
+    rules = list(BUILTIN_RULES)
+    for index, path in enumerate(modules):
+        spec = importlib.util.spec_from_file_location("lint_rules_{}".format(index), path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        rules.extend(module.RULES)
+    if names is None:
+        return rules
+    by_name = {rule.name: rule for rule in rules}
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise ValueError("unknown rules: {}".format(", ".join(unknown)))
+    return [by_name[name] for name in names]
+
+
+def write_atomically(filename, data):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix=".lint_sources.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as output_file:
+            output_file.write(data)
+        os.chmod(tmp_filename, os.stat(filename).st_mode & 0o7777)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+class Timings:
+    """Files, diagnostics and seconds per rule, summed over the workers."""
+
+    def __init__(self):
+        self.rules = {}
+        self.read_seconds = 0.0
+        self.files = 0
+        self.bytes = 0
+
+    def add_rule(self, name, seconds, diagnostics, fixed=0):
+        entry = self.rules.setdefault(name, {"files": 0, "diagnostics": 0, "fixed": 0, "seconds": 0.0})
+        entry["files"] += 1
+        entry["diagnostics"] += diagnostics
+        entry["fixed"] += fixed
+        entry["seconds"] += seconds
+
+    def update(self, other):
+        for name, counts in other.rules.items():
+            entry = self.rules.setdefault(name, {"files": 0, "diagnostics": 0, "fixed": 0, "seconds": 0.0})
+            for key, value in counts.items():
+                entry[key] += value
+        self.read_seconds += other.read_seconds
+        self.files += other.files
+        self.bytes += other.bytes
+
+
+def lint_file(filename, rules, fix, timings):
+    """Reads a file once and runs every rule on it, returns the diagnostics."""
+    diagnostics = []
+    start = time.perf_counter()
+    try:
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= MMAP_SIZE:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+    except IOError as e:
+        print("{}: {}".format(filename, e), file=sys.stderr)
+        return diagnostics
+    timings.read_seconds += time.perf_counter() - start
+    timings.files += 1
+    timings.bytes += size
+
+    changed = False
+    try:
+        for rule in rules:
+            start = time.perf_counter()
+            if fix:
+                found, fixed = rule.fix(filename, data)
+            else:
+                found, fixed = rule.check(filename, data), None
+            if fixed is not None:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+                data = fixed
+                changed = True
+                timings.add_rule(rule.name, time.perf_counter() - start, 0, len(found))
+            else:
+                diagnostics.extend(found)
+                timings.add_rule(rule.name, time.perf_counter() - start, len(found))
+        if changed:
+            write_atomically(filename, data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    return diagnostics
+
+
+_rules = None
+
+
+def init_worker(names, modules):
+    global _rules
+    _rules = load_rules(names, modules)
+
+
+def lint_chunk(job):
+    filenames, fix = job
+    timings = Timings()
+    diagnostics = []
+    for filename in filenames:
+        rules = [rule for rule in _rules if rule.applies_to(filename)]
+        diagnostics.extend(lint_file(filename, rules, fix, timings))
+    return diagnostics, timings
+
+
+def tolerated_files(diagnostics, baseline):
+    """Returns the files whose attribute diagnostics are all tolerated by the baseline."""
+    counts = collections.Counter(
+        diagnostic.filename for diagnostic in diagnostics if diagnostic.rule == AttributeRule.name
+    )
+    return set(filename for filename, count in counts.items() if count <= baseline.get(filename, 0))
+
+
+def format_diagnostic(pwd, diagnostic):
+    location = "{}/{}".format(pwd, diagnostic.filename)
+    if diagnostic.line is not None:
+        location += ":{}".format(diagnostic.line)
+    text = "{}: error: {} [{}]\n".format(location, diagnostic.message, diagnostic.rule).encode("utf-8")
+    if diagnostic.code is not None:
+        text += b"          " + diagnostic.code + b"\n"
+    return text
+
+
+def print_report(timings, rules, seconds, out):
+    print("{:<16} {:>8} {:>12} {:>8} {:>10}".format("rule", "files", "diagnostics", "fixed", "seconds"), file=out)
+    for rule in rules:
+        entry = timings.rules.get(rule.name, {"files": 0, "diagnostics": 0, "fixed": 0, "seconds": 0.0})
+        print(
+            "{:<16} {:>8} {:>12} {:>8} {:>10.3f}".format(
+                rule.name, entry["files"], entry["diagnostics"], entry["fixed"], entry["seconds"]
+            ),
+            file=out,
+        )
+    print("{:<16} {:>8} {:>12} {:>8} {:>10.3f}".format("read", timings.files, "", "", timings.read_seconds), file=out)
+    print("{} files, {} bytes in {:.3f}s".format(timings.files, timings.bytes, seconds), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run source checks over the files tracked by git in one walk.")
+    parser.add_argument("pathspecs", nargs="*", help="git pathspecs of the files to check")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of processes checking files"
+    )
+    parser.add_argument("--rules", help="comma separated names of the rules to run, all of them by default")
+    parser.add_argument(
+        "--rules-from", action="append", default=[], metavar="FILE", help="load more rules from a Python file"
+    )
+    parser.add_argument("--list-rules", action="store_true", help="print the names of the rules and exit")
+    parser.add_argument("--fix", action="store_true", help="fix the problems of rules which can fix them in place")
+    parser.add_argument("--json", metavar="FILE", help="also write the diagnostics and the report to a JSON file")
+    parser.add_argument(
+        "--attribute-baseline",
+        metavar="FILE",
+        help="JSON baseline of check_attributes.py with the number of uses of __attribute__ tolerated in each file",
+    )
+    args = parser.parse_args()
+
+    names = args.rules.split(",") if args.rules else None
+    modules = [os.path.abspath(path) for path in args.rules_from]
+    try:
+        rules = load_rules(names, modules)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.list_rules:
+        for rule in rules:
+            print("{:<16} {}".format(rule.name, " ".join(rule.patterns)))
+        return
+
+    start = time.perf_counter()
+    filenames = [
+        filename
+        for filename in check_attributes.list_files(args.pathspecs)
+        if any(rule.applies_to(filename) for rule in rules)
+    ]
+    jobs = [(filenames[i : i + CHUNK_FILES], args.fix) for i in range(0, len(filenames), CHUNK_FILES)]
+    if args.jobs > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(
+            min(args.jobs, len(jobs)), initializer=init_worker, initargs=(names, modules)
+        ) as pool:
+            results = pool.map(lint_chunk, jobs)
+    else:
+        init_worker(names, modules)
+        results = [lint_chunk(job) for job in jobs]
+    seconds = time.perf_counter() - start
+
+    timings = Timings()
+    diagnostics = []
+    for chunk_diagnostics, chunk_timings in results:
+        diagnostics.extend(chunk_diagnostics)
+        timings.update(chunk_timings)
+
+    tolerated = set()
+    if args.attribute_baseline:
+        tolerated = tolerated_files(diagnostics, check_attributes.load_baseline(args.attribute_baseline))
+
+    def is_tolerated(diagnostic):
+        return diagnostic.rule == AttributeRule.name and diagnostic.filename in tolerated
+
+    pwd = check_attributes.working_directory()
+    out = sys.stdout.buffer
+    failed = False
+    for diagnostic in diagnostics:
+        if not is_tolerated(diagnostic):
+            out.write(format_diagnostic(pwd, diagnostic))
+            failed = True
+    out.flush()
+    print_report(timings, rules, seconds, sys.stderr)
+
+    if args.json:
+        check_attributes.write_json(
+            {
+                "diagnostics": [
+                    {
+                        "rule": diagnostic.rule,
+                        "file": diagnostic.filename,
+                        "line": diagnostic.line,
+                        "message": diagnostic.message,
+                        "code": None if diagnostic.code is None else diagnostic.code.decode("utf-8", "replace"),
+                        "baseline": is_tolerated(diagnostic),
+                    }
+                    for diagnostic in diagnostics
+                ],
+                "rules": timings.rules,
+                "files": timings.files,
+                "bytes": timings.bytes,
+                "read_seconds": timings.read_seconds,
+                "seconds": seconds,
+            },
+            args.json,
+        )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,11 @@
 # If the option `skip_tests` is defined, that replaces all `error` elements
 # with `skipped` elements.
 #
+# Xml files are parsed incrementally and every `error` element is discarded
+# once its test case has been written, so memory use does not depend on the
+# size of the input. Files truncated by a crashed valgrind run are converted
+# up to the last complete `error` element.
+#
 # USAGE
 #
 #   python memcheck_xml2junit_converter.py [OPTIONS]
@@ -40,111 +45,527 @@
 # * -s, --skip_tests:       Error elements in a Valgrind Memcheck xml file are
 #                           replaced by a skipped message type in the converted
 #                           JUnit xml file.
+# * -j, --jobs:             Number of xml files converted in parallel. Every
+#                           output file is written to a temporary file and
+#                           renamed into place, the outputs do not depend on
+#                           the number of jobs.
+# * -d, --deduplicate:      Aggregates the errors of all xml files into a single
+#                           JUnit xml file `memcheck.xml` with one test case per
+#                           unique error. Errors are identified by a fingerprint
+#                           of their kind and the function, file and line of the
+#                           top frames of their stack, and every test case
+#                           reports how often and in which files it occurred.
+# * --stack_depth:          Number of stack frames in a fingerprint, 5 by
+#                           default.
+# * --baseline:             JSON file of known fingerprints. Known errors are
+#                           reported as skipped and the script exits with an
+#                           error if any new error is found. Implies
+#                           --deduplicate.
+# * --write_baseline:       Writes the fingerprints of all errors found to a
+#                           JSON file usable with --baseline. Implies
+#                           --deduplicate.
+# * --generate_suppressions: Collects the `suppression` elements valgrind emits
+#                           with `--gen-suppressions=all` into a Valgrind
+#                           suppressions file. Suppressions are cut to their top
+#                           frames followed by a `...` wildcard, deduplicated
+#                           and appended to the suppressions already in the
+#                           file. The file collects candidates for triage, it
+#                           must not be the file passed to valgrind with
+#                           `--suppressions`, or every new error would be
+#                           suppressed from the next run on.
+# * --suppression_frames:   Number of frames kept in a generated suppression, 5
+#                           by default.
 #
+from __future__ import print_function
+
 import argparse
 import errno
+import hashlib
+import json
+import multiprocessing
 import os
+import shutil
+import sys
+import tempfile
 import xml.etree.ElementTree as ET
 
 def get_testcase_preamble(name, close=False):
     return '    <testcase classname="valgrind-memcheck" name="{}"{}>\n'.format(str(name), "/" if close else "")
 
 
-parser = argparse.ArgumentParser(description='Convert Valgrind Memcheck xml into JUnit xml format.')
-optional = parser._action_groups.pop()
-required = parser.add_argument_group('required arguments')
-required.add_argument('-i','--input_directory',
-                      help='Directory where Valgrind Memcheck xml files are located',
-                      required=True)
-required.add_argument('-o','--output_directory',
-                      help='Directory where the converted JUnit xml files are collected',
-                      required=True)
-optional.add_argument('-s','--skip_tests',
-                      help='Error elements in a Valgrind Memcheck xml file is replaced by a skipped message type in the converted JUnit xml file',
-                      action='store_true')
-parser._action_groups.append(optional)
-args = parser.parse_args()
-
-if not os.path.exists(args.output_directory):
+def escape(text):
+  text = text.replace("&","&amp;")
+  text = text.replace("<","&lt;")
+  return text.replace(">","&gt;")
+
+
+def get_text(element, path):
+  child = element.find(path)
+  return child.text if child is not None else None
+
+
+def parse_error(error):
+  what = error.find('what')
+  if what is None:
+    what = error.find('xwhat/text')
+  frames = []
+  stack = error.find('stack')
+  if stack is not None:
+    for frame in stack.findall('frame'):
+      frames.append({'ip': get_text(frame, 'ip'),
+                     'fn': get_text(frame, 'fn'),
+                     'file': get_text(frame, 'file'),
+                     'line': get_text(frame, 'line')})
+  suppression = error.find('suppression')
+  if suppression is not None:
+    sframes = []
+    for sframe in suppression.findall('sframe'):
+      fun = get_text(sframe, 'fun')
+      obj = get_text(sframe, 'obj')
+      if fun is not None:
+        sframes.append('fun:' + fun)
+      elif obj is not None:
+        sframes.append('obj:' + obj)
+      else:
+        sframes.append('obj:*')
+    suppression = {'kind': get_text(suppression, 'skind'),
+                   'aux': [skaux.text for skaux in suppression.findall('skaux')],
+                   'frames': sframes}
+  return {'kind': get_text(error, 'kind'),
+          'what': what.text if what is not None else '',
+          'frames': frames,
+          'suppression': suppression}
+
+
+def iter_errors(input_filepath):
+  """Yields the errors of a Valgrind Memcheck xml file one at a time.
+
+  Elements are cleared as soon as they are complete. A truncated file ends
+  the iteration after its last complete error, a file which is not xml at
+  all raises ET.ParseError.
+  """
+  root = None
+  depth = 0
   try:
-    os.mkdir(args.output_directory)
-  except OSError as e:
-    if e.errno != errno.EEXIST:
+    for event, element in ET.iterparse(input_filepath, events=('start', 'end')):
+      if event == 'start':
+        if root is None:
+          root = element
+        depth += 1
+        continue
+      depth -= 1
+      if element.tag == 'error':
+        yield parse_error(element)
+      if depth == 1:
+        # drop finished top level elements from the root
+        root.clear()
+  except ET.ParseError as e:
+    if root is None:
       raise
+    print('Warning: {} is truncated ({}), converted the complete errors only'.format(input_filepath, e), file=sys.stderr)
 
-for subdir, dirs, files in os.walk(args.input_directory):
-  if os.path.basename(subdir) == os.path.basename(args.output_directory):
-    continue
-  for filename in files:
-    if "xml" in filename:
-      # read errors in valgrind memcheck xml
-      input_filepath = os.path.join(subdir, filename)
-      try:
-        doc = ET.parse(input_filepath)
-      except ET.ParseError:
-        continue
-      errors = doc.findall('.//error')
-
-      # create output filename
-      output_filename = os.path.join(args.output_directory, filename)
-      if not output_filename.endswith('.xml'):
-        output_filename += '.xml'
-
-      test_type = "error"
-      plural = "s"
-      if args.skip_tests:
-        test_type = "skipped"
-        plural = ""
-
-      out = open(output_filename,"w")
-      out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-      if len(errors) == 0:
-        out.write('<testsuite name="valgrind" tests="1" '+test_type+''+plural+'="'+str(len(errors))+'">\n')
-        out.write(get_testcase_preamble(filename, close=True))
+
+def write_error(out, test_type, filename, errorcount, error):
+  location = None
+  for frame in error['frames']:
+    if frame['file'] is not None and frame['line'] is not None:
+      location = frame
+      break
+
+  if location is not None:
+    out.write(get_testcase_preamble("{} {} ({}, {}:{})".format(str(filename), errorcount, error['kind'], location['file'], location['line'])))
+  else:
+    out.write(get_testcase_preamble("{} {} ({})".format(str(filename), errorcount, error['kind'])))
+  out.write('        <'+test_type+' type="'+error['kind']+'">\n')
+  out.write('  '+error['what']+'\n\n')
+
+  for frame in error['frames']:
+    write_frame(out, frame)
+  out.write('        </'+test_type+'>\n')
+  out.write('    </testcase>\n')
+
+
+def write_frame(out, frame):
+  if frame['fn'] is not None:
+    bodytext = frame['fn']
+  else:
+    bodytext = "unknown function name"
+  bodytext = escape(bodytext)
+  if frame['file'] is not None and frame['line'] is not None:
+    out.write('  '+frame['ip']+': '+bodytext+' ('+frame['file']+':'+frame['line']+')\n')
+  else:
+    out.write('  '+frame['ip']+': '+bodytext+'\n')
+
+
+def convert(input_filepath, output_filename, filename, skip_tests, suppression_frames=None):
+  """Converts one Valgrind Memcheck xml file, returns None if it is not xml.
+
+  The number of errors is part of the testsuite element, so test cases are
+  first written to a temporary file and copied behind the header once the
+  input has been read. If suppression_frames is set, the generalized
+  suppressions of the errors are returned.
+  """
+  test_type = "error"
+  plural = "s"
+  if skip_tests:
+    test_type = "skipped"
+    plural = ""
+
+  errorcount = 0
+  suppressions = set()
+  with tempfile.TemporaryFile(mode='w+') as testcases:
+    try:
+      for error in iter_errors(input_filepath):
+        errorcount += 1
+        write_error(testcases, test_type, filename, errorcount, error)
+        if suppression_frames is not None:
+          add_suppression(suppressions, error, suppression_frames)
+    except ET.ParseError:
+      return None
+
+    out, tmp_filename = open_output(output_filename)
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    if errorcount == 0:
+      out.write('<testsuite name="valgrind" tests="1" '+test_type+''+plural+'="'+str(errorcount)+'">\n')
+      out.write(get_testcase_preamble(filename, close=True))
+    else:
+      out.write('<testsuite name="valgrind" tests="'+str(errorcount)+'" '+test_type+''+plural+'="'+str(errorcount)+'">\n')
+      testcases.seek(0)
+      shutil.copyfileobj(testcases, out)
+    out.write('</testsuite>\n')
+    out.close()
+  close_output(tmp_filename, output_filename)
+  return suppressions
+
+
+def open_output(output_filename):
+  """Opens a temporary file next to output_filename for writing."""
+  output_directory = os.path.dirname(os.path.abspath(output_filename))
+  fd, tmp_filename = tempfile.mkstemp(dir=output_directory, prefix='.' + os.path.basename(output_filename), suffix='.tmp')
+  return os.fdopen(fd, "w"), tmp_filename
+
+
+def close_output(tmp_filename, output_filename):
+  """Moves a file written through open_output into place."""
+  os.chmod(tmp_filename, 0o644)
+  os.rename(tmp_filename, output_filename)
+
+
+def get_fingerprint(error, stack_depth):
+  """Identifies an error by its kind and the top frames of its stack.
+
+  Instruction pointers and the message are left out, they differ between
+  processes and runs (addresses, leaked bytes) for the same error.
+  """
+  frames = [[frame['fn'], frame['file'], frame['line']] for frame in error['frames'][:stack_depth]]
+  key = json.dumps([error['kind'], frames])
+  return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def fingerprint_file(job):
+  """Returns the errors of an xml file by fingerprint, None if it is not xml."""
+  input_filepath, filename, stack_depth, suppression_frames = job
+  errors = {}
+  suppressions = set()
+  try:
+    for error in iter_errors(input_filepath):
+      if suppression_frames is not None:
+        add_suppression(suppressions, error, suppression_frames)
+      fingerprint = get_fingerprint(error, stack_depth)
+      if fingerprint in errors:
+        errors[fingerprint][1] += 1
       else:
-        out.write('<testsuite name="valgrind" tests="'+str(len(errors))+'" '+test_type+''+plural+'="'+str(len(errors))+'">\n')
-        errorcount=0
-        for error in errors:
-          errorcount += 1
-
-          kind = error.find('kind')
-          what = error.find('what')
-          if what == None:
-            what = error.find('xwhat/text')
-
-          stack = error.find('stack')
-          frames = stack.findall('frame')
-
-          for frame in frames:
-            fi = frame.find('file')
-            li = frame.find('line')
-            if fi != None and li != None:
-              break
-
-          if fi != None and li != None:
-            out.write(get_testcase_preamble("{} {} ({}, {}:{})".format(str(filename), errorcount, kind.text, fi.text, li.text)))
-          else:
-            out.write(get_testcase_preamble("{} {} ({})".format(str(filename), errorcount, kind.text)))
-          out.write('        <'+test_type+' type="'+kind.text+'">\n')
-          out.write('  '+what.text+'\n\n')
-
-          for frame in frames:
-            ip = frame.find('ip')
-            fn = frame.find('fn')
-            fi = frame.find('file')
-            li = frame.find('line')
-            if fn != None:
-              bodytext = fn.text
-            else:
-              bodytext = "unknown function name"
-            bodytext = bodytext.replace("&","&amp;")
-            bodytext = bodytext.replace("<","&lt;")
-            bodytext = bodytext.replace(">","&gt;")
-            if fi != None and li != None:
-              out.write('  '+ip.text+': '+bodytext+' ('+fi.text+':'+li.text+')\n')
-            else:
-              out.write('  '+ip.text+': '+bodytext+'\n')
-          out.write('        </'+test_type+'>\n')
-          out.write('    </testcase>\n')
-      out.write('</testsuite>\n')
-      out.close()
+        error.pop('suppression')
+        errors[fingerprint] = [error, 1]
+  except ET.ParseError:
+    return None
+  return filename, errors, suppressions
+
+
+def aggregate(results):
+  """Merges per file errors into {fingerprint: [error, count, filenames]}."""
+  aggregated = {}
+  for result in results:
+    if result is None:
+      continue
+    filename, errors, _ = result
+    for fingerprint, (error, count) in errors.items():
+      if fingerprint in aggregated:
+        aggregated[fingerprint][1] += count
+        aggregated[fingerprint][2].append(filename)
+      else:
+        aggregated[fingerprint] = [error, count, [filename]]
+  return aggregated
+
+
+def get_location(error):
+  for frame in error['frames']:
+    if frame['file'] is not None and frame['line'] is not None:
+      return '{}:{}'.format(frame['file'], frame['line'])
+  return None
+
+
+MAX_LISTED_FILES = 10
+
+
+def write_aggregated(output_filename, aggregated, known, skip_tests):
+  """Writes one test case per fingerprint, returns the new fingerprints."""
+  new = [fingerprint for fingerprint in sorted(aggregated) if fingerprint not in known]
+  failed_type = "skipped" if skip_tests else "error"
+  failures = 0 if skip_tests else len(new)
+
+  out, tmp_filename = open_output(output_filename)
+  out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+  if not aggregated:
+    out.write('<testsuite name="valgrind" tests="1" errors="0" skipped="0">\n')
+    out.write(get_testcase_preamble("valgrind-memcheck", close=True))
+  else:
+    out.write('<testsuite name="valgrind" tests="{}" errors="{}" skipped="{}">\n'.format(
+        len(aggregated), failures, len(aggregated) - failures))
+    # most frequent errors first, the fingerprint breaks ties deterministically
+    for fingerprint in sorted(aggregated, key=lambda f: (-aggregated[f][1], f)):
+      error, count, filenames = aggregated[fingerprint]
+      test_type = "skipped" if fingerprint in known else failed_type
+      location = get_location(error)
+      if location is not None:
+        out.write(get_testcase_preamble("{} {} ({})".format(error['kind'], fingerprint, location)))
+      else:
+        out.write(get_testcase_preamble("{} {}".format(error['kind'], fingerprint)))
+      out.write('        <'+test_type+' type="'+error['kind']+'">\n')
+      out.write('  '+escape(error['what'])+'\n\n')
+      filenames = sorted(filenames)
+      listed = ', '.join(escape(filename) for filename in filenames[:MAX_LISTED_FILES])
+      if len(filenames) > MAX_LISTED_FILES:
+        listed += ', ...'
+      out.write('  Occurred {} times in {} files: {}\n'.format(count, len(filenames), listed))
+      if fingerprint in known:
+        out.write('  Known error from the baseline\n')
+      out.write('\n')
+      for frame in error['frames']:
+        write_frame(out, frame)
+      out.write('        </'+test_type+'>\n')
+      out.write('    </testcase>\n')
+  out.write('</testsuite>\n')
+  out.close()
+  close_output(tmp_filename, output_filename)
+  return new
+
+
+def generalize_suppression(suppression, suppression_frames):
+  """Returns the lines of a suppression, cut to its top frames.
+
+  Frames below the kept ones are replaced by the `...` wildcard, which
+  matches any number of frames, so the suppression also covers the same
+  error reached through other callers.
+  """
+  frames = suppression['frames']
+  if len(frames) > suppression_frames:
+    frames = frames[:suppression_frames] + ['...']
+  return tuple([suppression['kind']] + suppression['aux'] + frames)
+
+
+def add_suppression(suppressions, error, suppression_frames):
+  if error.get('suppression') is not None:
+    suppressions.add(generalize_suppression(error['suppression'], suppression_frames))
+
+
+def get_suppression_name(lines):
+  return 'generated-' + hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()[:12]
+
+
+SUPPRESSIONS_HEADER = '# Generated by memcheck_xml2junit_converter.py --generate_suppressions\n'
+
+
+def load_suppressions(path):
+  """Reads a Valgrind suppressions file into {lines: name}."""
+  suppressions = {}
+  if not os.path.exists(path):
+    return suppressions
+  block = None
+  with open(path, 'r') as f:
+    for line in f:
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      if line == '{':
+        block = []
+      elif line == '}':
+        if block:
+          suppressions.setdefault(tuple(block[1:]), block[0])
+        block = None
+      elif block is not None:
+        block.append(line)
+  return suppressions
+
+
+def write_suppressions(path, suppressions):
+  """Adds new suppressions to a Valgrind suppressions file.
+
+  The file is kept as it is, including comments and hand-written entries,
+  and suppressions which are not in it yet are appended. They are named
+  after their content so that re-generating them is deterministic.
+  """
+  directory = os.path.dirname(os.path.abspath(path))
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+  existing = load_suppressions(path)
+  added = {}
+  for lines in suppressions:
+    if lines not in existing and lines not in added:
+      added[lines] = get_suppression_name(lines)
+  if not added and os.path.exists(path):
+    return 0
+
+  content = ''
+  if os.path.exists(path):
+    with open(path, 'r') as f:
+      content = f.read()
+  if not content.strip():
+    content = SUPPRESSIONS_HEADER
+  elif not content.endswith('\n'):
+    content += '\n'
+  out, tmp_filename = open_output(path)
+  out.write(content)
+  for lines in sorted(added, key=lambda lines: (added[lines], lines)):
+    out.write('{\n')
+    out.write('   ' + added[lines] + '\n')
+    for line in lines:
+      out.write('   ' + line + '\n')
+    out.write('}\n')
+  out.close()
+  close_output(tmp_filename, path)
+  return len(added)
+
+
+def load_baseline(path):
+  with open(path, 'r') as f:
+    return json.load(f)['fingerprints']
+
+
+def write_baseline(path, aggregated):
+  fingerprints = {}
+  for fingerprint, (error, count, filenames) in aggregated.items():
+    fingerprints[fingerprint] = {'kind': error['kind'], 'what': error['what'], 'location': get_location(error)}
+  out, tmp_filename = open_output(path)
+  json.dump({'fingerprints': fingerprints}, out, indent=2, sort_keys=True)
+  out.write('\n')
+  out.close()
+  close_output(tmp_filename, path)
+
+
+def run_jobs(function, jobs, count):
+  """Maps function over jobs in a process pool, results are in job order."""
+  if count > 1 and len(jobs) > 1:
+    pool = multiprocessing.Pool(min(count, len(jobs)))
+    try:
+      return pool.map(function, jobs, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  return [function(job) for job in jobs]
+
+
+def convert_job(job):
+  return convert(*job)
+
+
+def find_jobs(input_directory, output_directory, skip_tests):
+  """Returns the conversions to run, in a deterministic order.
+
+  Input files with the same name in different directories map to the same
+  output file, the last one in sorted order is converted.
+  """
+  jobs = {}
+  for subdir, dirs, files in os.walk(input_directory):
+    dirs.sort()
+    if os.path.basename(subdir) == os.path.basename(output_directory):
+      continue
+    for filename in sorted(files):
+      if "xml" in filename:
+        input_filepath = os.path.join(subdir, filename)
+
+        # create output filename
+        output_filename = os.path.join(output_directory, filename)
+        if not output_filename.endswith('.xml'):
+          output_filename += '.xml'
+
+        jobs[output_filename] = (input_filepath, output_filename, filename, skip_tests)
+  return [jobs[output_filename] for output_filename in sorted(jobs)]
+
+
+def save_suppressions(path, results):
+  suppressions = set()
+  for result in results:
+    suppressions.update(result)
+  added = write_suppressions(path, suppressions)
+  print('Added {} new suppressions to {}'.format(added, path))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Convert Valgrind Memcheck xml into JUnit xml format.')
+  optional = parser._action_groups.pop()
+  required = parser.add_argument_group('required arguments')
+  required.add_argument('-i','--input_directory',
+                        help='Directory where Valgrind Memcheck xml files are located',
+                        required=True)
+  required.add_argument('-o','--output_directory',
+                        help='Directory where the converted JUnit xml files are collected',
+                        required=True)
+  optional.add_argument('-s','--skip_tests',
+                        help='Error elements in a Valgrind Memcheck xml file is replaced by a skipped message type in the converted JUnit xml file',
+                        action='store_true')
+  optional.add_argument('-j','--jobs',
+                        help='Number of xml files converted in parallel, defaults to 1',
+                        type=int, default=1)
+  optional.add_argument('-d','--deduplicate',
+                        help='Aggregate the errors of all xml files into memcheck.xml with one test case per unique error',
+                        action='store_true')
+  optional.add_argument('--stack_depth',
+                        help='Number of stack frames identifying an error, defaults to 5',
+                        type=int, default=5)
+  optional.add_argument('--baseline',
+                        help='JSON file of known error fingerprints, fails only if new errors are found')
+  optional.add_argument('--write_baseline',
+                        help='Write the fingerprints of all errors found to this JSON file')
+  optional.add_argument('--generate_suppressions',
+                        help='Valgrind suppressions file to merge the suppressions found in the xml files into')
+  optional.add_argument('--suppression_frames',
+                        help='Number of frames kept in a generated suppression, defaults to 5',
+                        type=int, default=5)
+  parser._action_groups.append(optional)
+  args = parser.parse_args()
+
+  if not os.path.exists(args.output_directory):
+    try:
+      os.mkdir(args.output_directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  suppression_frames = args.suppression_frames if args.generate_suppressions else None
+  jobs = find_jobs(args.input_directory, args.output_directory, args.skip_tests)
+  if not (args.deduplicate or args.baseline or args.write_baseline):
+    results = run_jobs(convert_job, [job + (suppression_frames,) for job in jobs], args.jobs)
+    if args.generate_suppressions:
+      save_suppressions(args.generate_suppressions, [result for result in results if result is not None])
+    return
+
+  results = run_jobs(fingerprint_file, [(input_filepath, filename, args.stack_depth, suppression_frames)
+                                        for input_filepath, _, filename, _ in jobs], args.jobs)
+  if args.generate_suppressions:
+    save_suppressions(args.generate_suppressions, [result[2] for result in results if result is not None])
+  aggregated = aggregate(results)
+  known = load_baseline(args.baseline) if args.baseline else {}
+  new = write_aggregated(os.path.join(args.output_directory, 'memcheck.xml'), aggregated, known, args.skip_tests)
+  if args.write_baseline:
+    write_baseline(args.write_baseline, aggregated)
+  if args.baseline and new:
+    print('{} new Valgrind Memcheck errors not in {}:'.format(len(new), args.baseline), file=sys.stderr)
+    for fingerprint in new:
+      error = aggregated[fingerprint][0]
+      print('  {} {} ({})'.format(fingerprint, error['kind'], get_location(error) or 'unknown location'), file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -16,6 +16,12 @@
 # and writes the static size of the binary when loaded into memory, VM size,
 # into a log file.
 #
+# Besides the human readable table, the input can be Bloaty's CSV output
+# (`bloaty --csv -n 0 -d sections,compileunits,symbols`). The rows are then
+# aggregated per section, compile unit and symbol into a JSON report, which
+# can be compared against the report of an earlier build to rank what grew
+# the most, and checked against per section budgets.
+#
 # USAGE
 #
 #   python parse_bloaty.py [OPTIONS]
@@ -27,40 +33,251 @@
 # * -i, --input_file:  Sets the input file path.
 # * -o, --output_file: Sets the output file path.
 # * -m, --message:     Adds a message to the reported memory usage.
+# * -j, --json:        Writes a JSON report of the sizes per section, compile
+#                      unit and symbol to the given file path. Needs CSV input.
+# * -b, --baseline:    Compares against a JSON report of an earlier build and
+#                      prints the largest growth by VM size and by file size.
+# * --top:             Number of entries in each ranking of the comparison.
+#                      [Default: 20]
+# * --budget:          SECTION=SIZE, fails if the VM size of a section exceeds
+#                      SIZE bytes (Ki, Mi and Gi suffixes are accepted). Can be
+#                      given multiple times. Needs CSV input.
 #
+from __future__ import print_function
+
 import argparse
+import csv
+import heapq
+import json
+import os
+import re
 import sys
+import tempfile
+
+SIZE_COLUMNS = ('vmsize', 'filesize')
+DIMENSIONS = ('sections', 'segments', 'compileunits', 'symbols')
+UNITS = {'': 1, 'Ki': 1024, 'Mi': 1024 ** 2, 'Gi': 1024 ** 3}
+
+
+def format_size(size):
+  """Formats a size the way Bloaty does, e.g. 512, 12.3Ki or 1.23Mi."""
+  value = float(size)
+  for unit in ('', 'Ki', 'Mi', 'Gi'):
+    if abs(value) < 1024 or unit == 'Gi':
+      break
+    value /= 1024
+  if unit == '':
+    return str(int(size))
+  if abs(value) < 10:
+    return '{:.2f}{}'.format(value, unit)
+  if abs(value) < 100:
+    return '{:.1f}{}'.format(value, unit)
+  return '{:.0f}{}'.format(value, unit)
+
+
+def parse_size(text):
+  match = re.match(r'^\s*([0-9.]+)\s*(Ki|Mi|Gi)?\s*$', text)
+  if not match:
+    raise argparse.ArgumentTypeError('invalid size {!r}'.format(text))
+  return int(float(match.group(1)) * UNITS[match.group(2) or ''])
+
+
+def parse_budget(text):
+  section, _, size = text.rpartition('=')
+  if not section:
+    raise argparse.ArgumentTypeError('budget has to be SECTION=SIZE, got {!r}'.format(text))
+  return section, parse_size(size)
 
-parser = argparse.ArgumentParser(description='Log total static memory size reported by Bloaty.')
-optional = parser._action_groups.pop()
-required = parser.add_argument_group('required arguments')
-required.add_argument('-i','--input_file',
-                      help='File path where a Bloaty file is located',
-                      required=True)
-required.add_argument('-o','--output_file',
-                      help='File path where the log should be created',
-                      required=True)
-optional.add_argument('-m','--message',
-                      help='Custom message that gets concatenated with the reported memory usage',
-                      default='Static memory usage:')
-parser._action_groups.append(optional)
-args = parser.parse_args()
-
-try:
-  finput = open(args.input_file)
-  foutput = open(args.output_file,"a")
-except IOError:
-  sys.exit()
-
-with finput:
-  lines = finput.readlines()
-  last_line = lines[-1]
 
+def is_csv(header):
+  return header.strip().endswith(','.join(SIZE_COLUMNS))
+
+
+def read_table_total(finput):
+  """Returns the VM size of the TOTAL row of Bloaty's human readable table."""
+  last_line = ''
+  for line in finput:
+    if line.strip():
+      last_line = line
   end = last_line.rfind("TOTAL")-4
   start = last_line.rfind(" ",0,end)
+  return last_line[start:end].strip()
+
+
+def read_csv(finput):
+  """Aggregates Bloaty CSV rows per data source in a single pass.
+
+  Returns {'total': sizes, dimension: {name: sizes}} where sizes is a
+  [vmsize, filesize] list. Symbols are aggregated over all sections and
+  compile units they appear in.
+  """
+  reader = csv.reader(finput)
+  header = next(reader)
+  sources = header[:-len(SIZE_COLUMNS)]
+  report = {'total': [0, 0]}
+  for source in sources:
+    report[source] = {}
+  total = report['total']
+  tables = [report[source] for source in sources]
+  for row in reader:
+    if len(row) != len(header):
+      continue
+    vmsize = int(row[-2])
+    filesize = int(row[-1])
+    total[0] += vmsize
+    total[1] += filesize
+    for table, name in zip(tables, row):
+      sizes = table.get(name)
+      if sizes is None:
+        table[name] = [vmsize, filesize]
+      else:
+        sizes[0] += vmsize
+        sizes[1] += filesize
+  return report
+
+
+def _prepend(line, lines):
+  yield line
+  for line in lines:
+    yield line
+
+
+def to_json(report):
+  result = {'total': {'vmsize': report['total'][0], 'filesize': report['total'][1]}}
+  for source, table in report.items():
+    if source == 'total':
+      continue
+    result[source] = {name: {'vmsize': sizes[0], 'filesize': sizes[1]} for name, sizes in table.items()}
+  return result
+
+
+def diff(report, baseline, top):
+  """Ranks the largest growth per data source by VM size and by file size.
+
+  Entries only present in one of the reports count as zero in the other.
+  """
+  result = {'total': {column: report['total'][column] - baseline['total'][column] for column in SIZE_COLUMNS}}
+  for source in report:
+    if source == 'total' or source not in baseline:
+      continue
+    current = report[source]
+    previous = baseline[source]
+    deltas = []
+    for name in set(current) | set(previous):
+      after = current.get(name, {'vmsize': 0, 'filesize': 0})
+      before = previous.get(name, {'vmsize': 0, 'filesize': 0})
+      delta = {column: after[column] - before[column] for column in SIZE_COLUMNS}
+      if delta['vmsize'] or delta['filesize']:
+        deltas.append((name, delta))
+    result[source] = {}
+    for column in SIZE_COLUMNS:
+      ranked = heapq.nsmallest(top, deltas, key=lambda item: (-item[1][column], item[0]))
+      result[source][column] = [dict(name=name, **delta) for name, delta in ranked if delta[column] > 0]
+  return result
+
+
+def print_diff(result):
+  total = result['total']
+  print('Size change: VM {:+d} bytes, file {:+d} bytes'.format(total['vmsize'], total['filesize']))
+  for source in DIMENSIONS:
+    if source not in result:
+      continue
+    for column in SIZE_COLUMNS:
+      if not result[source][column]:
+        continue
+      print('Largest {} growth by {}:'.format(source, column))
+      for entry in result[source][column]:
+        print('  {:>+10d} {}'.format(entry[column], entry['name']))
+
+
+def check_budgets(report, budgets):
+  """Returns the (section, size, budget) triples exceeding their budget."""
+  sections = report.get('sections', {})
+  exceeded = []
+  for section, budget in budgets:
+    size = sections.get(section, {'vmsize': 0})['vmsize']
+    if size > budget:
+      exceeded.append((section, size, budget))
+  return exceeded
+
+
+def write_json(path, data):
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+  with os.fdopen(fd, 'w') as f:
+    json.dump(data, f, indent=1, sort_keys=True)
+    f.write('\n')
+  os.chmod(tmp_path, 0o644)
+  os.rename(tmp_path, path)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Log total static memory size reported by Bloaty.')
+  optional = parser._action_groups.pop()
+  required = parser.add_argument_group('required arguments')
+  required.add_argument('-i','--input_file',
+                        help='File path where a Bloaty file is located',
+                        required=True)
+  required.add_argument('-o','--output_file',
+                        help='File path where the log should be created',
+                        required=True)
+  optional.add_argument('-m','--message',
+                        help='Custom message that gets concatenated with the reported memory usage',
+                        default='Static memory usage:')
+  optional.add_argument('-j','--json',
+                        help='File path where a JSON report of the sizes per section, compile unit and symbol should be written')
+  optional.add_argument('-b','--baseline',
+                        help='JSON report of an earlier build to compare against')
+  optional.add_argument('--top',
+                        help='Number of entries in each ranking of the comparison',
+                        type=int, default=20)
+  optional.add_argument('--budget',
+                        help='SECTION=SIZE, fail if the VM size of the section exceeds SIZE',
+                        type=parse_budget, action='append', default=[])
+  parser._action_groups.append(optional)
+  args = parser.parse_args()
+
+  try:
+    finput = open(args.input_file)
+    foutput = open(args.output_file,"a")
+  except IOError:
+    sys.exit()
+
+  report = None
+  with finput:
+    line = finput.readline()
+    # Bloaty.cmake writes the options bloaty ran with before its output
+    if line.startswith('bloaty with options'):
+      line = finput.readline()
+    if is_csv(line):
+      report = to_json(read_csv(_prepend(line, finput)))
+      result = format_size(report['total']['vmsize'])
+    else:
+      finput.seek(0)
+      result = read_table_total(finput)
 
-  result = last_line[start:end].strip()
   message = "{} {}\n".format(args.message, result)
   foutput.write(message)
-finput.close()
-foutput.close()
+  foutput.close()
+
+  if report is None:
+    if args.json or args.baseline or args.budget:
+      print('Error: --json, --baseline and --budget need Bloaty CSV output as input', file=sys.stderr)
+      sys.exit(1)
+    return
+
+  if args.baseline:
+    with open(args.baseline) as fbaseline:
+      report_diff = diff(report, json.load(fbaseline), args.top)
+    print_diff(report_diff)
+  if args.json:
+    write_json(args.json, report)
+
+  exceeded = check_budgets(report, args.budget)
+  if exceeded:
+    for section, size, budget in exceeded:
+      print('Error: section {} is {} bytes, exceeding its budget of {} bytes'.format(section, size, budget), file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
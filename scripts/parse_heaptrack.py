@@ -15,8 +15,13 @@
 # This script uses a file generated by the profiling tool Heaptrack as input
 # and writes the peak heap memory consumption into a log file.
 #
-# Heaptrack comes with a tool called heaptrack_print which is used to analyze
-# the collected data and print the result.
+# The Heaptrack file is read directly, in a single streaming pass, which
+# computes the peak heap memory consumption, the peak RSS, the number of calls
+# to allocation functions and the number of temporary allocations. Traces
+# compressed with gzip or zstd (which needs the `zstandard` module or the
+# `zstd` program) are supported, independent of the file extension. Files in
+# a format the reader does not recognize are analyzed with heaptrack_print,
+# the tool which comes with Heaptrack, instead.
 #
 # USAGE
 #
@@ -29,46 +34,438 @@
 # * -i, --input_file:  Sets the input file path.
 # * -o, --output_file: Sets the output file path.
 # * -m, --message:     Adds a message to the reported memory usage.
+# * -r, --report:      Writes an extended report next to the input file, in the
+#                      same pass. `<input_file>.json` holds the totals, the
+#                      heap and RSS over time and the top allocation sites by
+#                      their contribution to the peak and by number of
+#                      allocations, with symbolized stacks and their temporary
+#                      allocations. `<input_file>.csv` holds the time series.
+# * --top:             Number of allocation sites in each ranking of the
+#                      report. [Default: 20]
+# * --points:          Maximum number of points of the time series, samples are
+#                      merged into coarser intervals keeping the maximum.
+#                      [Default: 1000]
 #
+from __future__ import print_function
+
 import argparse
+import gzip
+import io
+import json
+import os
 import re
+import shutil
 import subprocess
 import sys
-
-parser = argparse.ArgumentParser(description='Log peak heap memory consumption reported by Heaptrack.')
-optional = parser._action_groups.pop()
-required = parser.add_argument_group('required arguments')
-required.add_argument('-i','--input_file',
-                      help='File path where a Heaptrack file is located',
-                      required=True)
-required.add_argument('-o','--output_file',
-                      help='File path where the log should be created',
-                      required=True)
-optional.add_argument('-m','--message',
-                      help='Custom message that gets concatenated with the reported memory usage',
-                      default='Heap memory usage:')
-parser._action_groups.append(optional)
-args = parser.parse_args()
+import tempfile
 
 try:
-  foutput = open(args.output_file,"a")
-except IOError:
-  sys.exit()
-
-p_heaptrack_print = subprocess.Popen(['which', 'heaptrack_print'], stdout=subprocess.PIPE)
-program_path = p_heaptrack_print.stdout.read().rstrip()
-p_heaptrack_print.terminate()
-
-p = subprocess.Popen([program_path, args.input_file], stdout=subprocess.PIPE)
-text = []
-for line in p.stdout:
-  text.append(line)
-for string in reversed(text):
-  if "peak heap memory consumption" in string:
-    m = re.search('\d',string)
-    result = string[m.start():].strip()
+  import zstandard
+except ImportError:
+  zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# file format versions written by heaptrack_interpret which the reader
+# understands, older versions have no allocation info ('a') records
+SUPPORTED_FILE_VERSIONS = (1, 2, 3)
+
+
+class UnsupportedFormat(Exception):
+  pass
+
+
+def find_program(name):
+  """Returns the path of a program on the PATH, or None."""
+  # shutil.which is not available in Python 2, which runs this script on
+  # hosts where `python` is Python 2.
+  if hasattr(shutil, 'which'):
+    return shutil.which(name)
+  from distutils.spawn import find_executable
+  return find_executable(name)
+
+
+def open_trace(path):
+  """Opens a Heaptrack file for reading text, decompressing it as needed."""
+  with open(path, 'rb') as f:
+    magic = f.read(4)
+  if magic.startswith(GZIP_MAGIC):
+    # GzipFile has no read1() in Python 2, which TextIOWrapper needs.
+    return io.TextIOWrapper(io.BufferedReader(gzip.open(path, 'rb')), encoding='utf-8', errors='replace')
+  if magic.startswith(ZSTD_MAGIC):
+    if zstandard is not None:
+      reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+      return io.TextIOWrapper(io.BufferedReader(reader), encoding='utf-8', errors='replace')
+    if find_program('zstd') is None:
+      raise UnsupportedFormat('zstd compressed, but neither the zstandard module nor zstd is available')
+    process = subprocess.Popen(['zstd', '-dcq', path], stdout=subprocess.PIPE)
+    # The pipe is a plain file object in Python 2, which io can't wrap.
+    return io.open(process.stdout.fileno(), 'r', encoding='utf-8', errors='replace', closefd=False)
+  return io.open(path, 'r', encoding='utf-8', errors='replace')
+
+
+class HeaptrackReader(object):
+  """Accumulates the totals of a Heaptrack file line by line.
+
+  Memory use only depends on the number of distinct allocation infos (size
+  and trace pairs) in the file, not on the number of allocations. The totals
+  follow heaptrack_print: an allocation is temporary if it is freed before
+  any other allocation happens.
+  """
+
+  def __init__(self):
+    self.file_version = None
+    self.page_size = 1
+    self.allocation_sizes = [0]
+    self.last_allocation = 0
+    self.timestamp = 0
+    self.leaked = 0
+    self.peak_heap = 0
+    self.peak_time = 0
+    self.peak_rss = 0
+    self.allocations = 0
+    self.temporary = 0
+
+  def read(self, lines):
+    for line in lines:
+      mode = line[:1]
+      if mode == '+':
+        self.allocate(int(line[2:], 16))
+      elif mode == '-':
+        self.deallocate(int(line[2:], 16))
+      elif mode == 'a':
+        if self.file_version is None:
+          raise UnsupportedFormat('missing version record')
+        size, trace = line[2:].split()
+        self.add_allocation_info(int(size, 16), int(trace, 16))
+      elif mode == 'c':
+        self.timestamp = int(line[2:], 16)
+      elif mode == 'R':
+        self.peak_rss = max(self.peak_rss, int(line[2:], 16))
+      elif mode == 'v':
+        fields = line.split()
+        self.file_version = int(fields[2], 16) if len(fields) > 2 else 0
+        if self.file_version not in SUPPORTED_FILE_VERSIONS:
+          raise UnsupportedFormat('file format version {}'.format(self.file_version))
+      elif mode == 'I':
+        self.page_size = int(line.split()[1], 16)
+      elif mode in ('s', 't', 'i', 'm', 'X', 'A', '#', '\n', ''):
+        self.read_other(mode, line)
+      else:
+        raise UnsupportedFormat('unknown record {!r}'.format(line[:20]))
+
+  def read_other(self, mode, line):
+    pass
+
+  def add_allocation_info(self, size, trace):
+    self.allocation_sizes.append(size)
+
+  def allocate(self, index):
+    self.allocations += 1
+    self.leaked += self.allocation_sizes[index]
+    if self.leaked > self.peak_heap:
+      self.peak_heap = self.leaked
+      self.peak_time = self.timestamp
+    self.last_allocation = index
+
+  def deallocate(self, index):
+    if index == self.last_allocation:
+      self.temporary += 1
+    self.last_allocation = 0
+    self.leaked -= self.allocation_sizes[index]
+
+  def summary(self):
+    return {'peak_heap': self.peak_heap,
+            'peak_time': self.peak_time / 1000.0,
+            'peak_rss': self.peak_rss * self.page_size,
+            'allocations': self.allocations,
+            'temporary': self.temporary,
+            'leaked': self.leaked,
+            'total_time': self.timestamp / 1000.0}
+
+
+class HeaptrackReport(HeaptrackReader):
+  """Also accumulates per allocation site costs and heap usage over time.
+
+  An allocation site is a trace. The contribution of a site to the peak is
+  its live memory at the time of the global peak, which is tracked in one
+  pass by saving the live memory of a site the first time it changes after
+  a new peak was reached.
+  """
+
+  def __init__(self, max_points=1000):
+    HeaptrackReader.__init__(self)
+    self.max_points = max_points
+    self.strings = [None]
+    self.instruction_pointers = [None]
+    self.traces = [None]
+    self.allocation_traces = [0]
+    self.live = [0]
+    self.at_peak = [0]
+    self.touched = [0]
+    self.site_allocations = [0]
+    self.site_temporary = [0]
+    self.peak_version = 0
+    self.interval = 10
+    self.series = []
+    self.interval_heap = 0
+    self.interval_rss = 0
+    self.rss = 0
+
+  def read_other(self, mode, line):
+    if mode == 's':
+      if self.file_version >= 3:
+        _, length, rest = line.split(' ', 2)
+        self.strings.append(rest[:int(length, 16)])
+      else:
+        self.strings.append(line[2:].rstrip('\n'))
+    elif mode == 't':
+      ip, parent = line[2:].split()
+      self.traces.append((int(ip, 16), int(parent, 16)))
+      for costs in (self.live, self.at_peak, self.touched, self.site_allocations, self.site_temporary):
+        costs.append(0)
+    elif mode == 'i':
+      fields = [int(field, 16) for field in line[2:].split()]
+      self.instruction_pointers.append(fields)
+
+  def add_allocation_info(self, size, trace):
+    HeaptrackReader.add_allocation_info(self, size, trace)
+    self.allocation_traces.append(trace)
+
+  def update_site(self, site, delta):
+    if self.touched[site] != self.peak_version:
+      # unchanged since the last peak, its live memory is still the peak one
+      self.at_peak[site] = self.live[site]
+      self.touched[site] = self.peak_version
+    self.live[site] += delta
+
+  def allocate(self, index):
+    site = self.allocation_traces[index]
+    self.update_site(site, self.allocation_sizes[index])
+    self.site_allocations[site] += 1
+    peak_heap = self.peak_heap
+    HeaptrackReader.allocate(self, index)
+    if self.peak_heap > peak_heap:
+      self.peak_version += 1
+    self.interval_heap = max(self.interval_heap, self.leaked)
+
+  def deallocate(self, index):
+    site = self.allocation_traces[index]
+    if index == self.last_allocation:
+      self.site_temporary[site] += 1
+    self.update_site(site, -self.allocation_sizes[index])
+    HeaptrackReader.deallocate(self, index)
+
+  def read(self, lines):
+    for line in lines:
+      if line[:1] == 'c':
+        self.add_sample(int(line[2:], 16))
+      elif line[:1] == 'R':
+        self.rss = int(line[2:], 16)
+        self.interval_rss = max(self.interval_rss, self.rss)
+      HeaptrackReader.read(self, (line,))
+
+  def add_sample(self, timestamp):
+    """Closes the interval up to timestamp, keeping at most max_points."""
+    start = timestamp - timestamp % self.interval
+    if self.series and self.series[-1][0] == start:
+      sample = self.series[-1]
+      sample[1] = max(sample[1], self.interval_heap)
+      sample[2] = max(sample[2], self.interval_rss)
+    else:
+      self.series.append([start, self.interval_heap, self.interval_rss])
+    self.interval_heap = self.leaked
+    self.interval_rss = self.rss
+    if len(self.series) > self.max_points:
+      self.interval *= 2
+      merged = []
+      for start, heap, rss in self.series:
+        start -= start % self.interval
+        if merged and merged[-1][0] == start:
+          merged[-1][1] = max(merged[-1][1], heap)
+          merged[-1][2] = max(merged[-1][2], rss)
+        else:
+          merged.append([start, heap, rss])
+      self.series = merged
+
+  def get_string(self, index):
+    if 0 < index < len(self.strings):
+      return self.strings[index]
+    return None
+
+  def get_frames(self, ip):
+    """Returns the symbolized frames of an instruction pointer, innermost first."""
+    fields = self.instruction_pointers[ip]
+    address, module, rest = fields[0], fields[1], fields[2:]
+    frames = []
+    if rest:
+      frame = {'function': self.get_string(rest[0])}
+      if len(rest) >= 3:
+        frame['file'] = self.get_string(rest[1])
+        frame['line'] = rest[2]
+      frames.append(frame)
+      # the remaining fields are inlined function, file and line triples
+      for i in range(3, len(rest) - 2, 3):
+        frames.append({'function': self.get_string(rest[i]), 'file': self.get_string(rest[i + 1]),
+                       'line': rest[i + 2], 'inlined': True})
+    else:
+      frames.append({'function': None})
+    for frame in frames:
+      frame['address'] = '0x{:x}'.format(address)
+      frame['module'] = self.get_string(module)
+    return frames
+
+  def get_stack(self, site, max_frames=32):
+    stack = []
+    while site and len(stack) < max_frames:
+      ip, site = self.traces[site]
+      stack.extend(self.get_frames(ip))
+    return stack
+
+  def get_site(self, site):
+    return {'peak': self.get_peak_contribution(site),
+            'allocations': self.site_allocations[site],
+            'temporary': self.site_temporary[site],
+            'leaked': self.live[site],
+            'stack': self.get_stack(site)}
+
+  def get_peak_contribution(self, site):
+    if self.touched[site] != self.peak_version:
+      return self.live[site]
+    return self.at_peak[site]
+
+  def report(self, top):
+    sites = range(1, len(self.traces))
+    by_peak = sorted(sites, key=lambda site: (-self.get_peak_contribution(site), site))[:top]
+    by_allocations = sorted(sites, key=lambda site: (-self.site_allocations[site], site))[:top]
+    self.add_sample(self.timestamp + self.interval)
+    return {'summary': self.summary(),
+            'series': {'interval': self.interval / 1000.0,
+                       'points': [{'time': start / 1000.0, 'heap': heap, 'rss': rss * self.page_size}
+                                  for start, heap, rss in self.series]},
+            'top_sites': {'peak': [self.get_site(site) for site in by_peak if self.get_peak_contribution(site) > 0],
+                          'allocations': [self.get_site(site) for site in by_allocations
+                                          if self.site_allocations[site] > 0]}}
+
+
+def write_atomically(path, write):
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'w') as f:
+      write(f)
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+  except BaseException:
+    os.remove(tmp_path)
+    raise
+
+
+def write_report(path, report):
+  """Writes the report as <path>.json and its time series as <path>.csv."""
+  def write_json(f):
+    json.dump(report, f, indent=2)
+    f.write('\n')
+
+  def write_csv(f):
+    f.write('time,heap,rss\n')
+    for point in report['series']['points']:
+      f.write('{:.3f},{},{}\n'.format(point['time'], point['heap'], point['rss']))
+
+  write_atomically(path + '.json', write_json)
+  write_atomically(path + '.csv', write_csv)
+
+
+def read_heaptrack(path, reader=None):
+  reader = reader or HeaptrackReader()
+  try:
+    with open_trace(path) as lines:
+      reader.read(lines)
+  except (ValueError, IndexError, EOFError, OSError) as e:
+    if isinstance(e, IOError) and e.errno is not None:
+      raise
+    raise UnsupportedFormat(str(e))
+  return reader
+
+
+def format_bytes(size):
+  """Formats a byte count like heaptrack_print does."""
+  units = ['B', 'K', 'M', 'G', 'T', 'P']
+  value = float(size)
+  unit = 0
+  while unit < len(units) - 1 and abs(value) > 1000.0:
+    value /= 1000.0
+    unit += 1
+  if unit == 0:
+    return '{}B'.format(size)
+  return '{:.2f}{}'.format(value, units[unit])
+
+
+def get_peak_from_heaptrack_print(path):
+  """Returns the peak heap memory consumption reported by heaptrack_print."""
+  program_path = find_program('heaptrack_print')
+  if program_path is None:
+    return None
+  p = subprocess.Popen([program_path, path], stdout=subprocess.PIPE, universal_newlines=True)
+  result = None
+  for string in p.stdout:
+    if "peak heap memory consumption" in string:
+      m = re.search(r'\d',string)
+      result = string[m.start():].strip()
+  p.wait()
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Log peak heap memory consumption reported by Heaptrack.')
+  optional = parser._action_groups.pop()
+  required = parser.add_argument_group('required arguments')
+  required.add_argument('-i','--input_file',
+                        help='File path where a Heaptrack file is located',
+                        required=True)
+  required.add_argument('-o','--output_file',
+                        help='File path where the log should be created',
+                        required=True)
+  optional.add_argument('-m','--message',
+                        help='Custom message that gets concatenated with the reported memory usage',
+                        default='Heap memory usage:')
+  optional.add_argument('-r','--report',
+                        help='Write an extended report with the heap usage over time and the top allocation sites next to the input file',
+                        action='store_true')
+  optional.add_argument('--top',
+                        help='Number of allocation sites in each ranking of the report',
+                        type=int, default=20)
+  optional.add_argument('--points',
+                        help='Maximum number of points of the heap usage over time',
+                        type=int, default=1000)
+  parser._action_groups.append(optional)
+  args = parser.parse_args()
+
+  try:
+    foutput = open(args.output_file,"a")
+  except IOError:
+    sys.exit()
+
+  try:
+    reader = read_heaptrack(args.input_file, HeaptrackReport(args.points) if args.report else None)
+    summary = reader.summary()
+    # Same format as the line of heaptrack_print which used to be logged.
+    result = '{} after {:.3f}s'.format(format_bytes(summary['peak_heap']), summary['peak_time'])
+    print('peak heap memory consumption: {}'.format(result))
+    print('peak RSS (including heaptrack overhead): {}'.format(format_bytes(summary['peak_rss'])))
+    print('calls to allocation functions: {}'.format(summary['allocations']))
+    print('temporary memory allocations: {}'.format(summary['temporary']))
+    if args.report:
+      write_report(args.input_file, reader.report(args.top))
+  except UnsupportedFormat as e:
+    print('Unsupported Heaptrack file ({}), falling back to heaptrack_print'.format(e), file=sys.stderr)
+    result = get_peak_from_heaptrack_print(args.input_file)
+
+  if result is not None:
     message = "{} {}\n".format(args.message, result)
     foutput.write(message)
-    break
-foutput.close()
-p.terminate()
+  foutput.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -15,6 +15,14 @@
 # and writes the sum of the maximal used stack for all active threads into a
 # log file.
 #
+# A structured JSON report can be written as well. It lists, for every
+# thread, the maximal used stack, the stack size and the utilization, the
+# totals per process and the threads closest to overflowing their stack. The
+# report can be compared against a baseline report, which fails if the
+# maximal used stack of a thread grew by more than a threshold. Threads are
+# matched by name and their index within the process, as process and thread
+# ids differ between runs.
+#
 # USAGE
 #
 #   python parse_stackusage.py [OPTIONS]
@@ -26,41 +34,151 @@
 # * -i, --input_file:  Sets the input file path.
 # * -o, --output_file: Sets the output file path.
 # * -m, --message:     Adds a message to the reported memory usage.
+# * -r, --report:      Writes a JSON report to the given file path.
+# * -b, --baseline:    Compares against a JSON report written by an earlier
+#                      run, exits with an error if a thread's maximal used
+#                      stack grew by more than the threshold.
+# * -t, --threshold:   Allowed growth of a thread's maximal used stack in
+#                      percent. [Default: 10]
+# * --top:             Number of threads listed as closest to overflow.
+#                      [Default: 10]
 #
+from __future__ import print_function
+
 import argparse
+import json
 import sys
 
-parser = argparse.ArgumentParser(description='Log sum of the maximal used stack for all active threads reported by Stackusage.')
-optional = parser._action_groups.pop()
-required = parser.add_argument_group('required arguments')
-required.add_argument('-i','--input_file',
-                      help='File path where a Stackusage file is located',
-                      required=True)
-required.add_argument('-o','--output_file',
-                      help='File path where the log should be created',
-                      required=True)
-optional.add_argument('-m','--message',
-                      help='Custom message that gets concatenated with the reported memory usage',
-                      default='Stack memory usage:')
-parser._action_groups.append(optional)
-args = parser.parse_args()
-
-try:
-  finput = open(args.input_file)
-  foutput = open(args.output_file,"a")
-except IOError:
-  sys.exit()
-
-with finput:
-  lines = finput.readlines()
-  total_stack = 0.0
-  for line in lines:
-    if any(s in line for s in ('stackusage', 'pid')):
+# columns of a Stackusage log line
+COLUMNS = ('pid', 'id', 'tid', 'requested', 'actual', 'maxuse', 'max%', 'dur', 'funcP')
+
+
+def parse_threads(finput):
+  """Yields a dict per thread line of a Stackusage log."""
+  for line in finput:
+    columns = line.split(None, len(COLUMNS))
+    # skips the "stackusage log at ..." and "pid id tid ..." header lines
+    if len(columns) < len(COLUMNS) or not columns[0].isdigit():
+      continue
+    yield {'pid': int(columns[0]),
+           'id': int(columns[1]),
+           'tid': int(columns[2]),
+           'stack_size': int(columns[4]),
+           'max_use': int(columns[5]),
+           'name': columns[len(COLUMNS)].strip() if len(columns) > len(COLUMNS) else ''}
+
+
+def get_utilization(max_use, stack_size):
+  return round(100.0 * max_use / stack_size, 2) if stack_size else 0.0
+
+
+def get_thread_key(thread):
+  return '{}#{}'.format(thread['name'], thread['id'])
+
+
+def build_report(threads, top):
+  processes = {}
+  for thread in threads:
+    thread['utilization'] = get_utilization(thread['max_use'], thread['stack_size'])
+    process = processes.setdefault(thread['pid'], {'pid': thread['pid'], 'threads': 0, 'max_use': 0, 'stack_size': 0})
+    process['threads'] += 1
+    process['max_use'] += thread['max_use']
+    process['stack_size'] += thread['stack_size']
+  for process in processes.values():
+    process['utilization'] = get_utilization(process['max_use'], process['stack_size'])
+  closest = sorted(threads, key=lambda thread: (-thread['utilization'], thread['pid'], thread['id']))[:top]
+  return {'total': {'threads': len(threads),
+                    'max_use': sum(thread['max_use'] for thread in threads),
+                    'stack_size': sum(thread['stack_size'] for thread in threads)},
+          'processes': [processes[pid] for pid in sorted(processes)],
+          'threads': threads,
+          'closest_to_overflow': [{'pid': thread['pid'], 'id': thread['id'], 'name': thread['name'],
+                                   'max_use': thread['max_use'], 'stack_size': thread['stack_size'],
+                                   'utilization': thread['utilization']} for thread in closest]}
+
+
+def compare(report, baseline, threshold):
+  """Returns the threads whose maximal used stack grew above the threshold.
+
+  A thread appearing in several processes is compared by its largest use.
+  Threads which are not in the baseline are not reported.
+  """
+  def max_use_by_key(threads):
+    result = {}
+    for thread in threads:
+      key = get_thread_key(thread)
+      result[key] = max(result.get(key, 0), thread['max_use'])
+    return result
+
+  current = max_use_by_key(report['threads'])
+  previous = max_use_by_key(baseline['threads'])
+  grown = []
+  for key in sorted(current):
+    if key not in previous:
       continue
-    columns = line.split()
-    total_stack = total_stack + int(columns[5])
-    result = "{:.{}f}".format(total_stack / 1024 / 1024, 2) + "Mi"
+    growth = current[key] - previous[key]
+    limit = previous[key] * threshold / 100.0
+    if growth > limit:
+      grown.append((key, previous[key], current[key]))
+  return grown
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Log sum of the maximal used stack for all active threads reported by Stackusage.')
+  optional = parser._action_groups.pop()
+  required = parser.add_argument_group('required arguments')
+  required.add_argument('-i','--input_file',
+                        help='File path where a Stackusage file is located',
+                        required=True)
+  required.add_argument('-o','--output_file',
+                        help='File path where the log should be created',
+                        required=True)
+  optional.add_argument('-m','--message',
+                        help='Custom message that gets concatenated with the reported memory usage',
+                        default='Stack memory usage:')
+  optional.add_argument('-r','--report',
+                        help='File path where a JSON report should be written')
+  optional.add_argument('-b','--baseline',
+                        help='JSON report of an earlier run to compare the maximal used stack per thread against')
+  optional.add_argument('-t','--threshold',
+                        help='Allowed growth in percent of the maximal used stack of a thread compared to the baseline',
+                        type=float, default=10.0)
+  optional.add_argument('--top',
+                        help='Number of threads listed as closest to overflow in the report',
+                        type=int, default=10)
+  parser._action_groups.append(optional)
+  args = parser.parse_args()
+
+  try:
+    finput = open(args.input_file)
+    foutput = open(args.output_file,"a")
+  except IOError:
+    sys.exit()
+
+  with finput:
+    threads = list(parse_threads(finput))
+  report = build_report(threads, args.top)
+
+  result = "{:.{}f}".format(report['total']['max_use'] / 1024.0 / 1024.0, 2) + "Mi"
   message = "{} {}\n".format(args.message, result)
   foutput.write(message)
-finput.close()
-foutput.close()
+  foutput.close()
+
+  if args.report:
+    with open(args.report, 'w') as freport:
+      json.dump(report, freport, indent=2)
+      freport.write('\n')
+
+  if args.baseline:
+    with open(args.baseline) as fbaseline:
+      baseline = json.load(fbaseline)
+    grown = compare(report, baseline, args.threshold)
+    if grown:
+      print('Stack usage grew by more than {}% compared to {}:'.format(args.threshold, args.baseline), file=sys.stderr)
+      for key, previous, current in grown:
+        print('  {}: {} -> {} bytes'.format(key, previous, current), file=sys.stderr)
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
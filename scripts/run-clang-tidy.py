@@ -7,7 +7,6 @@
 # SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
 #
 #===-----------------------------------------------------------------------===#
-# FIXME: Integrate with clang-tidy-diff.py
 
 
 """
@@ -30,6 +29,29 @@ Example invocations.
    run-clang-tidy.py -fix -checks=-*,llvm-header-guard extra/clang-tidy \
                      -header-filter=extra/clang-tidy
 
+- Only lint the lines changed since master, in the translation units that
+ contain them or include a changed header.
+   run-clang-tidy.py -diff-base=master
+
+- Split a run across two CI nodes and combine the results afterwards.
+   run-clang-tidy.py -shard-index=0 -shard-count=2 -bundle=shard-0
+   run-clang-tidy.py -shard-index=1 -shard-count=2 -bundle=shard-1
+   run-clang-tidy.py merge -export-fixes=fixes.yaml \
+                     -export-diagnostics=diagnostics.jsonl shard-0 shard-1
+
+- Reuse precompiled headers for the leading includes shared by files with
+ identical flags, and report how much time that saved.
+   run-clang-tidy.py -pch -pch-compare
+
+- Export fixes and a JSON lines stream of all diagnostics from a single run,
+ e.g. to feed clang_tidy_ratchet.py without running clang-tidy again.
+   run-clang-tidy.py -export-fixes=fixes.yaml \
+                     -export-diagnostics=diagnostics.jsonl
+
+- Reuse results from previous runs for translation units whose preprocessed
+ source, flags, clang-tidy version and configuration have not changed.
+   run-clang-tidy.py -cache-dir=$HOME/.cache/clang-tidy -cache-size=5G
+
 Compilation database setup:
 http://clang.llvm.org/docs/HowToSetupToolingForLLVM.html
 """
@@ -38,15 +60,19 @@ from __future__ import print_function
 
 import argparse
 import glob
+import hashlib
+import heapq
 import json
 import multiprocessing
 import os
 import re
+import shlex
 import shutil
 import subprocess
 import sys
 import tempfile
 import threading
+import time
 import traceback
 
 try:
@@ -54,12 +80,19 @@ try:
 except ImportError:
  yaml = None
 
+if yaml:
+ # The libyaml based loader and dumper are much faster when available.
+ YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+ YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 is_py2 = sys.version[0] == '2'
 
 if is_py2:
    import Queue as queue
+   from urllib import pathname2url
 else:
    import queue as queue
+   from urllib.request import pathname2url
 
 
 def find_compilation_database(path):
@@ -113,32 +146,1038 @@ def get_tidy_invocation(f, clang_tidy_binary, checks, tmpdir, build_path,
  return start
 
 
+def get_export_fixes_file(invocation):
+ """Returns the -export-fixes target of a clang-tidy invocation, if any."""
+ if '-export-fixes' in invocation:
+   return invocation[invocation.index('-export-fixes') + 1]
+ return None
+
+
+def get_compile_arguments(entry):
+ """Returns the compiler command line of a compilation database entry."""
+ if 'arguments' in entry:
+   return list(entry['arguments'])
+ return shlex.split(entry['command'])
+
+
+# Compiler flags which either name an output file or only produce dependency
+# information. They have no effect on what clang-tidy sees, and have to be
+# dropped so that preprocessing does not clobber build artifacts.
+_OUTPUT_FLAGS_WITH_VALUE = ('-o', '-MF', '-MT', '-MQ')
+_OUTPUT_FLAGS = ('-c', '-M', '-MM', '-MD', '-MMD', '-MP')
+
+
+def get_preprocess_invocation(entry):
+ """Turns a compilation database entry into a preprocessor-only command."""
+ arguments = get_compile_arguments(entry)
+ result = [arguments[0]]
+ skip = False
+ for arg in arguments[1:]:
+   if skip:
+     skip = False
+     continue
+   if arg in _OUTPUT_FLAGS_WITH_VALUE:
+     skip = True
+     continue
+   if arg in _OUTPUT_FLAGS or arg.startswith(_OUTPUT_FLAGS_WITH_VALUE):
+     continue
+   result.append(arg)
+ result.append('-E')
+ return result
+
+
+def get_dependency_invocation(entry):
+ """Turns a compilation database entry into a command listing its includes."""
+ return get_preprocess_invocation(entry)[:-1] + ['-M']
+
+
+def parse_dependencies(output):
+ """Returns the prerequisites of the make rule printed by the compiler."""
+ text = output.replace('\\\n', ' ').replace('\\\r\n', ' ')
+ found = re.search(r':(?:\s|$)', text)
+ if not found:
+   return []
+ prerequisites = []
+ for token in re.findall(r'(?:\\.|[^\s\\])+', text[found.end():]):
+   prerequisites.append(re.sub(r'\\(.)', r'\1', token).replace('$$', '$'))
+ return prerequisites
+
+
+def get_changed_lines(diff_base):
+ """Returns the lines changed in the working tree since a git revision.
+
+ The result maps absolute file paths to lists of inclusive [first, last]
+ line ranges, the format expected by clang-tidy's -line-filter. Files which
+ only had lines removed are not included.
+ """
+ toplevel = subprocess.check_output(
+     ['git', 'rev-parse', '--show-toplevel']).decode('utf-8').strip()
+ diff = subprocess.check_output(
+     ['git', 'diff', '-U0', '--no-color', '--no-ext-diff', diff_base, '--'],
+     cwd=toplevel).decode('utf-8', 'replace')
+ changed = {}
+ filename = None
+ for line in diff.splitlines():
+   found = re.match(r'^\+\+\+ (?:b/)?(.*)', line)
+   if found:
+     filename = found.group(1)
+     if filename == '/dev/null':
+       filename = None
+     else:
+       filename = os.path.normpath(os.path.join(toplevel, filename))
+     continue
+   found = re.match(r'^@@ -[0-9,]+ \+([0-9]+)(?:,([0-9]+))? @@', line)
+   if found and filename is not None:
+     first = int(found.group(1))
+     count = int(found.group(2)) if found.group(2) is not None else 1
+     if count > 0:
+       changed.setdefault(filename, []).append([first, first + count - 1])
+ return changed
+
+
+INCLUDE_RE = re.compile(r'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"]+)[>"]',
+                        re.MULTILINE)
+
+
+def get_include_dirs(entry):
+ """Returns the quote and angle bracket include search paths of an entry."""
+ arguments = get_compile_arguments(entry)
+ quote_dirs = []
+ angle_dirs = []
+ i = 0
+ while i < len(arguments):
+   arg = arguments[i]
+   for flag, dirs in (('-iquote', quote_dirs), ('-isystem', angle_dirs),
+                      ('-idirafter', angle_dirs), ('-I', angle_dirs)):
+     if arg.startswith(flag):
+       value = arg[len(flag):]
+       if not value and i + 1 < len(arguments):
+         i += 1
+         value = arguments[i]
+       dirs.append(make_absolute(value, entry['directory']))
+       break
+   i += 1
+ return quote_dirs, angle_dirs
+
+
+class IncludeScanner(object):
+ """Conservatively finds the files a translation unit includes.
+
+ Includes are discovered with a regular expression and resolved against the
+ search paths of the compile command, ignoring the preprocessor state. This
+ may report headers which are not actually included, but is much cheaper
+ than preprocessing every translation unit.
+ """
+
+ def __init__(self):
+   self.direct_includes = {}
+
+ def get_direct_includes(self, name):
+   if name not in self.direct_includes:
+     try:
+       with open(name, 'rb') as f:
+         content = f.read().decode('utf-8', 'replace')
+       self.direct_includes[name] = INCLUDE_RE.findall(content)
+     except (IOError, OSError):
+       self.direct_includes[name] = []
+   return self.direct_includes[name]
+
+ def resolve(self, including, kind, header, quote_dirs, angle_dirs):
+   search = angle_dirs
+   if kind == '"':
+     search = [os.path.dirname(including)] + quote_dirs + angle_dirs
+   for directory in search:
+     candidate = os.path.normpath(os.path.join(directory, header))
+     if os.path.isfile(candidate):
+       return candidate
+   return None
+
+ def get_includes(self, entry, name):
+   """Returns all files transitively included by a translation unit."""
+   quote_dirs, angle_dirs = get_include_dirs(entry)
+   seen = set([name])
+   pending = [name]
+   while pending:
+     current = pending.pop()
+     for kind, header in self.get_direct_includes(current):
+       resolved = self.resolve(current, kind, header, quote_dirs, angle_dirs)
+       if resolved is None or resolved in seen:
+         continue
+       seen.add(resolved)
+       pending.append(resolved)
+   seen.discard(name)
+   return seen
+
+ def includes_any(self, entry, name, targets):
+   """Checks whether a translation unit includes any of the given files."""
+   return not self.get_includes(entry, name).isdisjoint(targets)
+
+
+def get_diff_files(files, entries, changed_lines):
+ """Returns the translation units affected by the changed lines."""
+ changed_headers = set(name for name in changed_lines if name not in entries)
+ scanner = IncludeScanner()
+ result = []
+ for name in files:
+   if name in changed_lines:
+     result.append(name)
+   elif changed_headers and scanner.includes_any(entries[name], name,
+                                                 changed_headers):
+     result.append(name)
+ return result
+
+
+def get_group_flags(entry, name):
+ """Returns the flags of an entry without its outputs and source file."""
+ arguments = get_preprocess_invocation(entry)[:-1]
+ return [arg for arg in arguments[1:]
+         if make_absolute(arg, entry['directory']) != name]
+
+
+# Lines which may appear between the leading includes of a source file.
+_PREAMBLE_SKIP_RE = re.compile(r'^\s*(//.*|#\s*pragma\s+once\s*)?$')
+
+
+def get_leading_includes(name, entry, scanner):
+ """Returns the resolved paths of the includes a source file starts with."""
+ quote_dirs, angle_dirs = get_include_dirs(entry)
+ result = []
+ in_comment = False
+ try:
+   with open(name, 'rb') as f:
+     for line in f:
+       line = line.decode('utf-8', 'replace')
+       if in_comment:
+         if '*/' in line:
+           in_comment = False
+           line = line[line.index('*/') + 2:]
+         else:
+           continue
+       stripped = line.strip()
+       if stripped.startswith('/*'):
+         if '*/' not in stripped:
+           in_comment = True
+         continue
+       if _PREAMBLE_SKIP_RE.match(line):
+         continue
+       found = INCLUDE_RE.match(line)
+       if not found:
+         break
+       resolved = scanner.resolve(name, found.group(1), found.group(2),
+                                  quote_dirs, angle_dirs)
+       if resolved is None:
+         break
+       result.append(resolved)
+ except (IOError, OSError):
+   pass
+ return tuple(result)
+
+
+# Errors of clang when a PCH does not match the translation unit, e.g.
+#   fatal error: file 'a.h' has been modified since the precompiled header
+#   'pch-0.h.pch' was built
+#   error: PCH file was compiled for the target 'x' but ...
+PCH_REJECTED_RE = re.compile(rb'PCH file|precompiled header|AST file')
+
+
+class PrecompiledHeaders(object):
+ """Builds and hands out precompiled headers for groups of files.
+
+ Files are grouped by identical flags. Within each group, the sequence of
+ leading includes covering the most include directives across files is
+ compiled into a PCH, which clang-tidy loads with -include-pch instead of
+ parsing those headers again for every file. The PCH has to be built by
+ the clang that clang-tidy is based on.
+
+ Checks built on preprocessor callbacks, such as llvm-include-order,
+ llvm-header-guard, readability-duplicate-include or
+ cppcoreguidelines-macro-usage, do not see the headers loaded from the PCH
+ and miss their findings in them. Run them without -pch.
+ """
+
+ def __init__(self, clang_binary, directory, min_files):
+   self.clang_binary = clang_binary
+   self.directory = directory
+   self.min_files = min_files
+   self.groups = []
+   self.assignments = {}
+   self.lock = threading.Lock()
+
+ def plan(self, files, entries):
+   scanner = IncludeScanner()
+   by_flags = {}
+   for name in files:
+     entry = entries[name]
+     flags = get_group_flags(entry, name)
+     language = 'c-header' if name.endswith('.c') else 'c++-header'
+     key = json.dumps([entry['directory'], language, flags])
+     by_flags.setdefault(key, []).append(
+         (name, get_leading_includes(name, entry, scanner)))
+
+   for key, members in sorted(by_flags.items()):
+     directory, language, flags = json.loads(key)
+     # Pick the include prefix which saves the most include directives,
+     # i.e. the longest prefix weighted by the number of files sharing it.
+     counts = {}
+     for _, includes in members:
+       for length in range(1, len(includes) + 1):
+         prefix = includes[:length]
+         counts[prefix] = counts.get(prefix, 0) + 1
+     candidates = [(len(prefix) * count, prefix)
+                   for prefix, count in counts.items()
+                   if count >= self.min_files]
+     if not candidates:
+       continue
+     _, prefix = max(candidates)
+     group = {'directory': directory, 'language': language, 'flags': flags,
+              'includes': prefix, 'pch': None, 'valid': False,
+              'build_time': 0.0, 'files': [], 'plain_time': 0.0,
+              'pch_time': 0.0, 'compared': 0, 'fallbacks': 0}
+     for name, includes in members:
+       if includes[:len(prefix)] == prefix:
+         group['files'].append(name)
+         self.assignments[name] = group
+     self.groups.append(group)
+
+ def build_group(self, index, group):
+   header = os.path.join(self.directory, 'pch-%d.h' % index)
+   with open(header, 'w') as f:
+     for include in group['includes']:
+       f.write('#include "%s"\n' % include)
+   pch = header + '.pch'
+   invocation = ([self.clang_binary, '-x', group['language']] +
+                 group['flags'] + [header, '-o', pch])
+   start = time.time()
+   try:
+     with open(os.devnull, 'w') as dev_null:
+       returncode = subprocess.call(invocation, cwd=group['directory'],
+                                    stdout=dev_null, stderr=dev_null)
+   except OSError:
+     returncode = 1
+   group['build_time'] = time.time() - start
+   group['pch'] = pch
+   group['valid'] = returncode == 0
+
+ def build(self, jobs):
+   """Builds the PCHs of all groups in parallel."""
+   pending = queue.Queue()
+   for index, group in enumerate(self.groups):
+     pending.put((index, group))
+
+   def worker():
+     while True:
+       try:
+         index, group = pending.get_nowait()
+       except queue.Empty:
+         return
+       self.build_group(index, group)
+
+   threads = [threading.Thread(target=worker) for _ in range(max(1, jobs))]
+   for t in threads:
+     t.start()
+   for t in threads:
+     t.join()
+
+ def get_extra_args(self, name):
+   """Returns the clang-tidy arguments which load the PCH of a file."""
+   group = self.assignments.get(name)
+   if group is None or not group['valid']:
+     return []
+   return ['-extra-arg-before=-include-pch',
+           '-extra-arg-before=' + group['pch']]
+
+ def invalidate(self, name):
+   """Stops using the PCH of a file after clang-tidy rejected it."""
+   group = self.assignments[name]
+   with self.lock:
+     group['valid'] = False
+     group['fallbacks'] += 1
+
+ def record(self, name, plain_time, pch_time):
+   group = self.assignments[name]
+   with self.lock:
+     group['plain_time'] += plain_time
+     group['pch_time'] += pch_time
+     group['compared'] += 1
+
+ def print_report(self, log):
+   built = [group for group in self.groups if group['pch'] is not None]
+   print('PCH: %d groups, %d built successfully in %.1fs, covering %d files' %
+         (len(built), sum(1 for group in built if group['valid'] or
+                          group['fallbacks']),
+          sum(group['build_time'] for group in built),
+          sum(len(group['files']) for group in built)), file=log)
+   plain_total = 0.0
+   pch_total = 0.0
+   for group in built:
+     if group['fallbacks']:
+       print('  %s: PCH rejected by clang-tidy, fell back to plain' %
+             group['pch'], file=log)
+     if not group['compared']:
+       continue
+     plain_total += group['plain_time']
+     pch_total += group['pch_time'] + group['build_time']
+     print('  %s (%d includes, %d files): plain %.1fs, PCH %.1fs + %.1fs '
+           'build' % (group['pch'], len(group['includes']), group['compared'],
+                      group['plain_time'], group['pch_time'],
+                      group['build_time']), file=log)
+   if pch_total > 0:
+     print('PCH total: plain %.1fs, PCH %.1fs including builds (%.2fx)' %
+           (plain_total, pch_total, plain_total / pch_total), file=log)
+
+
+def load_timings(path):
+ """Loads the per translation unit clang-tidy durations of earlier runs."""
+ try:
+   with open(path) as f:
+     timings = json.load(f)
+ except (IOError, OSError, ValueError):
+   return {}
+ if not isinstance(timings, dict):
+   return {}
+ return timings
+
+
+def save_timings(path, timings):
+ """Atomically writes the timing database."""
+ directory = os.path.dirname(os.path.abspath(path))
+ (handle, name) = tempfile.mkstemp(suffix='.json', dir=directory)
+ with os.fdopen(handle, 'w') as f:
+   json.dump(timings, f, indent=1, sort_keys=True)
+ os.rename(name, path)
+
+
+# Seconds of clang-tidy time per byte of source, used to estimate the
+# duration of translation units when no earlier timing is known at all.
+DEFAULT_SECONDS_PER_BYTE = 2e-4
+
+
+def estimate_durations(files, timings):
+ """Predicts how long clang-tidy will take for each file.
+
+ Files with a recorded duration use it. Other files are estimated from
+ their size, scaled by the median seconds-per-byte of the recorded files.
+ """
+ sizes = {}
+ for name in files:
+   try:
+     sizes[name] = os.path.getsize(name)
+   except OSError:
+     sizes[name] = 0
+ ratios = sorted(timings[name] / sizes[name] for name in files
+                 if name in timings and sizes[name] > 0)
+ seconds_per_byte = DEFAULT_SECONDS_PER_BYTE
+ if ratios:
+   seconds_per_byte = ratios[len(ratios) // 2]
+ return dict((name, timings[name] if name in timings
+              else sizes[name] * seconds_per_byte) for name in files)
+
+
+def simulate_makespan(durations, workers):
+ """Returns the makespan of dispatching durations in order to workers."""
+ finish_times = [0.0] * max(1, workers)
+ for duration in durations:
+   heapq.heappush(finish_times, heapq.heappop(finish_times) + duration)
+ return max(finish_times)
+
+
+def partition_files(files, estimates, count):
+ """Splits files into count shards of roughly equal estimated cost.
+
+ Files are assigned longest first to the currently cheapest shard. The
+ result only depends on the inputs, so every shard of a distributed run
+ computes the same partition as long as they share the same estimates.
+ """
+ shards = [[] for _ in range(count)]
+ costs = [(0.0, index) for index in range(count)]
+ for name in sorted(files, key=lambda name: (-estimates[name], name)):
+   cost, index = heapq.heappop(costs)
+   shards[index].append(name)
+   heapq.heappush(costs, (cost + estimates[name], index))
+ return shards
+
+
+# Names of the files inside a result bundle written with -bundle.
+BUNDLE_INFO = 'bundle.json'
+BUNDLE_FIXES = 'fixes.yaml'
+BUNDLE_DIAGNOSTICS = 'diagnostics.jsonl'
+BUNDLE_TIMINGS = 'timings.json'
+
+
+def write_bundle_info(bundle, shard_index, shard_count, files, failed_files):
+ with open(os.path.join(bundle, BUNDLE_INFO), 'w') as f:
+   json.dump({'shard_index': shard_index, 'shard_count': shard_count,
+              'files': files, 'failed_files': sorted(failed_files)},
+             f, indent=1, sort_keys=True)
+
+
+def merge_bundles(argv):
+ """Combines the result bundles of a sharded run.
+
+ The merged fixes and diagnostics are written exactly as a single run over
+ all shards would have written them, apart from diagnostics in headers
+ which are reported only once instead of once per shard.
+ """
+ parser = argparse.ArgumentParser(prog='run-clang-tidy.py merge',
+                                  description='Merges the result bundles '
+                                  'written by sharded run-clang-tidy.py runs.')
+ parser.add_argument('-export-fixes', metavar='filename', dest='export_fixes',
+                     help='Create a yaml file with the suggested fixes of all '
+                     'shards.')
+ parser.add_argument('-export-diagnostics', metavar='filename',
+                     dest='export_diagnostics',
+                     help='Create a JSON lines file with the diagnostics of '
+                     'all shards.')
+ parser.add_argument('-timings-file', dest='timings_file', default=None,
+                     help='Timing database to update with the durations '
+                     'recorded by all shards.')
+ parser.add_argument('bundles', nargs='+', help='result bundle directories')
+ args = parser.parse_args(argv)
+
+ return_code = 0
+ infos = []
+ for bundle in args.bundles:
+   with open(os.path.join(bundle, BUNDLE_INFO)) as f:
+     infos.append(json.load(f))
+ shard_counts = set(info['shard_count'] for info in infos)
+ shard_indices = sorted(info['shard_index'] for info in infos)
+ expected_indices = list(range(infos[0]['shard_count']))
+ if len(shard_counts) != 1 or shard_indices != expected_indices:
+   print('Error: expected exactly one bundle for each of %s shards, got '
+         'shards %s.' % ('/'.join(str(c) for c in sorted(shard_counts)),
+                         shard_indices), file=sys.stderr)
+   return_code = 1
+ for info in infos:
+   for name in info['failed_files']:
+     print('clang-tidy failed on ' + name, file=sys.stderr)
+     return_code = 1
+
+ if args.export_diagnostics:
+   seen = set()
+   with open(args.export_diagnostics, 'w') as out:
+     for bundle in args.bundles:
+       path = os.path.join(bundle, BUNDLE_DIAGNOSTICS)
+       if not os.path.isfile(path):
+         continue
+       with open(path) as f:
+         for line in f:
+           diagnostic = json.loads(line)
+           key = (diagnostic['file'], diagnostic['line'],
+                  diagnostic['column'], diagnostic['check'])
+           if key in seen:
+             continue
+           seen.add(key)
+           out.write(line)
+
+ if args.export_fixes:
+   if not yaml:
+     print('Error: exporting fixes requires PyYAML.', file=sys.stderr)
+     return 1
+   print('Writing fixes to ' + args.export_fixes + ' ...')
+   tmpdir = tempfile.mkdtemp()
+   try:
+     for index, bundle in enumerate(args.bundles):
+       path = os.path.join(bundle, BUNDLE_FIXES)
+       if os.path.isfile(path):
+         shutil.copyfile(path, os.path.join(tmpdir, '%d.yaml' % index))
+     merge_replacement_files(tmpdir, args.export_fixes)
+   finally:
+     shutil.rmtree(tmpdir)
+
+ if args.timings_file:
+   timings = load_timings(args.timings_file)
+   for bundle in args.bundles:
+     timings.update(load_timings(os.path.join(bundle, BUNDLE_TIMINGS)))
+   save_timings(args.timings_file, timings)
+
+ return return_code
+
+
+def parse_size(size):
+ """Parses a size such as '500M' or '5G' into a number of bytes."""
+ units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+ size = size.strip().upper()
+ if size and size[-1] in units:
+   return int(float(size[:-1]) * units[size[-1]])
+ return int(size)
+
+
+class ResultCache(object):
+ """On-disk cache of clang-tidy results, similar in spirit to ccache.
+
+ Entries are keyed by a hash of the preprocessed translation unit, the
+ compile flags, the clang-tidy invocation, the clang-tidy version and the
+ effective configuration for the file. Each entry stores the clang-tidy
+ stdout/stderr, its return code and the exported fixes so that a hit can be
+ replayed byte-for-byte. Entries are evicted least recently used first once
+ the cache grows beyond its size limit.
+ """
+
+ def __init__(self, directory, max_size, clang_tidy_binary, checks, config,
+              allow_enabling_alpha_checkers):
+   self.directory = os.path.abspath(directory)
+   self.max_size = max_size
+   self.clang_tidy_binary = clang_tidy_binary
+   self.checks = checks
+   self.config = config
+   self.allow_enabling_alpha_checkers = allow_enabling_alpha_checkers
+   self.hits = 0
+   self.misses = 0
+   self.uncacheable = 0
+   self.evicted = 0
+   self.lock = threading.Lock()
+   self.config_digests = {}
+   if not os.path.isdir(self.directory):
+     os.makedirs(self.directory)
+   self.version = subprocess.check_output(
+       [clang_tidy_binary, '--version']).decode('utf-8')
+
+ def get_config_digest(self, name):
+   """Hashes the effective clang-tidy configuration for a file.
+
+   clang-tidy looks up .clang-tidy files per directory, so the result is
+   memoised per directory.
+   """
+   directory = os.path.dirname(name)
+   with self.lock:
+     if directory in self.config_digests:
+       return self.config_digests[directory]
+   invocation = [self.clang_tidy_binary, '-dump-config']
+   if self.allow_enabling_alpha_checkers:
+     invocation.append('-allow-enabling-analyzer-alpha-checkers')
+   if self.checks:
+     invocation.append('-checks=' + self.checks)
+   if self.config:
+     invocation.append('-config=' + self.config)
+   invocation.append(name)
+   try:
+     output = subprocess.check_output(invocation, stderr=subprocess.STDOUT)
+   except (OSError, subprocess.CalledProcessError):
+     return None
+   digest = hashlib.sha256(output).hexdigest()
+   with self.lock:
+     self.config_digests[directory] = digest
+   return digest
+
+ def compute_key(self, entry, invocation):
+   """Computes the cache key of a clang-tidy invocation.
+
+   Returns None if the translation unit cannot be preprocessed, in which
+   case the result must not be cached.
+   """
+   name = invocation[-1]
+   config_digest = self.get_config_digest(name)
+   if config_digest is None:
+     return None
+   h = hashlib.sha256()
+   try:
+     proc = subprocess.Popen(get_preprocess_invocation(entry),
+                             cwd=entry['directory'],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+   except OSError:
+     return None
+   # Hash the preprocessed output as it streams in rather than holding the
+   # whole translation unit in memory. Warnings of the preprocessor are
+   # discarded, a full stderr pipe would block it while stdout is read.
+   for chunk in iter(lambda: proc.stdout.read(1 << 16), b''):
+     h.update(chunk)
+   if proc.wait() != 0:
+     return None
+   # The name of the temporary fixes file changes on every run, and whether
+   # fixes are exported does not change the diagnostics.
+   fixes = get_export_fixes_file(invocation)
+   stable_invocation = [arg for arg in invocation
+                        if arg not in ('-export-fixes', fixes)]
+   for part in (get_compile_arguments(entry), stable_invocation,
+                [self.version, config_digest]):
+     h.update(json.dumps(part).encode('utf-8'))
+   return h.hexdigest()
+
+ def entry_path(self, key):
+   return os.path.join(self.directory, key[:2], key)
+
+ def lookup(self, key, want_fixes):
+   """Returns (stdout, stderr, returncode, fixes) for a key, or None."""
+   path = self.entry_path(key)
+   try:
+     with open(os.path.join(path, 'result.json')) as f:
+       result = json.load(f)
+     with open(os.path.join(path, 'stdout'), 'rb') as f:
+       output = f.read()
+     with open(os.path.join(path, 'stderr'), 'rb') as f:
+       err = f.read()
+     fixes = None
+     if want_fixes:
+       with open(os.path.join(path, 'fixes.yaml'), 'rb') as f:
+         fixes = f.read()
+     # Mark the entry as recently used for LRU eviction.
+     os.utime(path, None)
+   except (IOError, OSError, ValueError):
+     with self.lock:
+       self.misses += 1
+     return None
+   with self.lock:
+     self.hits += 1
+   return output, err, result['returncode'], fixes
+
+ def store(self, key, output, err, returncode, fixes):
+   """Atomically adds a result to the cache."""
+   path = self.entry_path(key)
+   parent = os.path.dirname(path)
+   try:
+     if not os.path.isdir(parent):
+       os.makedirs(parent)
+   except OSError:
+     pass
+   staging = None
+   try:
+     staging = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+     with open(os.path.join(staging, 'result.json'), 'w') as f:
+       json.dump({'returncode': returncode}, f)
+     with open(os.path.join(staging, 'stdout'), 'wb') as f:
+       f.write(output)
+     with open(os.path.join(staging, 'stderr'), 'wb') as f:
+       f.write(err)
+     if fixes is not None:
+       with open(os.path.join(staging, 'fixes.yaml'), 'wb') as f:
+         f.write(fixes)
+     if os.path.isdir(path):
+       shutil.rmtree(path, ignore_errors=True)
+     os.rename(staging, path)
+   except OSError:
+     # Another worker or process stored the same key concurrently, or the
+     # cache directory is full or read-only; the result is just not cached.
+     if staging is not None:
+       shutil.rmtree(staging, ignore_errors=True)
+
+ def evict(self):
+   """Removes least recently used entries until the cache fits its limit."""
+   entries = []
+   total = 0
+   for bucket in glob.iglob(os.path.join(self.directory, '*')):
+     for path in glob.iglob(os.path.join(bucket, '*')):
+       try:
+         size = sum(os.path.getsize(os.path.join(path, f))
+                    for f in os.listdir(path))
+         entries.append((os.path.getmtime(path), size, path))
+       except OSError:
+         continue
+       total += size
+   entries.sort()
+   for _, size, path in entries:
+     if total <= self.max_size:
+       break
+     shutil.rmtree(path, ignore_errors=True)
+     total -= size
+     self.evicted += 1
+   return total
+
+ def print_stats(self, log):
+   total = self.hits + self.misses
+   rate = 100.0 * self.hits / total if total else 0.0
+   size = self.evict()
+   print('clang-tidy cache: %d hits, %d misses (%.1f%% hit rate), '
+         '%d uncacheable, %d evicted, %.1f MiB in %s' %
+         (self.hits, self.misses, rate, self.uncacheable, self.evicted,
+          size / (1024.0 * 1024.0), self.directory), file=log)
+
+
+# Matches the diagnostic lines printed by clang-tidy, e.g.
+#   /path/to/file.cc:12:3: warning: message text [check-name]
+DIAGNOSTIC_RE = re.compile(r'^(?P<file>.+?):(?P<line>[0-9]+):(?P<column>[0-9]+): '
+                           r'(?P<severity>warning|error): (?P<message>.*?)'
+                           r'(?: \[(?P<check>[^\]]+)\])?$')
+
+
+def parse_diagnostics(output):
+ """Extracts the warnings and errors from clang-tidy output."""
+ diagnostics = []
+ for line in output.splitlines():
+   found = DIAGNOSTIC_RE.match(line)
+   if found:
+     diagnostic = found.groupdict()
+     diagnostic['line'] = int(diagnostic['line'])
+     diagnostic['column'] = int(diagnostic['column'])
+     diagnostics.append(diagnostic)
+ return diagnostics
+
+
+def escape_regex(text):
+ """Escapes text for use in the POSIX extended regexes of clang-tidy."""
+ return re.sub(r'([.^$|()\[\]{}*+?\\])', r'\\\1', text)
+
+
+class DiagnosticDeduplicator(object):
+ """Suppresses diagnostics which an earlier translation unit reported.
+
+ With -header-filter every translation unit including a header reports the
+ diagnostics in that header again. Diagnostics are identified by file, line,
+ column and check, and only the first report of each is kept, together with
+ the notes and source snippets that follow it.
+
+ When skip_headers is set, headers included by translation units which
+ clang-tidy analyzed successfully are passed to clang-tidy with
+ -exclude-header-filter so that later translation units do not report on
+ them at all. This requires clang-tidy 19 or newer. The included headers are
+ taken from the dependency output of the preprocessor (-M), which costs one
+ preprocessor run per translation unit but only lists headers which were
+ really compiled. Only headers matching header_filter are listed, as
+ clang-tidy ignores the others anyway, and the filter is capped at
+ MAX_EXCLUDE_FILTER_LENGTH characters to stay below the size limit of a
+ single argument; the headers beyond that are deduplicated from the output
+ instead.
+ """
+
+ # Linux limits a single argument to 128 KiB (MAX_ARG_STRLEN).
+ MAX_EXCLUDE_FILTER_LENGTH = 32 * 1024
+
+ def __init__(self, entries, skip_headers, header_filter=None):
+   self.entries = entries
+   self.skip_headers = skip_headers
+   self.header_filter = None
+   if header_filter:
+     try:
+       self.header_filter = re.compile(header_filter)
+     except re.error:
+       pass
+   self.seen = set()
+   self.suppressed = 0
+   self.analyzed_headers = set()
+   self.lock = threading.Lock()
+
+ def get_extra_args(self):
+   """Returns the clang-tidy arguments to skip already analyzed headers."""
+   if not self.skip_headers:
+     return []
+   with self.lock:
+     headers = sorted(self.analyzed_headers)
+   alternatives = []
+   length = 0
+   for header in headers:
+     if (self.header_filter is not None and
+         not self.header_filter.search(header)):
+       continue
+     alternative = escape_regex(header)
+     length += len(alternative) + 1
+     if length > self.MAX_EXCLUDE_FILTER_LENGTH:
+       break
+     alternatives.append(alternative)
+   if not alternatives:
+     return []
+   return ['-exclude-header-filter=^(' + '|'.join(alternatives) + ')$']
+
+ def get_included_headers(self, name):
+   """Returns the headers transitively included by a translation unit.
+
+   Returns an empty set if the dependencies cannot be determined, so that no
+   header is skipped on a guess.
+   """
+   if not self.skip_headers:
+     return set()
+   entry = self.entries[name]
+   try:
+     proc = subprocess.Popen(get_dependency_invocation(entry),
+                             cwd=entry['directory'],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+     output = proc.communicate()[0]
+   except OSError:
+     return set()
+   if proc.returncode != 0:
+     return set()
+   headers = set(make_absolute(header, entry['directory'])
+                 for header in parse_dependencies(
+                     output.decode('utf-8', 'surrogateescape')))
+   headers.discard(name)
+   return headers
+
+ def filter(self, output, headers):
+   """Removes already reported diagnostics from clang-tidy output.
+
+   Returns the remaining output and its diagnostics. Must only be called
+   from one thread at a time.
+   """
+   with self.lock:
+     self.analyzed_headers.update(headers)
+   kept = []
+   diagnostics = []
+   keep = True
+   for line in output.splitlines(True):
+     found = DIAGNOSTIC_RE.match(line.rstrip('\r\n'))
+     if found:
+       diagnostic = found.groupdict()
+       diagnostic['line'] = int(diagnostic['line'])
+       diagnostic['column'] = int(diagnostic['column'])
+       key = (diagnostic['file'], diagnostic['line'], diagnostic['column'],
+              diagnostic['check'])
+       keep = key not in self.seen
+       if keep:
+         self.seen.add(key)
+         diagnostics.append(diagnostic)
+       else:
+         self.suppressed += 1
+     if keep:
+       kept.append(line)
+   return ''.join(kept), diagnostics
+
+
+def get_sarif_result(diagnostic):
+ """Converts a diagnostic record into a SARIF 2.1.0 result object."""
+ return {
+     'ruleId': diagnostic['check'] or 'clang-diagnostic',
+     'level': diagnostic['severity'],
+     'message': {'text': diagnostic['message']},
+     'locations': [{'physicalLocation': {
+         'artifactLocation': {
+             'uri': 'file://' + pathname2url(diagnostic['file'])},
+         'region': {'startLine': diagnostic['line'],
+                    'startColumn': diagnostic['column']}}}],
+     'properties': {'translationUnit': diagnostic['tu'],
+                    'duration': diagnostic['duration']},
+ }
+
+
+SARIF_HEADER = ('{"$schema": "https://json.schemastore.org/sarif-2.1.0.json", '
+                '"version": "2.1.0", "runs": [{"tool": {"driver": '
+                '{"name": "clang-tidy", "informationUri": '
+                '"https://clang.llvm.org/extra/clang-tidy/"}}, "results": [')
+SARIF_FOOTER = '\n]}]}\n'
+
+
+class ResultWriter(object):
+ """Writes the results of all workers from a single thread.
+
+ Workers hand their results over through an unbounded queue and carry on
+ with the next file, instead of waiting for each other on a shared lock
+ while output is parsed and written. Every diagnostic is written as a
+ record with its file, line, column, check, severity, message, translation
+ unit and the clang-tidy duration, as JSON lines or SARIF on stdout
+ depending on output_format, and as JSON lines to diagnostics_file.
+ """
+
+ def __init__(self, output_format, diagnostics_file, deduplicator):
+   self.output_format = output_format
+   self.diagnostics_file = diagnostics_file
+   self.deduplicator = deduplicator
+   self.results = queue.Queue()
+   self.sarif_results = 0
+   self.errors = 0
+   if output_format == 'sarif':
+     sys.stdout.write(SARIF_HEADER)
+   self.thread = threading.Thread(target=self.run)
+   self.thread.daemon = True
+   self.thread.start()
+
+ def put(self, name, invocation, output, err, duration, headers):
+   self.results.put((name, invocation, output, err, duration, headers))
+
+ def close(self):
+   """Waits for all pending results to be written."""
+   self.results.put(None)
+   self.thread.join()
+   if self.output_format == 'sarif':
+     sys.stdout.write(SARIF_FOOTER)
+   sys.stdout.flush()
+
+ def run(self):
+   while True:
+     result = self.results.get()
+     if result is None:
+       return
+     # An exception would end the only writer thread and silently drop all
+     # later results, so it is reported for the file it happened on instead.
+     try:
+       self.write(*result)
+     except Exception as e:
+       sys.stdout.flush()
+       sys.stderr.write('%s: failed to write results: %s\n' % (result[0], e))
+       self.errors += 1
+
+ def write(self, name, invocation, output, err, duration, headers):
+   output = output.decode('utf-8', 'replace')
+   if self.deduplicator is not None:
+     output, diagnostics = self.deduplicator.filter(output, headers)
+   elif self.output_format != 'text' or self.diagnostics_file is not None:
+     diagnostics = parse_diagnostics(output)
+   else:
+     diagnostics = []
+   for diagnostic in diagnostics:
+     diagnostic['tu'] = name
+     diagnostic['duration'] = round(duration, 3)
+
+   if self.output_format == 'text':
+     sys.stdout.write(' '.join(invocation) + '\n' + output)
+   elif self.output_format == 'jsonl':
+     for diagnostic in diagnostics:
+       sys.stdout.write(json.dumps(diagnostic, sort_keys=True) + '\n')
+   else:
+     for diagnostic in diagnostics:
+       sys.stdout.write((',\n' if self.sarif_results else '\n') +
+                        json.dumps(get_sarif_result(diagnostic),
+                                   sort_keys=True))
+       self.sarif_results += 1
+   if self.diagnostics_file is not None:
+     for diagnostic in diagnostics:
+       self.diagnostics_file.write(json.dumps(diagnostic, sort_keys=True) +
+                                   '\n')
+   if len(err) > 0:
+     sys.stdout.flush()
+     sys.stderr.write(err.decode('utf-8', 'replace'))
+
+
 def merge_replacement_files(tmpdir, mergefile):
  """Merge all replacement files in a directory into a single file"""
  # The fixes suggested by clang-tidy >= 4.0.0 are given under
  # the top level key 'Diagnostics' in the output yaml files
  mergekey = "Diagnostics"
- merged=[]
- for replacefile in glob.iglob(os.path.join(tmpdir, '*.yaml')):
-   content = yaml.safe_load(open(replacefile, 'r'))
-   if not content:
-     continue # Skip empty files.
-   merged.extend(content.get(mergekey, []))
-
- if merged:
-   # MainSourceFile: The key is required by the definition inside
-   # include/clang/Tooling/ReplacementsYaml.h, but the value
-   # is actually never used inside clang-apply-replacements,
-   # so we set it to '' here.
-   output = {'MainSourceFile': '', mergekey: merged}
-   with open(mergefile, 'w') as out:
-     yaml.safe_dump(output, out)
+ # Diagnostics in headers are exported once for every translation unit
+ # including the header. Only a digest of each diagnostic is kept to drop
+ # those duplicates, and the merged file is written as the replacement files
+ # are read, so memory use does not grow with the size of the fixes.
+ seen = set()
+ out = None
+ partial = mergefile + '.tmp'
+ try:
+   for replacefile in sorted(glob.iglob(os.path.join(tmpdir, '*.yaml'))):
+     with open(replacefile, 'r') as f:
+       content = yaml.load(f, Loader=YamlLoader)
+     if not content:
+       continue # Skip empty files.
+     diagnostics = []
+     for diagnostic in content.get(mergekey) or []:
+       digest = hashlib.sha1(json.dumps(
+           diagnostic, sort_keys=True, default=str).encode('utf-8')).digest()
+       if digest not in seen:
+         seen.add(digest)
+         diagnostics.append(diagnostic)
+     if not diagnostics:
+       continue
+     if out is None:
+       out = open(partial, 'w')
+       # MainSourceFile: The key is required by the definition inside
+       # include/clang/Tooling/ReplacementsYaml.h, but the value
+       # is actually never used inside clang-apply-replacements,
+       # so we set it to '' here.
+       out.write("MainSourceFile: ''\n%s:\n" % mergekey)
+     yaml.dump(diagnostics, out, Dumper=YamlDumper, default_flow_style=False)
+ except:
+   if out is not None:
+     out.close()
+     os.remove(partial)
+   raise
+ if out is not None:
+   out.close()
+   os.rename(partial, mergefile)
 
 
 def check_clang_apply_replacements_binary(args):
  """Checks if invoking supplied clang-apply-replacements binary works."""
  try:
-   subprocess.check_call([args.clang_apply_replacements_binary, '--version'])
+   # Keep stdout parseable in the structured output formats.
+   stdout = None if args.output_format == 'text' else sys.stderr
+   subprocess.check_call([args.clang_apply_replacements_binary, '--version'],
+                         stdout=stdout)
  except:
    print('Unable to run clang-apply-replacements. Is clang-apply-replacements '
          'binary correctly specified?', file=sys.stderr)
@@ -157,32 +1196,116 @@ def apply_fixes(args, tmpdir):
  subprocess.call(invocation)
 
 
-def run_tidy(args, tmpdir, build_path, queue, lock, failed_files):
+def run_invocation(invocation):
+ """Runs clang-tidy, returning its output, return code and duration."""
+ start = time.time()
+ proc = subprocess.Popen(invocation, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+ output, err = proc.communicate()
+ return output, err, proc.returncode, time.time() - start
+
+
+def run_tidy(args, tmpdir, build_path, queue, writer, failed_files, entries,
+             cache, durations, deduplicator, pch):
  """Takes filenames out of queue and runs clang-tidy on them."""
  while True:
    name = queue.get()
-   invocation = get_tidy_invocation(name, args.clang_tidy_binary, args.checks,
-                                    tmpdir, build_path, args.header_filter,
-                                    args.allow_enabling_alpha_checkers,
-                                    args.extra_arg, args.extra_arg_before,
-                                    args.quiet, args.config, args.line_filter)
-
-   proc = subprocess.Popen(invocation, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-   output, err = proc.communicate()
-   if proc.returncode != 0:
-     if proc.returncode < 0:
-       msg = "%s: terminated by signal %d\n" % (name, -proc.returncode)
-       err += msg.encode('utf-8')
+   start = time.time()
+   invocation = [name]
+   try:
+     invocation = get_tidy_invocation(name, args.clang_tidy_binary,
+                                      args.checks, tmpdir, build_path,
+                                      args.header_filter,
+                                      args.allow_enabling_alpha_checkers,
+                                      args.extra_arg, args.extra_arg_before,
+                                      args.quiet, args.config, args.line_filter)
+     fixes_file = get_export_fixes_file(invocation)
+
+     key = None
+     cached = None
+     if cache is not None:
+       key = cache.compute_key(entries[name], invocation)
+       if key is None:
+         with cache.lock:
+           cache.uncacheable += 1
+       else:
+         cached = cache.lookup(key, fixes_file is not None)
+     # The headers to skip depend on which translation units happened to
+     # finish first. Cacheable runs are done without them, so that the key
+     # and the stored output do not depend on the scheduling of the workers;
+     # their repeated diagnostics are still removed from the output.
+     if deduplicator is not None and key is None:
+       invocation[-1:-1] = deduplicator.get_extra_args()
+
+     if cached is not None:
+       output, err, returncode, fixes = cached
+       if fixes_file is not None:
+         with open(fixes_file, 'wb') as f:
+           f.write(fixes)
+     else:
+       used_pch = False
+       pch_args = pch.get_extra_args(name) if pch is not None else []
+       if pch_args:
+         pch_invocation = invocation[:-1] + pch_args + invocation[-1:]
+         output, err, returncode, duration = run_invocation(pch_invocation)
+         # A nonzero status usually just means that warnings were turned into
+         # errors, the plain path is only needed when the PCH is stale or
+         # does not match the flags of this file.
+         rejected = (returncode != 0 and
+                     (PCH_REJECTED_RE.search(output) is not None or
+                      PCH_REJECTED_RE.search(err) is not None))
+         if rejected or args.pch_compare:
+           pch_duration = duration
+           output, err, returncode, duration = run_invocation(invocation)
+           if rejected:
+             pch.invalidate(name)
+           else:
+             pch.record(name, duration, pch_duration)
+             duration = pch_duration
+         else:
+           invocation = pch_invocation
+           used_pch = True
+       else:
+         output, err, returncode, duration = run_invocation(invocation)
+       # Cache hits say nothing about how long clang-tidy takes, so only real
+       # runs are recorded.
+       durations[name] = duration
+       # Results of runs killed by a signal are not reproducible, so they are
+       # never cached. Neither are results of PCH runs, the key only covers
+       # the plain invocation.
+       if key is not None and returncode >= 0 and not used_pch:
+         fixes = None
+         if fixes_file is not None:
+           with open(fixes_file, 'rb') as f:
+             fixes = f.read()
+         cache.store(key, output, err, returncode, fixes)
+
+     if returncode != 0:
+       if returncode < 0:
+         msg = "%s: terminated by signal %d\n" % (name, -returncode)
+         err += msg.encode('utf-8')
+       failed_files.append(name)
+     # Only translation units which clang-tidy analyzed completely have
+     # reported on their headers.
+     headers = set()
+     if deduplicator is not None and returncode == 0:
+       headers = deduplicator.get_included_headers(name)
+     writer.put(name, invocation, output, err, time.time() - start, headers)
+   except Exception as e:
+     # A worker which dies leaves its file unfinished and main() waiting
+     # for it forever, so the file is reported as failed instead.
      failed_files.append(name)
-   with lock:
-     sys.stdout.write(' '.join(invocation) + '\n' + output.decode('utf-8'))
-     if len(err) > 0:
-       sys.stdout.flush()
-       sys.stderr.write(err.decode('utf-8'))
-   queue.task_done()
+     msg = "%s: %s\n" % (name, e)
+     writer.put(name, invocation, b'', msg.encode('utf-8'),
+                time.time() - start, set())
+   finally:
+     queue.task_done()
 
 
 def main():
+ if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+   sys.exit(merge_bundles(sys.argv[2:]))
+
  parser = argparse.ArgumentParser(description='Runs clang-tidy over all files '
                                   'in a compilation database. Requires '
                                   'clang-tidy and clang-apply-replacements in '
@@ -215,10 +1338,40 @@ def main():
  parser.add_argument('-line-filter', default=None,
                      help='List of files with line ranges to filter the'
                      'warnings.')
+ parser.add_argument('-deduplicate', action='store_true',
+                     help='Report each diagnostic only once, even if several '
+                     'translation units include the header it is in.')
+ parser.add_argument('-skip-analyzed-headers', action='store_true',
+                     dest='skip_analyzed_headers',
+                     help='With -deduplicate, stop reporting diagnostics in '
+                     'headers which a successfully analyzed translation unit '
+                     'already included. Runs whose result is cached with '
+                     '-cache-dir still analyze all headers. Requires '
+                     'clang-tidy 19 or newer.')
+ parser.add_argument('-diff-base', '--diff-base', metavar='REV',
+                     dest='diff_base', default=None,
+                     help='Only process the translation units affected by '
+                     'changes in the working tree since the given git '
+                     'revision, and only report diagnostics on the changed '
+                     'lines. Cannot be combined with -line-filter.')
  if yaml:
    parser.add_argument('-export-fixes', metavar='filename', dest='export_fixes',
                        help='Create a yaml file to store suggested fixes in, '
                        'which can be applied with clang-apply-replacements.')
+ parser.add_argument('-export-diagnostics', metavar='filename',
+                     dest='export_diagnostics',
+                     help='Create a JSON lines file with one record per '
+                     'warning or error reported by clang-tidy, in the format '
+                     'of -output-format=jsonl, which can be read by '
+                     'clang_tidy_ratchet.py --diagnostics.')
+ parser.add_argument('-output-format', '--output-format',
+                     dest='output_format', default='text',
+                     choices=['text', 'jsonl', 'sarif'],
+                     help='Format of the results on stdout. text prints the '
+                     'clang-tidy output of each file, jsonl prints one JSON '
+                     'record per diagnostic and sarif prints a SARIF 2.1.0 '
+                     'log. Status messages go to stderr in the structured '
+                     'formats.')
  parser.add_argument('-j', type=int, default=0,
                      help='number of tidy instances to be run in parallel.')
  parser.add_argument('files', nargs='*', default=['.*'],
@@ -240,8 +1393,79 @@ def main():
                      'command line.')
  parser.add_argument('-quiet', action='store_true',
                      help='Run clang-tidy in quiet mode')
+ parser.add_argument('-timings-file', dest='timings_file', default=None,
+                     help='JSON file in which clang-tidy durations per file '
+                     'are recorded. Files are dispatched longest first based '
+                     'on these timings, files without a recorded timing are '
+                     'estimated from their size. Defaults to '
+                     'clang-tidy-timings.json in the build path, pass an empty '
+                     'value to disable.')
+ parser.add_argument('-pch', action='store_true',
+                     help='Group files by identical flags, precompile the '
+                     'leading includes most files of a group share and load '
+                     'the PCH in clang-tidy instead of parsing those headers '
+                     'for every file. Files fall back to the plain path if '
+                     'clang-tidy rejects the PCH. Checks built on '
+                     'preprocessor callbacks, e.g. llvm-include-order or '
+                     'llvm-header-guard, miss findings in the headers of the '
+                     'PCH.')
+ parser.add_argument('-pch-clang-binary', metavar='PATH',
+                     dest='pch_clang_binary', default='clang',
+                     help='clang used to build PCHs, it must be the version '
+                     'clang-tidy is based on.')
+ parser.add_argument('-pch-min-files', type=int, default=2,
+                     dest='pch_min_files',
+                     help='Minimum number of files sharing leading includes '
+                     'for a PCH to be built for them.')
+ parser.add_argument('-pch-compare', action='store_true',
+                     dest='pch_compare',
+                     help='With -pch, also run the plain path for files '
+                     'using a PCH and report the time of both paths.')
+ parser.add_argument('-shard-index', '--shard-index', dest='shard_index',
+                     type=int, default=None,
+                     help='Only process the files of this shard, counting '
+                     'from 0. Shards are balanced by estimated cost. All '
+                     'shards of a run must see the same -timings-file, '
+                     'without one the estimates are based on file sizes.')
+ parser.add_argument('-shard-count', '--shard-count', dest='shard_count',
+                     type=int, default=None,
+                     help='Total number of shards the files are split into.')
+ parser.add_argument('-bundle', metavar='DIR', default=None,
+                     help='Directory in which to write a self-contained '
+                     'result bundle with the diagnostics, fixes and timings '
+                     'of this run. Bundles of all shards are combined with '
+                     '"run-clang-tidy.py merge".')
+ parser.add_argument('-cache-dir', dest='cache_dir',
+                     default=os.environ.get('CLANG_TIDY_CACHE_DIR'),
+                     help='Directory in which to cache clang-tidy results. '
+                     'Translation units whose preprocessed source, flags, '
+                     'clang-tidy version and configuration are unchanged '
+                     'replay the cached results instead of being re-analyzed. '
+                     'Defaults to $CLANG_TIDY_CACHE_DIR, caching is disabled '
+                     'when neither is set.')
+ parser.add_argument('-cache-size', dest='cache_size',
+                     default=os.environ.get('CLANG_TIDY_CACHE_SIZE', '5G'),
+                     help='Maximum size of the result cache, least recently '
+                     'used entries are evicted beyond it (default: 5G).')
  args = parser.parse_args()
 
+ if (args.shard_index is None) != (args.shard_count is None):
+   parser.error('-shard-index and -shard-count must be given together')
+ if args.shard_count is not None and not (
+     0 <= args.shard_index < args.shard_count):
+   parser.error('-shard-index must be in [0, -shard-count)')
+
+ if args.bundle:
+   if not os.path.isdir(args.bundle):
+     os.makedirs(args.bundle)
+   if not args.export_diagnostics:
+     args.export_diagnostics = os.path.join(args.bundle, BUNDLE_DIAGNOSTICS)
+   if yaml and not args.export_fixes:
+     args.export_fixes = os.path.join(args.bundle, BUNDLE_FIXES)
+
+ # Keep stdout parseable in the structured output formats.
+ log = sys.stdout if args.output_format == 'text' else sys.stderr
+
  db_path = 'compile_commands.json'
 
  if args.build_path is not None:
@@ -258,7 +1482,7 @@ def main():
    if args.checks:
      invocation.append('-checks=' + args.checks)
    invocation.append('-')
-   if args.quiet:
+   if args.quiet or args.output_format != 'text':
      # Even with -quiet we still want to check if we can call clang-tidy.
      with open(os.devnull, 'w') as dev_null:
        subprocess.check_call(invocation, stdout=dev_null)
@@ -270,9 +1494,42 @@ def main():
 
  # Load the database and extract all files.
  database = json.load(open(os.path.join(build_path, db_path)))
+ entries = {}
+ for entry in database:
+   entries.setdefault(make_absolute(entry['file'], entry['directory']), entry)
  files = [make_absolute(entry['file'], entry['directory'])
           for entry in database]
 
+ if args.diff_base is not None:
+   if args.line_filter is not None:
+     print('Error: -diff-base cannot be combined with -line-filter.',
+           file=sys.stderr)
+     sys.exit(1)
+   try:
+     changed_lines = get_changed_lines(args.diff_base)
+   except (OSError, subprocess.CalledProcessError):
+     print('Error: unable to compute the changes since ' + args.diff_base +
+           '.', file=sys.stderr)
+     sys.exit(1)
+   if not changed_lines:
+     print('No lines changed since ' + args.diff_base + '.', file=log)
+     sys.exit(0)
+   files = get_diff_files(files, entries, changed_lines)
+   args.line_filter = json.dumps(
+       [{'name': name, 'lines': lines}
+        for name, lines in sorted(changed_lines.items())])
+
+ cache = None
+ if args.cache_dir:
+   try:
+     cache = ResultCache(args.cache_dir, parse_size(args.cache_size),
+                         args.clang_tidy_binary, args.checks, args.config,
+                         args.allow_enabling_alpha_checkers)
+   except (OSError, ValueError, subprocess.CalledProcessError):
+     print('Unable to set up the clang-tidy cache, running uncached.',
+           file=sys.stderr)
+     traceback.print_exc()
+
  max_task = args.j
  if max_task == 0:
    max_task = multiprocessing.cpu_count()
@@ -282,9 +1539,42 @@ def main():
    check_clang_apply_replacements_binary(args)
    tmpdir = tempfile.mkdtemp()
 
+ deduplicator = None
+ if args.deduplicate:
+   deduplicator = DiagnosticDeduplicator(entries, args.skip_analyzed_headers,
+                                         args.header_filter)
+
+ diagnostics_file = None
+ if args.export_diagnostics:
+   diagnostics_file = open(args.export_diagnostics, 'w')
+ writer = ResultWriter(args.output_format, diagnostics_file, deduplicator)
+
  # Build up a big regexy filter from all command line arguments.
  sanitised_files = re.sub('\\+', '\\+', '|'.join(args.files))
  file_name_re = re.compile(sanitised_files)
+ files = [name for name in files if file_name_re.search(name)]
+
+ timings_file = args.timings_file
+ if timings_file is None and args.shard_count is None:
+   # Shards must not pick up timings local to their node, they would
+   # partition the files differently.
+   timings_file = os.path.join(build_path, 'clang-tidy-timings.json')
+ timings = load_timings(timings_file) if timings_file else {}
+ estimates = estimate_durations(files, timings)
+ if args.shard_count is not None:
+   files = partition_files(files, estimates,
+                           args.shard_count)[args.shard_index]
+ # Dispatching the longest files first keeps a few huge translation units
+ # from running on their own at the end of the run.
+ ordered_files = sorted(files, key=lambda name: estimates[name], reverse=True)
+ durations = {}
+
+ pch = None
+ if args.pch:
+   pch = PrecompiledHeaders(args.pch_clang_binary, tempfile.mkdtemp(),
+                            args.pch_min_files)
+   pch.plan(files, entries)
+   pch.build(max_task)
 
  return_code = 0
  try:
@@ -292,33 +1582,66 @@ def main():
    task_queue = queue.Queue(max_task)
    # List of files with a non-zero return code.
    failed_files = []
-   lock = threading.Lock()
    for _ in range(max_task):
      t = threading.Thread(target=run_tidy,
-                          args=(args, tmpdir, build_path, task_queue, lock, failed_files))
+                          args=(args, tmpdir, build_path, task_queue, writer,
+                                failed_files, entries, cache, durations,
+                                deduplicator, pch))
      t.daemon = True
      t.start()
 
    # Fill the queue with files.
-   for name in files:
-     if file_name_re.search(name):
-       task_queue.put(name)
+   start = time.time()
+   for name in ordered_files:
+     task_queue.put(name)
 
    # Wait for all threads to be done.
    task_queue.join()
-   if len(failed_files):
+   writer.close()
+   if files:
+     print('clang-tidy makespan: predicted %.1fs (%.1fs in database order), '
+           'actual %.1fs on %d workers' %
+           (simulate_makespan([estimates[name] for name in ordered_files],
+                              max_task),
+            simulate_makespan([estimates[name] for name in files], max_task),
+            time.time() - start, max_task), file=log)
+   if len(failed_files) or writer.errors:
      return_code = 1
+   if cache is not None:
+     cache.print_stats(log)
+   if deduplicator is not None and deduplicator.suppressed:
+     print('Suppressed %d duplicate diagnostics.' % deduplicator.suppressed,
+           file=log)
+   if pch is not None:
+     pch.print_report(log)
 
  except KeyboardInterrupt:
    # This is a sad hack. Unfortunately subprocess goes
    # bonkers with ctrl-c and we start forking merrily.
-   print('\nCtrl-C detected, goodbye.')
+   print('\nCtrl-C detected, goodbye.', file=log)
    if tmpdir:
      shutil.rmtree(tmpdir)
+   if pch is not None:
+     shutil.rmtree(pch.directory)
    os.kill(0, 9)
 
+ if diagnostics_file is not None:
+   diagnostics_file.close()
+
+ if timings_file and durations:
+   timings.update(durations)
+   try:
+     save_timings(timings_file, timings)
+   except (IOError, OSError):
+     print('Unable to write timings to ' + timings_file + '.', file=sys.stderr)
+
+ if args.bundle:
+   save_timings(os.path.join(args.bundle, BUNDLE_TIMINGS), durations)
+   write_bundle_info(args.bundle, args.shard_index or 0, args.shard_count or 1,
+                     files, failed_files)
+
  if yaml and args.export_fixes:
-   print('Writing fixes to ' + args.export_fixes + ' ...')
+   print('Writing fixes to ' + args.export_fixes + ' ...', file=log)
    try:
      merge_replacement_files(tmpdir, args.export_fixes)
    except:
@@ -327,7 +1650,7 @@ def main():
      return_code=1
 
  if args.fix:
-   print('Applying fixes ...')
+   print('Applying fixes ...', file=log)
    try:
      apply_fixes(args, tmpdir)
    except:
@@ -337,6 +1660,8 @@ def main():
 
  if tmpdir:
    shutil.rmtree(tmpdir)
+ if pch is not None:
+   shutil.rmtree(pch.directory)
  sys.exit(return_code)
 
 